@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Helpers shared by benchmarks.
+
+Package's <code>__init__</code> is a gedit plugin and requires gedit and gtk
+modules, so benchmarks register a bare <code>zencoding</code> package and
+import Zen Coding modules from it directly.
+'''
+import imp
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _register_package():
+	if 'zencoding' in sys.modules:
+		return
+
+	package = imp.new_module('zencoding')
+	package.__path__ = [os.path.join(root, 'zencoding')]
+	sys.modules['zencoding'] = package
+
+def load_module(name):
+	"""
+	Imports module from zencoding package without running plugin code
+	@param name: Module name, like 'zen_core' or 'html_matcher'
+	@type name: str
+	@return: module
+	"""
+	_register_package()
+	__import__('zencoding.' + name)
+	return sys.modules['zencoding.' + name]
+
+def load_zen_core():
+	"""
+	Imports <code>zen_core</code> module and registers its filters
+	@return: module
+	"""
+	_register_package()
+	__import__('zencoding.filters')
+	return load_module('zen_core')
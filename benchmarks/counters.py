@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Counter replacement benchmark: expands abbreviations with counters, like
+<code>li.item$$$*5000</code>, with growing multiplier and reports time per
+element copy, which should stay flat as multiplier grows. Abbreviations with
+<code>|c</code> filter are expanded into separate node copies, the others
+use repeat nodes.
+
+Usage: python benchmarks/counters.py [repeats]
+'''
+import sys
+import time
+
+from common import load_zen_core
+
+abbreviations = [
+	'ul>li.item$$$*%(n)d',
+	'ul>li.item$$$*%(n)d|c',
+	'ul>li.item$$$*%(n)d>a[title=link$ of %(n)d]',
+]
+
+sizes = [1000, 2000, 5000, 10000, 20000]
+
+def measure(zen_core, abbr, repeats=3):
+	"""
+	Returns best expansion time of abbreviation, in seconds
+	@type abbr: str
+	@type repeats: int
+	@return: float
+	"""
+	best = None
+	for i in range(repeats):
+		zen_core.tree_cache.clear()
+		start = time.time()
+		zen_core.expand_abbreviation(abbr, 'html', 'xhtml')
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+
+	return best
+
+def main(args):
+	repeats = args and int(args[0]) or 3
+	zen_core = load_zen_core()
+
+	print '%-40s %8s %10s %12s' % ('abbreviation', 'copies', 'time, ms', 'us per copy')
+	for pattern in abbreviations:
+		for size in sizes:
+			abbr = pattern % {'n': size}
+			elapsed = measure(zen_core, abbr, repeats)
+			print '%-40s %8d %10.1f %12.2f' % (abbr, size, elapsed * 1000, elapsed * 1000000 / size)
+		print
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Abbreviation engine benchmark.
+
+Expands abbreviations from <code>corpus/abbreviations.txt</code> with each
+output profile, reports operations per second and time spent in each
+expansion phase (see <code>zen_core.get_stats()</code>) for every corpus
+group, and checks outputs against golden digests from
+<code>golden/&lt;profile&gt;.txt</code>. Benchmark fails if any output
+differs from golden one, so performance work can't silently change results.
+
+After intended output changes, golden files are rewritten with
+<code>--update</code> option.
+
+Usage: python benchmarks/expand.py [--update] [--check] [--cold] [--repeat N]
+[--profile name] [--group name]
+
+	--update   write golden files instead of checking outputs
+	--check    check outputs only, without timing
+	--cold     clear parsed trees cache before each expansion
+	--repeat   number of timed passes over each group, the best one is reported
+'''
+import hashlib
+import os
+import sys
+import time
+
+from common import load_zen_core
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+
+corpus_file = os.path.join(bench_dir, 'corpus', 'abbreviations.txt')
+
+golden_dir = os.path.join(bench_dir, 'golden')
+
+profiles = ('xhtml', 'html', 'xml', 'plain')
+
+phases = ('parse', 'rollout', 'filters', 'output', 'variables')
+
+def read_corpus(path=corpus_file):
+	"""
+	Reads benchmark corpus
+	@return: list of (group, syntax, abbreviation) tuples
+	"""
+	cases = []
+	for line in open(path):
+		line = line.strip()
+		if line and not line.startswith('#'):
+			group, syntax, abbr = line.split(None, 2)
+			cases.append((group, syntax, abbr))
+
+	return cases
+
+def wrap_text(lines):
+	"""
+	Generates text to wrap with abbreviation
+	@param lines: Number of lines
+	@type lines: int
+	@return: str
+	"""
+	return '\n'.join(['Item %d: lorem ipsum dolor sit amet, consectetur adipisicing elit' % i
+		for i in range(1, lines + 1)])
+
+def make_runner(zen_core, group, syntax, abbr, profile):
+	"""
+	Returns function that expands corpus case
+	@return: function
+	"""
+	if group.startswith('wrap:'):
+		text = wrap_text(int(group[5:]))
+		return lambda: zen_core.wrap_with_abbreviation(abbr, text, syntax, profile) or ''
+
+	return lambda: zen_core.expand_abbreviation(abbr, syntax, profile)
+
+def digest(output):
+	if isinstance(output, unicode):
+		output = output.encode('utf-8')
+	return hashlib.sha1(output).hexdigest()
+
+def golden_path(profile):
+	return os.path.join(golden_dir, profile + '.txt')
+
+def read_golden(profile):
+	"""
+	Reads golden digests of profile
+	@return: dict of digests by (group, syntax, abbreviation) key
+	"""
+	result = {}
+	path = golden_path(profile)
+	if os.path.exists(path):
+		for line in open(path):
+			line = line.rstrip('\n')
+			if line:
+				value, group, syntax, abbr = line.split('\t', 3)
+				result[(group, syntax, abbr)] = value
+
+	return result
+
+def write_golden(profile, cases, outputs):
+	if not os.path.isdir(golden_dir):
+		os.makedirs(golden_dir)
+
+	f = open(golden_path(profile), 'w')
+	try:
+		for case in cases:
+			f.write('%s\t%s\t%s\t%s\n' % ((outputs[case],) + case))
+	finally:
+		f.close()
+
+def time_group(zen_core, runners, repeat, cold):
+	"""
+	Runs expansions of group and returns best pass time and phase statistics
+	@return: tuple
+	"""
+	best = None
+	for i in range(repeat):
+		start = time.time()
+		for run in runners:
+			if cold:
+				zen_core.tree_cache.clear()
+			run()
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+
+	# phases are measured in a separate pass, timers slow expansion down
+	zen_core.reset_stats()
+	zen_core.enable_stats(True)
+	try:
+		for run in runners:
+			if cold:
+				zen_core.tree_cache.clear()
+			run()
+	finally:
+		zen_core.enable_stats(False)
+
+	return best, zen_core.get_stats()
+
+def main(args):
+	update = '--update' in args
+	check_only = '--check' in args or update
+	cold = '--cold' in args
+	repeat = 3
+	selected_profiles = profiles
+	selected_group = None
+
+	for i, arg in enumerate(args):
+		if arg == '--repeat':
+			repeat = int(args[i + 1])
+		elif arg == '--profile':
+			selected_profiles = (args[i + 1],)
+		elif arg == '--group':
+			selected_group = args[i + 1]
+
+	zen_core = load_zen_core()
+	cases = read_corpus()
+	groups = []
+	for case in cases:
+		if case[0] not in groups:
+			groups.append(case[0])
+
+	if selected_group:
+		if update:
+			print 'Golden files are written for the whole corpus only'
+			return 2
+		groups = [selected_group]
+		cases = [case for case in cases if case[0] == selected_group]
+
+	failures = []
+	for profile in selected_profiles:
+		golden = read_golden(profile)
+		outputs = {}
+
+		for case in cases:
+			try:
+				output = make_runner(zen_core, case[0], case[1], case[2], profile)()
+				outputs[case] = digest(output)
+			except Exception as e:
+				outputs[case] = 'error:%s' % e.__class__.__name__
+
+			if not update and golden.get(case) != outputs[case]:
+				failures.append((profile,) + case)
+
+		if update:
+			write_golden(profile, cases, outputs)
+			print 'Written %s (%d cases)' % (golden_path(profile), len(cases))
+			continue
+
+		if check_only:
+			continue
+
+		print 'Profile: %s' % profile
+		print '%-12s %6s %10s %10s' % ('group', 'cases', 'ops/sec', 'ms/pass') + \
+			''.join([' %9s' % phase[:9] for phase in phases])
+
+		for group in groups:
+			runners = [make_runner(zen_core, case[0], case[1], case[2], profile)
+				for case in cases if case[0] == group]
+			elapsed, stats = time_group(zen_core, runners, repeat, cold)
+			ops = elapsed and len(runners) / elapsed or 0
+
+			print '%-12s %6d %10.0f %10.2f' % (group, len(runners), ops, elapsed * 1000) + \
+				''.join([' %9.2f' % (stats.get(phase, {}).get('time', 0) * 1000) for phase in phases])
+		print
+
+	if failures:
+		print '%d outputs differ from golden:' % len(failures)
+		for failure in failures[:20]:
+			print '  [%s] %s %s %s' % failure
+		return 1
+
+	if not update:
+		print 'All outputs match golden'
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
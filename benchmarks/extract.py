@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Abbreviation extraction benchmark: extracts abbreviation from the end of
+long single-line documents, like minified HTML, with
+<code>zen_core.extract_abbreviation()</code>. Time should grow linearly
+with document size.
+
+Usage: python benchmarks/extract.py [repeats]
+'''
+import sys
+import time
+
+from common import load_zen_core
+
+documents = [
+	('nested abbreviation', 'div>', 'ul>li*3'),
+	('attribute sets', 'a[title="x > y" href=#]>', 'p'),
+	('child operators', 'a>b+c>', 'em'),
+	('minified html', '<div class="a"><p>text</p></div>', 'ul>li*3'),
+	('text with tags', 'x > y <br/> z ', 'a:link'),
+]
+"Name, repeated fragment and abbreviation at the end of document"
+
+sizes = [25000, 50000, 100000]
+
+def make_document(fragment, abbr, size):
+	"""
+	Builds single-line document of about <code>size</code> characters that
+	ends with abbreviation
+	@return: str
+	"""
+	return fragment * (size / len(fragment)) + abbr
+
+def measure(zen_core, text, repeats=3):
+	"""
+	Returns best extraction time, in seconds
+	@return: float
+	"""
+	best = None
+	for i in range(repeats):
+		start = time.time()
+		zen_core.extract_abbreviation(text)
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+
+	return best
+
+def main(args):
+	repeats = args and int(args[0]) or 3
+	zen_core = load_zen_core()
+
+	print '%-22s %8s %10s %12s' % ('document', 'size', 'time, ms', 'extracted')
+	for name, fragment, abbr in documents:
+		for size in sizes:
+			text = make_document(fragment, abbr, size)
+			elapsed = measure(zen_core, text, repeats)
+			print '%-22s %8d %10.2f %12d' % (name, len(text), elapsed * 1000,
+				len(zen_core.extract_abbreviation(text)))
+		print
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
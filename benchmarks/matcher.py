@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tag pair matching benchmark: matches tag pair around caret placed near the
+top, in the middle and near the bottom of generated HTML documents of
+growing size with <code>html_matcher.match()</code>. Document is indexed on the first
+match, time of indexing should grow linearly with document size; matches
+in unchanged document reuse the index and should take about the same time
+at any size.
+
+Usage: python benchmarks/matcher.py [repeats]
+'''
+import sys
+import time
+
+from common import load_module
+
+sizes = [100000, 500000, 1000000, 5000000]
+
+def make_document(size):
+	"""
+	Builds HTML document of about <code>size</code> characters: the body
+	element contains list items with links, comments and unary elements
+	@return: str
+	"""
+	item = '<li class="item"><a href="#">Link</a><br/><!-- item --></li>\n'
+	head = '<html><head><title>Test</title></head><body><ul>\n'
+	tail = '</ul></body></html>'
+	return head + item * ((size - len(head) - len(tail)) / len(item)) + tail
+
+def measure_index(html_matcher, document_index, html, start_ix, repeats=3):
+	"""
+	Returns best time of the first match in document, including indexing,
+	in seconds
+	@return: float
+	"""
+	best = None
+	for i in range(repeats):
+		document_index.clear()
+		start = time.time()
+		html_matcher.match(html, start_ix)
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+
+	return best
+
+def measure(html_matcher, html, start_ix, repeats=3):
+	"""
+	Returns best time of match in already indexed document, in seconds
+	@return: float
+	"""
+	best = None
+	for i in range(repeats):
+		start = time.time()
+		html_matcher.match(html, start_ix)
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+
+	return best
+
+def main(args):
+	repeats = args and int(args[0]) or 3
+	html_matcher = load_module('html_matcher')
+	document_index = load_module('document_index')
+
+	print '%-10s %10s %10s %10s %10s' % ('size', 'index, ms', 'top, ms', 'middle, ms', 'bottom, ms')
+	for size in sizes:
+		html = make_document(size)
+		# caret inside the body element, just after the list start...
+		top = html.find('<ul>') + 4
+		# ...in a list item in the middle of document and near the end
+		middle = html.find('Link', len(html) / 2)
+		bottom = html.rfind('Link')
+
+		print '%-10d %10.2f %10.2f %10.2f %10.2f' % (len(html),
+			measure_index(html_matcher, document_index, html, middle, repeats) * 1000,
+			measure(html_matcher, html, top, repeats) * 1000,
+			measure(html_matcher, html, middle, repeats) * 1000,
+			measure(html_matcher, html, bottom, repeats) * 1000)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Memory benchmark for abbreviation trees.
+
+For each abbreviation reports number of nodes in the primary (parsed) and
+rolled-out trees, object bytes per node and peak RSS of the process that
+built the trees. Each abbreviation is measured in a separate process so peak
+RSS values don't affect each other.
+
+With <code>--virtual</code> option multiplied elements are rolled out as
+repeat nodes.
+
+Usage: python benchmarks/memory.py [--virtual] [abbreviation ...]
+'''
+import os
+import subprocess
+import sys
+
+from common import load_zen_core
+
+abbreviations = [
+	'table>tr*500>td*20',
+	'ul>li*10000>a',
+	'ul>li.item$*5000',
+	'div#page>div.row*200>div.col$*10',
+	'dl>dt*3000+dd*3000',
+]
+
+def _rss_kb():
+	"""
+	Returns peak resident set size of current process in kilobytes
+	@return: int
+	"""
+	import resource
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == 'darwin':
+		rss /= 1024
+	return rss
+
+def _object_size(obj):
+	"""
+	Returns size of node object, including its own containers
+	@return: int
+	"""
+	size = sys.getsizeof(obj)
+	if hasattr(obj, '__dict__'):
+		size += sys.getsizeof(obj.__dict__)
+	size += sys.getsizeof(obj.children)
+	return size
+
+def _walk(node):
+	yield node
+	for child in node.children:
+		for item in _walk(child):
+			yield item
+
+def measure(abbr, virtual=False, syntax='html'):
+	"""
+	Builds primary and rolled-out trees of abbreviation and returns memory
+	usage figures
+	@param virtual: Roll out multiplied elements as repeat nodes
+	@type virtual: bool
+	@return: dict
+	"""
+	zen_core = load_zen_core()
+	rss_before = _rss_kb()
+
+	tree = zen_core.parse_into_tree(abbr, syntax)
+	if not tree:
+		raise ValueError('Invalid abbreviation: %s' % abbr)
+
+	nodes = list(_walk(zen_core.rollout_tree(tree, virtual=virtual)))
+	primary = list(_walk(tree))
+
+	return {
+		'abbr': abbr,
+		'primary_nodes': len(primary),
+		'primary_bytes': sum([_object_size(n) for n in primary]) / len(primary),
+		'nodes': len(nodes),
+		'bytes': sum([_object_size(n) for n in nodes]) / len(nodes),
+		'rss': _rss_kb(),
+		'rss_delta': _rss_kb() - rss_before
+	}
+
+def main(args):
+	virtual = '--virtual' in args
+	if virtual:
+		args = [arg for arg in args if arg != '--virtual']
+		
+	if len(args) > 1 and args[0] == '--child':
+		result = measure(args[1], virtual)
+		print '%(abbr)s\t%(primary_nodes)d\t%(primary_bytes)d\t%(nodes)d\t%(bytes)d\t%(rss)d\t%(rss_delta)d' % result
+		return
+
+	print '%-40s %8s %8s %8s %8s %10s %10s' % ('abbreviation', 'parsed', 'B/node',
+		'nodes', 'B/node', 'peak RSS', 'RSS delta')
+
+	for abbr in args or abbreviations:
+		command = [sys.executable, os.path.abspath(__file__), '--child', abbr]
+		if virtual:
+			command.append('--virtual')
+		output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0]
+		fields = output.strip().split('\t')
+		print '%-40s %8s %8s %8s %8s %8s K %8s K' % tuple(fields)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
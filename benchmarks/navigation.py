@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+HTML navigation benchmark: compares full parse of generated HTML documents
+of growing size with incremental reparse after a one-character edit near
+the top, in the middle and near the bottom of document. Incremental reparse
+parses a few tokens around the edit and moves offsets of the nodes after it,
+so it should stay well below full parse time. Lookup of node under caret
+in parsed document should take about the same time at any size. Parse in
+background is done in steps: the longest step, which blocks the editor, is
+reported too, as well as time to zenify the whole document.
+
+With <code>--memory</code>, reports number of nodes of parsed documents,
+size of node store and growth of peak memory of process while parsing.
+Each document is parsed in its own process.
+
+Usage: python benchmarks/navigation.py [repeats | --memory]
+'''
+import resource
+import subprocess
+import sys
+import time
+
+from common import load_module
+
+sizes = [50000, 200000, 500000, 1000000]
+
+def make_document(size):
+	"""
+	Builds HTML template of about <code>size</code> characters: table rows
+	with attributes, links, comments and template tags
+	@return: str
+	"""
+	row = '<tr class="row"><td id="c1"><a href="/item?id=<?=$id?>">Item</a></td>' \
+		'<td><img src="i.png" alt=\'\'><!-- cell --></td></tr>\n'
+	head = '<html><head><title>Test</title></head><body><table>\n'
+	tail = '</table></body></html>'
+	return head + row * ((size - len(head) - len(tail)) / len(row)) + tail
+
+def measure_full(html_navigation, html, repeats=3):
+	"""
+	Returns best full parse time, in seconds
+	@return: float
+	"""
+	best = None
+	for i in range(repeats):
+		start = time.time()
+		html_navigation.HtmlNavigation(html)
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+
+	return best
+
+def measure_step(html_navigation, html):
+	"""
+	Returns time of the longest step of parse in background, in seconds
+	@return: float
+	"""
+	longest = 0
+	navigation = html_navigation.HtmlNavigation(html, True)
+	done = False
+	while not done:
+		start = time.time()
+		done = navigation.update(html, 0)
+		longest = max(longest, time.time() - start)
+
+	return longest
+
+def measure_edit(navigation, html, offset, repeats=3):
+	"""
+	Returns best time of reparse after inserting a character at offset, in
+	seconds. Inserted character is removed after each measure
+	@return: float
+	"""
+	best = None
+	edited = html[:offset] + 'x' + html[offset:]
+	for i in range(repeats):
+		navigation.edit(offset, 0, 'x')
+		start = time.time()
+		navigation.update(edited)
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+
+		navigation.edit(offset, 1, '')
+		navigation.update(html)
+
+	return best
+
+def measure_lookup(navigation, html, offset, repeats=3):
+	"""
+	Returns best time of jump to the next tag from offset, in seconds
+	@return: float
+	"""
+	best = None
+	for i in range(repeats):
+		start = time.time()
+		navigation.next_tag(offset, offset, html)
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+
+	return best
+
+def measure_memory(size):
+	"""
+	Parses document of about <code>size</code> characters and prints its
+	size, number of nodes, size of node store and growth of peak memory, in
+	kilobytes
+	"""
+	html_navigation = load_module('html_navigation')
+	html = make_document(size)
+	before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	navigation = html_navigation.HtmlNavigation(html)
+	after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	print '%-10d %10d %10d %10d' % (len(html), len(navigation.store),
+		navigation.store.size() / 1024, after - before)
+
+def measure_zenify(navigation, html, repeats=3):
+	"""
+	Returns best time of zenify of the whole document with all attributes
+	and values, in seconds
+	@return: float
+	"""
+	best = None
+	for i in range(repeats):
+		start = time.time()
+		navigation.zenify(0, len(html), html, 3)
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+
+	return best
+
+def main(args):
+	if args and args[0] == '--memory':
+		if len(args) > 1:
+			measure_memory(int(args[1]))
+			return
+
+		print '%-10s %10s %10s %10s' % ('size', 'nodes', 'store, kb', 'peak, kb')
+		for size in sizes:
+			sys.stdout.flush()
+			subprocess.call([sys.executable, __file__, '--memory', str(size)])
+		return
+
+	repeats = args and int(args[0]) or 3
+	html_navigation = load_module('html_navigation')
+
+	print '%-10s %10s %10s %10s %10s %10s %10s %10s' % ('size', 'full, ms', 'step, ms', 'top, ms', 'middle, ms', 'bottom, ms', 'lookup, ms', 'zenify, ms')
+	for size in sizes:
+		html = make_document(size)
+		navigation = html_navigation.HtmlNavigation(html)
+		# edits in text of links
+		top = html.find('Item') + 2
+		middle = html.find('Item', len(html) / 2) + 2
+		bottom = html.rfind('Item') + 2
+
+		print '%-10d %10.2f %10.2f %10.2f %10.2f %10.2f %10.3f %10.2f' % (len(html),
+			measure_full(html_navigation, html, repeats) * 1000,
+			measure_step(html_navigation, html) * 1000,
+			measure_edit(navigation, html, top, repeats) * 1000,
+			measure_edit(navigation, html, middle, repeats) * 1000,
+			measure_edit(navigation, html, bottom, repeats) * 1000,
+			measure_lookup(navigation, html, middle, repeats) * 1000,
+			measure_zenify(navigation, html, repeats) * 1000)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Helpers shared by tests.
+
+Package's <code>__init__</code> is a gedit plugin and requires gedit and gtk
+modules, so tests register a bare <code>zencoding</code> package and import
+Zen Coding modules from it directly.
+
+Usage: python -m unittest discover -s tests
+'''
+import imp
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_module(name):
+	"""
+	Imports module from zencoding package without running plugin code
+	@param name: Module name, like 'zen_core' or 'html_matcher'
+	@type name: str
+	@return: module
+	"""
+	if 'zencoding' not in sys.modules:
+		package = imp.new_module('zencoding')
+		package.__path__ = [os.path.join(root, 'zencoding')]
+		sys.modules['zencoding'] = package
+
+	__import__('zencoding.' + name)
+	return sys.modules['zencoding.' + name]
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests of comment regions of document index and of pair matching around
+comments.
+'''
+import unittest
+
+from common import load_module
+
+document_index = load_module('document_index')
+html_matcher = load_module('html_matcher')
+
+def find_comment(content, pos, start_token='<!--', end_token='-->'):
+	return document_index.DocumentIndex(content).find_comment(pos, start_token, end_token)
+
+class CommentTest(unittest.TestCase):
+
+	def test_regions(self):
+		content = 'a <!-- b <!-- c --> d <!-- e --> f'
+		self.assertEqual(document_index.DocumentIndex(content).get_comments('<!--', '-->'), ([2, 22], [19, 32]))
+		self.assertEqual(find_comment(content, 2), None)
+		self.assertEqual(find_comment(content, 3), (2, 19))
+		self.assertEqual(find_comment(content, 12), (2, 19))
+		self.assertEqual(find_comment(content, 19), (2, 19))
+		self.assertEqual(find_comment(content, 20), None)
+
+	def test_unterminated_comment(self):
+		content = '<p>a</p><!-- b <!-- c'
+		self.assertEqual(find_comment(content, 4), None)
+		self.assertEqual(find_comment(content, 18), (8, len(content)))
+		self.assertEqual(find_comment(content, len(content)), (8, len(content)))
+		self.assertEqual(find_comment('/* a', 3, '/*', '*/'), (0, 4))
+
+	def test_comment_tokens_inside_cdata(self):
+		content = '<![CDATA[ <!-- ]]> a --> <!-- b -->'
+		self.assertEqual(find_comment(content, 12), None)
+		self.assertEqual(find_comment(content, 20), None)
+		self.assertEqual(find_comment(content, 30), (25, 35))
+		self.assertEqual(find_comment('<!-- <![CDATA[ --> a ]]>', 20), None)
+		# CDATA sections only hide markup comments
+		self.assertEqual(find_comment('<![CDATA[ /* a */ ]]>', 13, '/*', '*/'), (10, 17))
+
+	def test_match_around_comments(self):
+		content = '<div><!-- a <!-- b --> c</div>'
+		self.assertEqual(html_matcher.find(content, 18), (5, 22))
+		content = '<div><![CDATA[ <!-- ]]> <p>a</p> --> </div>'
+		self.assertEqual(html_matcher.find(content, 28), (24, 32))
+		self.assertEqual(html_matcher.find(content, 34), (5, 37))
+		self.assertEqual(html_matcher.find('<div>a --> b</div>', 12), (0, 18))
+
+if __name__ == '__main__':
+	unittest.main()
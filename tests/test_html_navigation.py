@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests of incremental update of navigation tree: after edits, updated tree
+must be the same as tree of full parse. Tests of zenify of parsed tags.
+'''
+import random
+import unittest
+
+from common import load_module
+
+html_navigation = load_module('html_navigation')
+load_module('filters')
+zen_core = load_module('zen_core')
+
+pieces = ['<', '>', '/', '!', '-', '[', ']', '?', '"', "'", '=', ' ', '\n', 'a', 'p', 'span', 'script',
+	'<p class="x">', '</p>', '<span>', '</span', '</span >', '<br/>', '<img src="a>b">', '<!--', '-->',
+	'<![CDATA[', ']]>', '<?php ?>', '<script>', '</script>', '<!DOCTYPE html>']
+
+def full_parse(content):
+	return html_navigation.HtmlNavigation(content).tree.show()
+
+class IncrementalUpdateTest(unittest.TestCase):
+
+	def edit(self, navigation, content, offset, removed, inserted):
+		navigation.edit(offset, removed, inserted)
+		content = content[:offset] + inserted + content[offset + removed:]
+		navigation.update(content)
+		self.assertEqual(navigation.tree.show(), full_parse(content))
+		return content
+
+	def test_edit_after_broken_closing_tag(self):
+		# edit turns ']]>' into text that continues '</span<' before it
+		content = '<span></span<]]><'
+		navigation = html_navigation.HtmlNavigation(content)
+		self.edit(navigation, content, 15, 2, '')
+
+	def test_edit_extends_closing_tag(self):
+		content = '<p><span>x</span  <b>'
+		navigation = html_navigation.HtmlNavigation(content)
+		self.edit(navigation, content, 18, 0, '>')
+
+	def test_random_edits(self):
+		rnd = random.Random(1)
+		for i in range(1500):
+			content = ''.join([rnd.choice(pieces) for j in range(rnd.randint(0, 40))])
+			navigation = html_navigation.HtmlNavigation(content)
+			for k in range(rnd.randint(1, 4)):
+				offset = rnd.randint(0, len(content))
+				removed = rnd.randint(0, min(4, len(content) - offset))
+				inserted = ''.join([rnd.choice(pieces) for j in range(rnd.randint(0, 2))])
+				content = self.edit(navigation, content, offset, removed, inserted)
+
+class ZenifyTest(unittest.TestCase):
+
+	def zenify(self, content, mode=0):
+		return html_navigation.HtmlNavigation(content).zenify(0, len(content), content, mode)
+
+	def test_repeated_tags(self):
+		self.assertEqual(self.zenify('<ul><li></li><li></li><li></li></ul>'), '(ul>li*3)')
+
+	def test_repeated_groups(self):
+		self.assertEqual(self.zenify('<div><p></p><span></span><p></p><span></span></div>'), '(div>(p+span)*2)')
+		self.assertEqual(self.zenify('<i></i><p></p><p></p><b></b><p></p><p></p><b></b><p></p>'), 'i+(p*2+b)*2+p')
+		self.assertEqual(self.zenify('<p class="a"></p><p class="b"></p><p class="a"></p><p class="b"></p>', 1), '(p.a+p.b)*2')
+
+	def test_expands_to_source(self):
+		# folded groups must expand back to the same tags, with own children
+		for content in ['<div><p></p><span></span><p></p><span></span></div>',
+				'<ul><li><b></b></li><li><b></b></li><li class="x"></li><li><b></b></li><li><b></b></li><li class="x"></li><em></em></ul>',
+				'<p><i></i><b></b><i></i><b></b></p><p><i></i><b></b><i></i><b></b></p><hr/>']:
+			abbreviation = self.zenify(content, 1)
+			self.assertEqual(zen_core.expand_abbreviation(abbreviation, 'html', 'plain').replace('<hr />', '<hr/>'), content)
+
+	def test_fold(self):
+		self.assertEqual(html_navigation.fold([1, 2, 1, 2, 1]), ((((1, 1), (2, 1)), 2), (1, 1)))
+		self.assertEqual(html_navigation.fold([1, 1, 2, 3]), ((1, 2), (2, 1), (3, 1)))
+
+if __name__ == '__main__':
+	unittest.main()
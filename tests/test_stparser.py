@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests of settings parsing: lookup index and shape of parsed settings.
+'''
+import unittest
+
+from common import load_module
+
+stparser = load_module('stparser')
+
+class IndexTest(unittest.TestCase):
+
+	def test_extends_precedence(self):
+		settings = {
+			'a': {'extends': 'b, c', 'snippets': {'x': 'a'}},
+			'b': {'extends': 'd', 'snippets': {'x': 'b', 'y': 'b'}},
+			'c': {'snippets': {'y': 'c', 'z': 'c'}, 'filters': 'c'},
+			'd': {'snippets': {'w': 'd'}, 'filters': 'd'}
+		}
+		stparser.parse(settings)
+		index = stparser.create_index(settings)
+		# syntax itself, then extended syntaxes in listed order, without
+		# their own extends
+		self.assertEqual(index['a']['snippets'], {'x': 'a', 'y': 'b', 'z': 'c'})
+		self.assertEqual(index['a']['resources']['filters'], 'c')
+		self.assertEqual(index['b']['snippets'], {'x': 'b', 'y': 'b', 'w': 'd'})
+		self.assertEqual(index['b']['resources']['filters'], 'd')
+
+	def test_element_types(self):
+		settings = stparser.get_settings({'html': {'element_types': {'empty': 'br, hr'}}})
+		self.assertEqual(settings['html']['element_types']['empty'], ['br', 'hr'])
+		self.assertEqual(settings.index['html']['elements']['empty'], frozenset(['br', 'hr']))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests of abbreviation expansion: filters, group multipliers, statistics,
+expansion contexts and batch expansion with worker processes.
+'''
+import pickle
+import sys
+import threading
+import unittest
+
+from common import load_module
+
+load_module('filters')
+zen_core = load_module('zen_core')
+
+class FiltersTest(unittest.TestCase):
+
+	def test_filters_at_end(self):
+		self.assertEqual(zen_core.parse_abbreviation('p|e|c').filters, 'e|c')
+		self.assertRaises(zen_core.InvalidAbbreviation, zen_core.parse_abbreviation, 'p|e\n')
+
+	def test_unknown_filters(self):
+		# modules of filters package that aren't filters are unknown names
+		expanded = zen_core.expand_abbreviation('div', 'html', 'xhtml')
+		for name in ['format', 'comment', 'escape', 'nonexist']:
+			self.assertEqual(zen_core.expand_abbreviation('div|' + name, 'html', 'xhtml'), expanded)
+		self.assertNotEqual(zen_core.expand_abbreviation('div|e', 'html', 'xhtml'), expanded)
+
+class GroupTest(unittest.TestCase):
+
+	def expand(self, abbr):
+		return zen_core.expand_abbreviation(abbr, 'html', 'plain')
+
+	def test_group_multiplier(self):
+		self.assertEqual(self.expand('div>(p+span)*2'), '<div><p></p><span></span><p></p><span></span></div>')
+		self.assertEqual(self.expand('(div>(p*2+b)*2+i)'), '<div><p></p><p></p><b></b><p></p><p></p><b></b><i></i></div>')
+		self.assertEqual(self.expand('(em>b)*2+i'), '<em><b></b></em><em><b></b></em><i></i>')
+
+	def test_group_copies(self):
+		self.assertEqual(self.expand('(li.i$)*3'), '<li class="i1"></li><li class="i2"></li><li class="i3"></li>')
+		self.assertEqual(self.expand('ul>(li.i$>a.a$)*2'), '<ul><li class="i1"><a href="" class="a1"></a></li><li class="i2"><a href="" class="a1"></a></li></ul>')
+		self.assertEqual(self.expand('(li.a$+li.b$*2)*2'), '<li class="a1"></li><li class="b1"></li><li class="b2"></li><li class="a3"></li><li class="b3"></li><li class="b4"></li>')
+		self.assertEqual(self.expand('((b.i$)*2)*2'), '<b class="i1"></b><b class="i2"></b><b class="i3"></b><b class="i4"></b>')
+		# operator after group is skipped, as after group without multiplier
+		self.assertEqual(self.expand('(b.i$)*2>i'), '<b class="i1"></b><b class="i2"></b><i></i>')
+		tree = zen_core.parse_abbreviation('(p>b)*2')
+		self.assertTrue(tree.children[0] is not tree.children[1])
+		self.assertTrue(tree.children[0].children[0] is not tree.children[1].children[0])
+
+class StatsTest(unittest.TestCase):
+
+	def test_collect_stats(self):
+		zen_core.reset_stats()
+		with zen_core.collect_stats():
+			self.assertTrue(zen_core.stats_enabled)
+			zen_core.expand_abbreviation('ul>li.stats*3', 'html', 'xhtml')
+		self.assertFalse(zen_core.stats_enabled)
+		self.assertEqual(zen_core.get_stats()['rollout']['calls'], 1)
+		zen_core.reset_stats()
+
+	def test_threads(self):
+		zen_core.reset_stats()
+		def record():
+			for i in range(20000):
+				zen_core._record_stats('test', 0.0, 1)
+		threads = [threading.Thread(target=record) for i in range(4)]
+		# switch threads often, so updates of statistics interleave
+		interval = sys.getcheckinterval()
+		sys.setcheckinterval(1)
+		try:
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+		finally:
+			sys.setcheckinterval(interval)
+		self.assertEqual(zen_core.get_stats()['test'], {'time': 0.0, 'calls': 80000, 'nodes': 80000})
+		zen_core.reset_stats()
+
+class ContextTest(unittest.TestCase):
+
+	def test_settings_not_changed(self):
+		settings = zen_core.stparser.get_settings()
+		settings.pop('variables', None)
+		context = zen_core.ExpansionContext(settings)
+		context.variables['a'] = 'b'
+		self.assertFalse('variables' in settings)
+
+	def test_thread_default_context(self):
+		result = []
+		def run():
+			result.append((zen_core.get_variable('lang'), zen_core.get_variable('test')))
+			zen_core.set_variable('test', 'thread')
+			zen_core.set_caret_placeholder('|')
+		
+		caret = zen_core.get_caret_placeholder()
+		zen_core.set_variable('test', 'main')
+		try:
+			thread = threading.Thread(target=run)
+			thread.start()
+			thread.join()
+			self.assertEqual(result, [('en', None)])
+			self.assertEqual(zen_core.get_variable('test'), 'main')
+			self.assertEqual(zen_core.get_caret_placeholder(), caret)
+			self.assertNotEqual(caret, '|')
+		finally:
+			del zen_core.get_context().variables['test']
+
+class ExpandManyTest(unittest.TestCase):
+
+	def test_errors_are_picklable(self):
+		error = pickle.loads(pickle.dumps(zen_core.InvalidAbbreviation('Unexpected closing parenthesis', 3)))
+		self.assertTrue(isinstance(error, zen_core.InvalidAbbreviation))
+		self.assertEqual(error.value, 'Unexpected closing parenthesis')
+		self.assertEqual(error.pos, 3)
+		error = pickle.loads(pickle.dumps(zen_core.ZenError("Can't save file")))
+		self.assertEqual(error.value, "Can't save file")
+
+	def test_pool_with_invalid_abbreviation(self):
+		abbreviations = ['p.x%d' % i for i in range(300)] + ['div)']
+		results = zen_core.expand_many(abbreviations, 'html', 'xhtml', processes=2, chunk_size=100)
+		self.assertEqual(results[:-1], zen_core.expand_many(abbreviations[:-1], 'html', 'xhtml'))
+		output, error = results[-1]
+		self.assertEqual(output, '')
+		self.assertTrue(isinstance(error, zen_core.InvalidAbbreviation))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -116,6 +116,7 @@ class ZenCodingWindowHelper():
 	def deactivate(self):
 
 		# zen coding
+		self.editor.close()
 		self.editor = None
 
 		# menu items
@@ -149,7 +150,7 @@ class ZenCodingWindowHelper():
 				md.run()
 				md.destroy()
 			else:
-				globals()['zen_core'].zen_settings = globals()['stparser'].get_settings(my_zen_settings.my_zen_settings)
+				globals()['zen_core'].update_settings(globals()['stparser'].get_settings(my_zen_settings.my_zen_settings))
 			self.modified = modified
 
 		# the content changed
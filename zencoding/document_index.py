@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Indexes of document shared by actions: tag index for pair matching,
+navigation tree and comment regions are made on first use and
+reused while the document is unchanged, so actions don't scan the whole
+document on every call.
+
+Tag index and navigation tree are still two parses of document: navigation
+tree is parsed in slices and updated in place on edits, tag index keeps
+tag grammar of pair matcher. Only comment regions are shared by both.
+'''
+from bisect import bisect_left
+
+import html_matcher
+from html_navigation import HtmlNavigation
+
+opaque_sections = {
+	'<!--': [('<![CDATA[', ']]>')]
+}
+"Sections where comment start token doesn't start comment, by comment start token"
+
+class DocumentIndex():
+	"""
+	Indexes of one version of document, each made on first use
+	"""
+
+	def __init__(self, content, navigation=None):
+		"""
+		@param content: Document text
+		@type content: str
+		@param navigation: Navigation tree of the previous version of document:
+		it's updated instead of being made again
+		@type navigation: HtmlNavigation
+		"""
+		self.content = content
+		self.navigation = navigation
+		self.tag_indexes = {}
+		self.comments = {}
+
+	def get_tag_index(self, mode='xhtml'):
+		"""
+		Returns tag index of document for pair matching
+		@type mode: str
+		@return: TagIndex
+		"""
+		if mode != 'html': mode = 'xhtml'
+		index = self.tag_indexes.get(mode)
+		if index is None:
+			index = self.tag_indexes[mode] = html_matcher.TagIndex(self.content, mode)
+
+		return index
+
+	def get_navigation(self):
+		"""
+		Returns navigation tree of document. Document is parsed on the first
+		lookup in tree, or before by <code>update()</code> calls of the tree
+		@return: HtmlNavigation
+		"""
+		if self.navigation is None:
+			self.navigation = HtmlNavigation(self.content, True)
+
+		return self.navigation
+
+	def get_comments(self, start_token, end_token):
+		"""
+		Returns sorted start and end offsets of comments. Comments are found
+		in document order: tokens inside comments and opaque sections (see
+		<code>opaque_sections</code>) don't start comments, unterminated comment
+		ends at the end of document
+		@type start_token: str
+		@type end_token: str
+		@return: tuple of lists
+		"""
+		comments = self.comments.get((start_token, end_token))
+		if comments is None:
+			comments = self.comments[(start_token, end_token)] = self._find_regions(start_token, end_token)
+
+		return comments
+
+	def _find_regions(self, start_token, end_token):
+		content = self.content
+		sections = [(start_token, end_token)] + opaque_sections.get(start_token, [])
+		next_starts = [content.find(opener) for opener, closer in sections]
+		starts = []
+		ends = []
+
+		while True:
+			found = [(pos, k) for k, pos in enumerate(next_starts) if pos != -1]
+			if not found:
+				break
+
+			start, k = min(found)
+			opener, closer = sections[k]
+			end = content.find(closer, start + len(opener))
+			if end == -1:
+				end = len(content)
+			else:
+				end += len(closer)
+
+			if not k:
+				starts.append(start)
+				ends.append(end)
+
+			for k, pos in enumerate(next_starts):
+				if pos != -1 and pos < end:
+					next_starts[k] = content.find(sections[k][0], end)
+
+		return starts, ends
+
+	def find_comment(self, pos, start_token, end_token):
+		"""
+		Returns bounds of comment that contains <code>pos</code>: pos is
+		after comment start and not after comment end
+		@type pos: int
+		@type start_token: str
+		@type end_token: str
+		@return: None if comment wasn't found, tuple otherwise
+		"""
+		starts, ends = self.get_comments(start_token, end_token)
+		ix = bisect_left(starts, pos) - 1
+		if ix < 0 or ends[ix] < pos:
+			return None
+
+		return starts[ix], ends[ix]
+
+_document = None
+"Index of the last used document"
+
+def get_document(content):
+	"""
+	Returns index of <code>content</code>. Index is made once per document
+	version: it is reused while the same document is requested
+	@type content: str
+	@return: DocumentIndex
+	"""
+	global _document
+	if _document is None or (_document.content is not content and _document.content != content):
+		_document = DocumentIndex(content)
+
+	return _document
+
+def set_document(document):
+	"""
+	Makes <code>document</code> the index returned for its content, e.g.
+	index of editor's buffer that carries its navigation tree
+	@type document: DocumentIndex
+	"""
+	global _document
+	_document = document
+
+def clear():
+	"""Drops index of the last used document"""
+	global _document
+	_document = None
@@ -1,23 +1,69 @@
-import os.path
+'''
+Output filters registry. Filter modules are imported lazily, when filter
+chain references them for the first time
+'''
 import sys
 
-# import all filters
-__sub_modules = []
-__prefix = 'zencoding.filters'
-__filter_dir = os.path.dirname(__file__)
-sys.path.append(__filter_dir)
-
-filter_map = {}
-for file in os.listdir(__filter_dir):
-	name, ext = os.path.splitext(file)
-	if ext.lower() == '.py':
-		__sub_modules.append(name)
-		
-__filters = __import__(__prefix, globals(), locals(), __sub_modules)
-for key in dir(__filters):
-	__module = getattr(__filters, key)
-	if hasattr(__module, '__name__') and __module.__name__.startswith(__prefix + '.') and hasattr(__module, 'process'):
-		if hasattr(__module, 'alias'):
-			filter_map[__module.alias] = __module.process
-		else:
-			filter_map[__module.__name__[len(__prefix) + 1:]] = __module.process
+manifest = {
+	'_format': 'format',
+	'c': 'comment',
+	'e': 'escape',
+	'fc': 'format-css',
+	'haml': 'haml',
+	'html': 'html',
+	'xsl': 'xsl'
+}
+"Module name for each filter name. Names without dots are relative to this package"
+
+filter_modules = {}
+"Imported module for each filter name, None for unknown filters"
+
+def _import(module_name):
+	"""
+	Imports filter module
+	@param module_name: Absolute module name or name relative to this package
+	@type module_name: str
+	@return: module
+	"""
+	if '.' not in module_name:
+		module_name = __name__ + '.' + module_name
+
+	__import__(module_name)
+	return sys.modules[module_name]
+
+def get_filter(name):
+	"""
+	Returns filter module by its name, importing module on first access.
+	Only filters of manifest and registered filters exist
+	@param name: Filter name or alias, like 'html' or 'c'
+	@type name: str
+	@return: module, None if filter doesn't exist
+	"""
+	try:
+		return filter_modules[name]
+	except KeyError:
+		pass
+
+	module = None
+	if name in manifest:
+		module = _import(manifest[name])
+		if not hasattr(module, 'process'):
+			module = None
+
+	filter_modules[name] = module
+	return module
+
+def register_filter(name, module):
+	"""
+	Registers filter, replacing existing filter with the same name
+	@param name: Filter name, used in filter chains
+	@type name: str
+	@param module: Filter module (or any object with filter functions) or
+	its import name, which will be imported on first use
+	@type module: module, str
+	"""
+	if isinstance(module, basestring):
+		manifest[name] = module
+		filter_modules.pop(name, None)
+	else:
+		filter_modules[name] = module
@@ -35,13 +35,15 @@ def add_comments(node, i):
 		node.start = zen_coding.replace_counter(node.start, i + 1)
 		node.end = zen_coding.replace_counter(node.end, i + 1)
 
+def begin(tree, profile):
+	"""
+	@return: False if comments shouldn't be added with current profile
+	"""
+	return profile['tag_nl'] is not False
+
+def enter(item, profile, level, index, enabled):
+	if enabled and item.is_block():
+		add_comments(item, index)
+
 def process(tree, profile):
-	if profile['tag_nl'] is False:
-		return tree
-		
-	for i, item in enumerate(tree.children):
-		if item.is_block():
-			add_comments(item, i)
-		process(item, profile)
-	
-	return tree
\ No newline at end of file
+	return zen_coding.run_filters(tree, profile, alias)
\ No newline at end of file
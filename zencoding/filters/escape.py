@@ -7,10 +7,14 @@ Filter for escaping unsafe XML characters: <, >, &
 @link http://chikuyonok.ru
 '''
 import re
+from zencoding import zen_core as zen_coding
 
 alias = 'e'
 "Filter name alias (if not defined, ZC will use module name)"
 
+supports_repeat = True
+"Filter can process repeat nodes (see ZenNode.repeat)"
+
 char_map = {
 	'<': '&lt;',
 	'>': '&gt;',
@@ -22,11 +26,9 @@ re_chars = re.compile(r'[<>&]')
 def escape_chars(text):
 	return re_chars.sub(lambda m: char_map[m.group(0)], text)
 
+def enter(item, profile, level, index, state):
+	item.start = escape_chars(item.start)
+	item.end = escape_chars(item.end)
+
 def process(tree, profile=None):
-	for item in tree.children:
-		item.start = escape_chars(item.start)
-		item.end = escape_chars(item.end)
-		
-		process(item)
-	
-	return tree
\ No newline at end of file
+	return zen_coding.run_filters(tree, profile, alias)
\ No newline at end of file
@@ -8,18 +8,20 @@ padding:0; -> padding: 0;
 @link http://chikuyonok.ru
 '''
 import re
+from zencoding import zen_core as zen_coding
 
 alias = 'fc'
 "Filter name alias (if not defined, ZC will use module name)"
 
+supports_repeat = True
+"Filter can process repeat nodes (see ZenNode.repeat)"
+
 re_css_prop = re.compile(r'([\w\-]+\s*:)\s*')
 
+def enter(item, profile, level, index, state):
+	# CSS properties are always snippets 
+	if item.type == 'snippet':
+		item.start = re_css_prop.sub(r'\1 ', item.start)
+
 def process(tree, profile):
-	for item in tree.children:
-		# CSS properties are always snippets 
-		if item.type == 'snippet':
-			item.start = re_css_prop.sub(r'\1 ', item.start)
-		
-		process(item, profile)
-		
-	return tree
\ No newline at end of file
+	return zen_coding.run_filters(tree, profile, alias)
\ No newline at end of file
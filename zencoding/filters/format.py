@@ -16,6 +16,9 @@ from zencoding import zen_core as zen_coding
 alias = '_format'
 "Filter name alias (if not defined, ZC will use module name)"
 
+supports_repeat = True
+"Filter can process repeat nodes (see ZenNode.repeat)"
+
 child_token = '${child}'
 placeholder = '%s'
 
@@ -59,11 +62,11 @@ def should_break_line(node, profile):
 		return False
 		
 	# calculate how many inline siblings we have
-	node_count = 1
+	node_count = node.repeat
 	node = node.next_sibling
 	while node:
 		if node.is_inline():
-			node_count += 1
+			node_count += node.repeat
 		else:
 			break
 		node = node.next_sibling
@@ -159,24 +162,31 @@ def process_tag(item, profile, level=0):
 	
 	return item
 
-def process(tree, profile, level=0):
+def enter(item, profile, level, index, state):
 	"""
-	Processes simplified tree, making it suitable for output as HTML structure
+	Processes tree node
 	@type item: ZenNode
 	@type profile: dict
 	@param level: Depth level
 	@type level: int
+	@param index: Index of node in parent's children list
+	@type index: int
 	"""
+	if item.type == 'tag':
+		item = process_tag(item, profile, level)
+	else:
+		item = process_snippet(item, profile, level)
 	
-	for item in tree.children:
-		if item.type == 'tag':
-			item = process_tag(item, profile, level)
-		else:
-			item = process_snippet(item, profile, level)
+	if item.content:
+		item.content = zen_coding.pad_string(item.content, item.padding)
 		
-		if item.content:
-			item.content = zen_coding.pad_string(item.content, item.padding)
-			
-		process(item, profile, level + 1)
-	
-	return tree
\ No newline at end of file
+	if item.lines:
+		item.lines = [zen_coding.pad_string(line, item.padding) for line in item.lines]
+
+def process(tree, profile):
+	"""
+	Processes simplified tree, making it suitable for output as HTML structure
+	@type tree: ZenNode
+	@type profile: dict
+	"""
+	return zen_coding.run_filters(tree, profile, alias)
\ No newline at end of file
@@ -9,6 +9,12 @@ Filter that produces HAML tree
 from zencoding import zen_core as zen_coding
 
 child_token = '${child}'
+
+supports_repeat = True
+"Filter can process repeat nodes (see ZenNode.repeat)"
+
+depends = ('_format',)
+"Filters that must be applied before this one"
 	
 def make_attributes_string(tag, profile):
 	"""
@@ -118,26 +124,50 @@ def process_tag(item, profile, level=0):
 	
 	return item
 
-def process(tree, profile, level=0):
+def begin(tree, profile):
 	"""
-	Processes simplified tree, making it suitable for output as HTML structure
+	Prepares tree for processing
 	@type tree: ZenNode
 	@type profile: dict
-	@type level: int
+	@return: True if counters are left for output stage
 	"""
-	if level == 0:
-		# preformat tree
-		tree = zen_coding.run_filters(tree, profile, '_format')
-		
-	for i, item in enumerate(tree.children):
-		if item.type == 'tag':
-			process_tag(item, profile, level)
-		else:
-			process_snippet(item, profile, level)
+	if tree.deferred:
+		# operations were deferred by another output filter, which
+		# can't be mixed with ours
+		zen_coding.materialize_tree(tree)
+	
+	if tree.deferred is not None:
+		# tree has repeat nodes, counters are different for each copy
+		tree.deferred.append('counters')
+		return True
 	
+	return False
+
+def enter(item, profile, level, index, deferred):
+	"""
+	Processes tree node
+	@type item: ZenNode
+	@type profile: dict
+	@type level: int
+	@param index: Index of node in parent's children list
+	@type index: int
+	@param deferred: Leave counters for output stage
+	@type deferred: bool
+	"""
+	if item.type == 'tag':
+		process_tag(item, profile, level)
+	else:
+		process_snippet(item, profile, level)
+
+	if not deferred:
 		# replace counters
-		item.start = zen_coding.unescape_text(zen_coding.replace_counter(item.start, item.counter))
-		item.end = zen_coding.unescape_text(zen_coding.replace_counter(item.end, item.counter))
-		process(item, profile, level + 1)
-		
-	return tree
\ No newline at end of file
+		item.start = zen_coding.render_counter(item.start, item.counter)
+		item.end = zen_coding.render_counter(item.end, item.counter)
+
+def process(tree, profile):
+	"""
+	Processes simplified tree, making it suitable for output as HAML structure
+	@type tree: ZenNode
+	@type profile: dict
+	"""
+	return zen_coding.run_filters(tree, profile, 'haml')
\ No newline at end of file
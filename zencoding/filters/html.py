@@ -10,6 +10,12 @@ from zencoding import zen_core as zen_coding
 
 child_token = '${child}'
 
+supports_repeat = True
+"Filter can process repeat nodes (see ZenNode.repeat)"
+
+depends = ('_format',)
+"Filters that must be applied before this one"
+
 def make_attributes_string(tag, profile):
 	"""
 	Creates HTML attributes string from tag according to profile settings
@@ -110,29 +116,54 @@ def process_tag(item, profile, level):
 	
 	return item
 
-def process(tree, profile, level=0):
+def begin(tree, profile):
 	"""
-	Processes simplified tree, making it suitable for output as HTML structure
+	Prepares tree for processing
 	@type tree: ZenNode
 	@type profile: dict
-	@type level: int
+	@return: True if counters and tabstops are left for output stage
 	"""
-	if level == 0:
-		# preformat tree
-		tree = zen_coding.run_filters(tree, profile, '_format')
-		zen_coding.max_tabstop = 0
-		
-	for item in tree.children:
-		if item.type == 'tag':
-			process_tag(item, profile, level)
-		else:
-			process_snippet(item, profile, level)
+	zen_coding.get_context().max_tabstop = 0
+	
+	if tree.deferred:
+		# operations were deferred by another output filter, which
+		# can't be mixed with ours
+		zen_coding.materialize_tree(tree)
 	
+	if tree.deferred is not None:
+		# tree has repeat nodes, counters and tabstops are different 
+		# for each copy
+		tree.deferred.extend(('counters', 'tabstops'))
+		return True
+	
+	return False
+
+def enter(item, profile, level, index, deferred):
+	"""
+	Processes tree node
+	@type item: ZenNode
+	@type profile: dict
+	@type level: int
+	@param index: Index of node in parent's children list
+	@type index: int
+	@param deferred: Leave counters and tabstops for output stage
+	@type deferred: bool
+	"""
+	if item.type == 'tag':
+		process_tag(item, profile, level)
+	else:
+		process_snippet(item, profile, level)
+
+	if not deferred:
 		# replace counters
-		item.start = zen_coding.unescape_text(zen_coding.replace_counter(item.start, item.counter))
-		item.end = zen_coding.unescape_text(zen_coding.replace_counter(item.end, item.counter))
+		item.start = zen_coding.render_counter(item.start, item.counter)
+		item.end = zen_coding.render_counter(item.end, item.counter)
 		zen_coding.upgrade_tabstops(item)
-		
-		process(item, profile, level + 1)
-		
-	return tree
+
+def process(tree, profile):
+	"""
+	Processes simplified tree, making it suitable for output as HTML structure
+	@type tree: ZenNode
+	@type profile: dict
+	"""
+	return zen_coding.run_filters(tree, profile, 'html')
@@ -8,6 +8,10 @@ child elements
 @link http://chikuyonok.ru
 '''
 import re
+from zencoding import zen_core as zen_coding
+
+supports_repeat = True
+"Filter can process repeat nodes (see ZenNode.repeat)"
 
 tags = {
 	'xsl:variable': 1,
@@ -23,9 +27,9 @@ def trim_attribute(node):
 	"""
 	node.start = re_attr.sub('', node.start)
 
+def enter(item, profile, level, index, state):
+	if item.type == 'tag' and item.name.lower() in tags and item.children:
+		trim_attribute(item)
+
 def process(tree, profile):
-	for item in tree.children:
-		if item.type == 'tag' and item.name.lower() in tags and item.children:
-			trim_attribute(item)
-		
-		process(item, profile)
\ No newline at end of file
+	return zen_coding.run_filters(tree, profile, 'xsl')
\ No newline at end of file
@@ -13,11 +13,18 @@ dictionary for later use.
 @author: Sergey Chikuyonok (serge.che@gmail.com)
 '''
 import re
+from array import array
+from bisect import bisect_left
+
+import document_index
 
 start_tag = r'<([\w\:\-]+)((?:\s+[\w\-:]+(?:\s*=\s*(?:(?:"[^"]*")|(?:\'[^\']*\')|[^>\s]+))?)*)\s*(\/?)>'
 end_tag = r'<\/([\w\:\-]+)[^>]*>'
 attr = r'([\w\-:]+)(?:\s*=\s*(?:(?:"((?:\\.|[^"])*)")|(?:\'((?:\\.|[^\'])*)\')|([^>\s]+)))?'
 
+re_start_tag = re.compile(start_tag)
+re_end_tag = re.compile(end_tag)
+
 "Last matched HTML pair"
 last_match = {
 	'opening_tag': None, # Tag() or Comment() object
@@ -158,6 +165,303 @@ def get_tags(html, start_ix, mode='xhtml'):
 	return _find_pair(html, start_ix, mode, lambda op, cl=None, ix=0: (op, cl) if op and op.type == 'tag' else None)
 
 
+# Token kinds of tag index
+TOKEN_START = 0
+TOKEN_UNARY = 1
+TOKEN_END = 2
+TOKEN_COMMENT_START = 3
+TOKEN_COMMENT_END = 4
+
+class TagIndex():
+	"""
+	Offset-sorted tokens of tags and comment boundaries of document, with
+	precomputed results of stack matching: for every token, the tag pair
+	search started from it is already resolved, so pair around caret is
+	found by binary search.
+	
+	Tokens are visited in the same order <code>_find_pair</code> scanner
+	always used: backward search jumps from comment end to token before
+	comment start, forward search jumps from comment start to token after
+	comment end. Comment boundaries are those of comments in the comment
+	index of document, other comment tokens are text.
+	"""
+	def __init__(self, html, mode='xhtml'):
+		"""
+		@param html: Document to index
+		@type html: str
+		@param mode: Matching mode
+		@type mode: str
+		"""
+		self.html = html
+		self.mode = mode
+		
+		# token offsets, tag (comment) ends, kinds and lower-cased tag names
+		self.starts = array('l')
+		self.ends = array('l')
+		self.kinds = array('b')
+		self.names = []
+		
+		# index of token visited next by backward and by forward search
+		self.back = array('l')
+		self.forth = array('l')
+		
+		# maximum end of tokens up to this one: tokens that can't contain 
+		# caret are resolved with precomputed results
+		self.reach = array('l')
+		
+		# for closing tag: opening tag matched in backward search, for 
+		# opening tag: closing tag matched in forward search. If search fails,
+		# the result is stored as (-2 - result token) or -1 if document 
+		# bounds were reached
+		self.pairs = array('l')
+		
+		# results of backward and forward searches started at token with 
+		# empty stack: unclosed opening tag and closing tag (or comment end)
+		self.opening = array('l')
+		self.closing = array('l')
+		
+		self._tokenize()
+		self._match_backward()
+		self._match_forward()
+	
+	def _add(self, start, end, kind, name=None):
+		self.starts.append(start)
+		self.ends.append(end)
+		self.kinds.append(kind)
+		self.names.append(name)
+	
+	def _tokenize(self):
+		html = self.html
+		is_html = self.mode == 'html'
+		next_lt = html.find('<')
+		next_comment_end = html.find('-->')
+		comment_starts, comment_ends = document_index.get_document(html).get_comments('<!--', '-->')
+		
+		while next_lt != -1 or next_comment_end != -1:
+			if next_comment_end == -1 or (next_lt != -1 and next_lt < next_comment_end):
+				ix = next_lt
+				next_lt = html.find('<', ix + 1)
+				
+				m = re_end_tag.match(html, ix)
+				if m:
+					self._add(ix, m.end(), TOKEN_END, m.group(1).lower())
+					continue
+				
+				m = re_start_tag.match(html, ix)
+				if m:
+					name = m.group(1).lower()
+					unary = bool(m.group(3)) or (is_html and name in empty)
+					self._add(ix, m.end(), unary and TOKEN_UNARY or TOKEN_START, name)
+				elif html.startswith('<!--', ix):
+					# only comments of comment index: tokens inside comments
+					# and CDATA sections are text
+					comment = bisect_left(comment_starts, ix)
+					if comment < len(comment_starts) and comment_starts[comment] == ix:
+						self._add(ix, comment_ends[comment], TOKEN_COMMENT_START)
+			else:
+				ix = next_comment_end
+				next_comment_end = html.find('-->', ix + 1)
+				comment = bisect_left(comment_ends, ix + 3)
+				if comment < len(comment_ends) and comment_ends[comment] == ix + 3 and comment_starts[comment] + 4 <= ix:
+					self._add(ix, ix + 3, TOKEN_COMMENT_END)
+		
+		reach = -1
+		for k, start in enumerate(self.starts):
+			kind = self.kinds[k]
+			if kind == TOKEN_COMMENT_END:
+				self.back.append(bisect_left(self.starts, find_comment_start(html, start)) - 1)
+			else:
+				self.back.append(k - 1)
+				reach = max(reach, self.ends[k])
+			
+			if kind == TOKEN_COMMENT_START:
+				self.forth.append(bisect_left(self.starts, self.ends[k]))
+			else:
+				self.forth.append(k + 1)
+			
+			self.reach.append(reach)
+		
+		self.pairs.extend([-1] * len(self.starts))
+	
+	def _match_backward(self):
+		kinds, names, back, pairs = self.kinds, self.names, self.back, self.pairs
+		opening = self.opening
+		
+		for k in xrange(len(kinds)):
+			kind = kinds[k]
+			if kind == TOKEN_START:
+				opening.append(k)
+			elif kind == TOKEN_END:
+				# search for opening tag of this closing tag, skipping 
+				# already matched pairs
+				result = -1
+				ix = back[k]
+				while ix >= 0:
+					if kinds[ix] == TOKEN_END:
+						if pairs[ix] < 0:
+							result = pairs[ix]
+							break
+						ix = back[pairs[ix]]
+					elif kinds[ix] == TOKEN_START:
+						result = ix if names[ix] == names[k] else -2 - ix
+						break
+					else:
+						ix = back[ix]
+				
+				pairs[k] = result
+				if result >= 0:
+					opening.append(opening[back[result]] if back[result] >= 0 else -1)
+				else:
+					opening.append(-2 - result if result != -1 else -1)
+			else:
+				opening.append(opening[back[k]] if back[k] >= 0 else -1)
+	
+	def _match_forward(self):
+		kinds, names, forth, pairs = self.kinds, self.names, self.forth, self.pairs
+		count = len(kinds)
+		closing = [-1] * count
+		
+		for k in xrange(count - 1, -1, -1):
+			kind = kinds[k]
+			if kind == TOKEN_END or kind == TOKEN_COMMENT_END:
+				closing[k] = k
+			elif kind == TOKEN_START:
+				# search for closing tag of this opening tag, skipping 
+				# already matched pairs
+				result = -1
+				ix = forth[k]
+				while ix < count:
+					if kinds[ix] == TOKEN_START:
+						if pairs[ix] < 0:
+							result = pairs[ix]
+							break
+						ix = forth[pairs[ix]]
+					elif kinds[ix] == TOKEN_END:
+						result = ix if names[ix] == names[k] else -2 - ix
+						break
+					elif kinds[ix] == TOKEN_COMMENT_END:
+						result = -2 - ix
+						break
+					else:
+						ix = forth[ix]
+				
+				pairs[k] = result
+				if result >= 0:
+					closing[k] = closing[forth[result]] if forth[result] < count else -1
+				else:
+					closing[k] = -2 - result if result != -1 else -1
+			elif forth[k] < count:
+				closing[k] = closing[forth[k]]
+		
+		self.closing.extend(closing)
+	
+	def tag(self, k):
+		"""
+		Creates tag object for token
+		@type k: int
+		@return: Tag
+		"""
+		start = self.starts[k]
+		if self.kinds[k] == TOKEN_END:
+			return Tag(re_end_tag.match(self.html, start), start)
+		return Tag(re_start_tag.match(self.html, start), start)
+	
+	def find_pair(self, start_ix, action=make_range):
+		"""
+		Search for tag pair around <code>start_ix</code> position
+		@type start_ix: int
+		@param action: Function that creates selection range
+		@type action: function
+		"""
+		kinds, names, back = self.kinds, self.names, self.back
+		starts, ends = self.starts, self.ends
+		
+		# find opening tag
+		opening = closing = -1
+		stack = []
+		k = bisect_left(starts, start_ix) - 1
+		
+		# tokens that may contain caret are checked one by one
+		while k >= 0 and self.reach[k] >= start_ix:
+			kind = kinds[k]
+			if kind == TOKEN_END:
+				if ends[k] > start_ix: # direct hit on searched closing tag
+					closing = k
+				else:
+					stack.append(names[k])
+			elif kind == TOKEN_UNARY:
+				if ends[k] > start_ix: # exact match
+					return action(self.tag(k), None, start_ix)
+			elif kind == TOKEN_START:
+				if stack and stack[-1] == names[k]:
+					stack.pop()
+				else:
+					opening = k
+					break
+			elif kind == TOKEN_COMMENT_START:
+				if ends[k] >= start_ix:
+					return action(Comment(starts[k], ends[k]))
+			
+			k = back[k]
+		
+		while opening == -1 and k >= 0:
+			if not stack:
+				opening = self.opening[k]
+				break
+			
+			kind = kinds[k]
+			if kind == TOKEN_END:
+				if self.pairs[k] < 0:
+					opening = -2 - self.pairs[k] if self.pairs[k] != -1 else -1
+					break
+				k = back[self.pairs[k]]
+				continue
+			elif kind == TOKEN_START:
+				if stack[-1] != names[k]:
+					opening = k
+					break
+				stack.pop()
+			
+			k = back[k]
+		
+		if opening == -1:
+			return action(None)
+		
+		# find closing tag
+		if closing == -1:
+			k = bisect_left(starts, start_ix)
+			if k < len(starts):
+				closing = self.closing[k]
+			if closing != -1 and kinds[closing] == TOKEN_COMMENT_END:
+				# looks like cursor was inside comment with invalid HTML
+				return action(Comment(find_comment_start(self.html, starts[closing]), ends[closing]))
+		
+		return action(self.tag(opening), self.tag(closing) if closing != -1 else None, start_ix)
+
+def get_index(html, mode='xhtml'):
+	"""
+	Returns tag index of <code>html</code>. Index is built once per document
+	version: it is reused while the same document is matched
+	@type html: str
+	@type mode: str
+	@return: TagIndex
+	"""
+	return document_index.get_document(html).get_tag_index(mode)
+
+def find_comment_start(html, start_pos):
+	"""
+	Returns start of comment that contains <code>start_pos</code>, looked up
+	in comment index of document, or <code>start_pos</code> itself if it
+	isn't inside comment
+	@type html: str
+	@type start_pos: int
+	@return: int
+	"""
+	comment = document_index.get_document(html).find_comment(start_pos, '<!--', '-->')
+	if comment:
+		return comment[0]
+	return start_pos
+
 def _find_pair(html, start_ix, mode='xhtml', action=make_range):
 	"""
 	Search for matching tags in <code>html</code>, starting from
@@ -175,99 +479,5 @@ def _find_pair(html, start_ix, mode='xhtml', action=make_range):
 	
 	@return: list
 	"""
-
-	forward_stack = []
-	backward_stack = []
-	opening_tag = None
-	closing_tag = None
-	html_len = len(html)
-	
 	set_mode(mode)
-
-	def has_match(substr, start=None):
-		if start is None:
-			start = ix
-
-		return html.find(substr, start) == start
-
-
-	def find_comment_start(start_pos):
-		while start_pos:
-			if html[start_pos] == '<' and has_match('<!--', start_pos):
-				break
-
-			start_pos -= 1
-
-		return start_pos
-
-#    find opening tag
-	ix = start_ix - 1
-	while ix >= 0:
-		ch = html[ix]
-		if ch == '<':
-			check_str = html[ix:]
-			m = re.match(end_tag, check_str)
-			if m:  # found closing tag
-				tmp_tag = Tag(m, ix)
-				if tmp_tag.start < start_ix and tmp_tag.end > start_ix: # direct hit on searched closing tag
-					closing_tag = tmp_tag
-				else:
-					backward_stack.append(tmp_tag)
-			else:
-				m = re.match(start_tag, check_str)
-				if m: # found opening tag
-					tmp_tag = Tag(m, ix);
-					if tmp_tag.unary:
-						if tmp_tag.start < start_ix and tmp_tag.end > start_ix: # exact match
-							return action(tmp_tag, None, start_ix)
-					elif backward_stack and backward_stack[-1].name == tmp_tag.name:
-						backward_stack.pop()
-					else: # found nearest unclosed tag
-						opening_tag = tmp_tag
-						break
-				elif check_str.startswith('<!--'): # found comment start
-					end_ix = check_str.find('-->') + ix + 3;
-					if ix < start_ix and end_ix >= start_ix:
-						return action(Comment(ix, end_ix))
-		elif ch == '-' and has_match('-->'): # found comment end
-			# search left until comment start is reached
-			ix = find_comment_start(ix)
-
-		ix -= 1
-		
-	if not opening_tag:
-		return action(None)
-	
-	# find closing tag
-	if not closing_tag:
-		ix = start_ix
-		while ix < html_len:
-			ch = html[ix]
-			if ch == '<':
-				check_str = html[ix:]
-				m = re.match(start_tag, check_str)
-				if m: # found opening tag
-					tmp_tag = Tag(m, ix);
-					if not tmp_tag.unary:
-						forward_stack.append(tmp_tag)
-				else:
-					m = re.match(end_tag, check_str)
-					if m:   #found closing tag
-						tmp_tag = Tag(m, ix);
-						if forward_stack and forward_stack[-1].name == tmp_tag.name:
-							forward_stack.pop()
-						else:  # found matched closing tag
-							closing_tag = tmp_tag;
-							break
-					elif has_match('<!--'): # found comment
-						ix += check_str.find('-->') + 3
-						continue
-			elif ch == '-' and has_match('-->'):
-				# looks like cursor was inside comment with invalid HTML
-				if not forward_stack or forward_stack[-1].type != 'comment':
-					end_ix = ix + 3
-					return action(Comment( find_comment_start(ix), end_ix ))
-				
-			ix += 1
-	
-	return action(opening_tag, closing_tag, start_ix)
\ No newline at end of file
+	return get_index(html, mode).find_pair(start_ix, action)
@@ -16,53 +16,459 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import re
+import sys
+import time
+from array import array
+from bisect import bisect_right
+
+re_tokens = re.compile(r'(<!--)|(-->)|(<!\[CDATA\[)|(\]\]>)|(<\?)|(\?>)|(<!)|(<[A-Za-z][A-Za-z0-9\-_:\.]*)|(</[A-Za-z][A-Za-z0-9\-_:\.]*\s*>)|(/>)|(>)|(")|(\')|(=)|(\s+)')
+re_name = re.compile(r'[A-Za-z][A-Za-z0-9\-_:\.]*$')
+re_name_char = re.compile(r'[A-Za-z0-9\-_:\.]')
+
+# Token kinds: groups of re_tokens, text between them is TOKEN_TEXT
+TOKEN_TEXT = 0
+TOKEN_COMMENT_START = 1
+TOKEN_COMMENT_END = 2
+TOKEN_CDATA_START = 3
+TOKEN_CDATA_END = 4
+TOKEN_QUESTION_START = 5
+TOKEN_QUESTION_END = 6
+TOKEN_EXCLAM_START = 7
+TOKEN_TAG_START = 8
+TOKEN_CLOSING_TAG = 9
+TOKEN_EMPTY_TAG_END = 10
+TOKEN_TAG_END = 11
+TOKEN_DOUBLE_QUOTE = 12
+TOKEN_SINGLE_QUOTE = 13
+TOKEN_EQUALS = 14
+TOKEN_SPACE = 15
+
+def tokens_feed(content, offset = 0):
+	"""
+	Yields tokens of content from offset as (kind, start, end) tuples:
+	markup tokens and text between them, without copying their text
+	"""
+	for m in re_tokens.finditer(content, offset):
+		start = m.start()
+		if start > offset:
+			yield _text_kind(content, offset, start), offset, start
+		offset = m.end()
+		yield m.lastindex, start, offset
+	if offset < len(content):
+		yield _text_kind(content, offset, len(content)), offset, len(content)
+
+token_lookahead = 9
+"Number of characters after token that tell which token it is, like in '<![CDATA['"
+
+def restart_offset(content, offset):
+	"""
+	Returns offset before which tokens don't depend on text at or after
+	offset. Tokens may look ahead a few characters, and tag names, closing
+	tags and whitespace may run over names and whitespace up to offset
+	"""
+	while offset > 0 and content[offset - 1].isspace():
+		offset -= 1
+	while offset > 0 and re_name_char.match(content[offset - 1]):
+		offset -= 1
+	# '</' of closing tag
+	return offset - 2 - token_lookahead
+
+def _text_kind(content, start, end):
+	"""
+	Returns kind of text token: text that starts with '<' is read as broken
+	tag start or closing tag
+	"""
+	if content[start] != '<':
+		return TOKEN_TEXT
+	elif content.startswith('</', start, end):
+		return TOKEN_CLOSING_TAG
+	return TOKEN_TAG_START
+
+def is_name(content, start, end):
+	"""Tells if text of content from start to end is a tag or attribute name"""
+	return re_name.match(content, start, end) is not None
+
+# Node types, stored as codes
+ROOT = 0
+DATA = 1
+SCRIPT_DATA = 2
+TAG = 3
+START_TAG = 4
+EMPTY_TAG = 5
+QUESTION_TAG = 6
+EXCLAM_TAG = 7
+COMMENT = 8
+CDATA = 9
+ATTRIBUTE = 10
+DOUBLE_QUOTED_VALUE = 11
+SINGLE_QUOTED_VALUE = 12
+VALUE = 13
+
+type_names = ['root', 'data', 'script-data', 'tag', 'start-tag', 'empty-tag', 'question-tag', 'exclam-tag',
+	'comment', 'cdata', 'attribute', 'double-quoted-value', 'single-quoted-value', 'value']
+
+type_codes = dict([(name, code) for code, name in enumerate(type_names)])
+
+tag_codes_basic = frozenset([ROOT, TAG, EMPTY_TAG])
+tag_codes = frozenset([TAG, EMPTY_TAG, QUESTION_TAG, EXCLAM_TAG, COMMENT, CDATA])
+
+empty_tags = frozenset(['area','base','basefont','br','col','embed','frame','hr','img','input','isindex','link','meta','param'])
+
+parse_slice = 1000
+"Number of tokens parsed between steps of parse"
+
+group_limit = 8
+"Longest group of sibling tags folded by zenify when it repeats"
+
+class NodeStore():
+	"""
+	Nodes of parsed document, stored column by column in parallel arrays:
+	node is an index in them. Children of node are linked with sibling
+	columns, -1 stands for no node. Names are stored once and referred by id
+	"""
+
+	def __init__(self):
+		self.types = array('b')
+		self.starts = array('i')
+		self.ends = array('i')
+		self.parents = array('i')
+		self.first_children = array('i')
+		self.last_children = array('i')
+		self.next_siblings = array('i')
+		self.previous_siblings = array('i')
+		self.name_ids = array('i')
+		self.names = ['']
+		self.name_index = {'': 0}
+
+		# children of nodes and their start offsets, made on lookup
+		self.child_lists = {}
+
+	def __len__(self):
+		return len(self.types)
+
+	def append(self, parent, type, start = 0, end = 0, name = ''):
+		"""
+		Adds node as the last child of parent
+		@return: int
+		"""
+		node = len(self.types)
+		name_id = 0
+		if name:
+			name_id = self.name_index.get(name)
+			if name_id is None:
+				name_id = self.name_index[name] = len(self.names)
+				self.names.append(name)
+
+		self.types.append(type)
+		self.starts.append(start)
+		self.ends.append(end)
+		self.parents.append(parent)
+		self.first_children.append(-1)
+		self.last_children.append(-1)
+		self.next_siblings.append(-1)
+		self.name_ids.append(name_id)
+
+		if parent == -1:
+			self.previous_siblings.append(-1)
+		else:
+			last = self.last_children[parent]
+			self.previous_siblings.append(last)
+			if last == -1:
+				self.first_children[parent] = node
+			else:
+				self.next_siblings[last] = node
+			self.last_children[parent] = node
+			if self.child_lists:
+				self.child_lists.pop(parent, None)
+
+		return node
+
+	def name(self, node):
+		return self.names[self.name_ids[node]]
+
+	def children(self, node):
+		"""
+		Returns children of node and their start offsets
+		@return: tuple of lists
+		"""
+		result = self.child_lists.get(node)
+		if result is None:
+			children = []
+			child = self.first_children[node]
+			while child != -1:
+				children.append(child)
+				child = self.next_siblings[child]
+			result = self.child_lists[node] = (children, [self.starts[child] for child in children])
+		return result
 
-def factorize(zen_children):
+	def shift(self, node, delta):
+		"""Moves node and its descendants by delta characters"""
+		starts, ends, next_siblings = self.starts, self.ends, self.next_siblings
+		stack = [node]
+		while stack:
+			node = stack.pop()
+			starts[node] += delta
+			ends[node] += delta
+			child = self.first_children[node]
+			while child != -1:
+				stack.append(child)
+				child = next_siblings[child]
+
+	def size(self):
+		"""
+		Returns size of stored nodes, in bytes
+		@return: int
+		"""
+		columns = [self.types, self.starts, self.ends, self.parents, self.first_children,
+			self.last_children, self.next_siblings, self.previous_siblings, self.name_ids]
+		return sum([column.itemsize * len(column) for column in columns]) + \
+			sum([sys.getsizeof(name) for name in self.names])
+
+class Zenifier():
+	"""
+	Makes abbreviations of tags. Every subtree gets a signature once, equal
+	signatures stand for equal abbreviations: repeated siblings and groups
+	of siblings are folded by signature and abbreviation is written in one
+	pass at the end
+	"""
+
+	def __init__(self, store, content, mode):
+		self.store = store
+		self.content = content
+		self.mode = mode
+		# signatures of (head, runs) entries, where head is abbreviation of
+		# tag without children and runs are (signature, count) of child tags
+		self.signatures = {}
+		self.entries = []
+
+	def head(self, node):
+		"""
+		Returns abbreviation of tag without its children: name, id and
+		classes, and other attributes depending on mode
+		@return: str
+		"""
+		store, content, mode = self.store, self.content, self.mode
+		types, starts, ends = store.types, store.starts, store.ends
+		first_children, next_siblings = store.first_children, store.next_siblings
 
-	zen_children = filter(lambda s: s, zen_children)
+		zen_id = ''
+		zen_class = ''
+		zen_attributes = []
 
-	if len(zen_children) > 1:
-	
-		zen_count = [1 for x in range(0, len(zen_children))]
-		index = 0
-		previous_child = ''
-		
-		for zen_child in zen_children:
-			if zen_child == previous_child:
-				zen_count[index] = zen_count[index - 1] + 1
-				zen_count[index - 1] = 0
-				zen_children[index - 1] = ''
-			previous_child = zen_child
-			index += 1
-			
-		index = 0
-		for zen_child in zen_children:
-			if zen_count[index] > 1:
-				parts = zen_child.split('>')
-				zen_children[index] = parts[0] + '*' + repr(zen_count[index])
-				if len(parts) > 1:
-					zen_children[index] += '>' + '>'.join(parts[1:])
-			index += 1
-		
-		zen_children = filter(lambda s: s, zen_children)
-		
-	return zen_children
-
-
-class Node ():
+		child = first_children[node]
+		while child != -1:
+
+			if mode > 0 and types[child] == ATTRIBUTE:
+				name = store.name(child).lower()
+				grand_child = first_children[child]
+				while grand_child != -1:
+					if types[grand_child] == VALUE and starts[grand_child] < ends[grand_child] and first_children[grand_child] == -1:
+						value = content[starts[grand_child]:ends[grand_child]]
+						if name == 'id':
+							zen_id = '#' + '#'.join(filter(lambda s: s, re.split('\s+', value)))
+						elif name == 'class':
+							zen_class = '.' + '.'.join(filter(lambda s: s, re.split('\s+', value)))
+						elif mode > 1:
+							if mode == 2 or name.startswith('on'):
+								zen_attributes.append(name)
+							else:
+								zen_attributes.append(name + '="' + value + '"')
+					grand_child = next_siblings[grand_child]
+
+			child = next_siblings[child]
+
+		zen_attributes_string = ''
+		if zen_attributes:
+			zen_attributes_string = '[' + ' '.join(zen_attributes) + ']'
+
+		return store.name(node) + zen_id + zen_class + zen_attributes_string
+
+	def signature(self, node):
+		"""
+		Returns signature of tag: children get their signatures first
+		@return: int
+		"""
+		store = self.store
+		types, first_children, next_siblings = store.types, store.first_children, store.next_siblings
+
+		order = []
+		stack = [node]
+		while stack:
+			tag = stack.pop()
+			order.append(tag)
+			child = first_children[tag]
+			while child != -1:
+				if types[child] in tag_codes_basic:
+					stack.append(child)
+				child = next_siblings[child]
+
+		tag_signatures = {}
+		for tag in reversed(order):
+			children = []
+			child = first_children[tag]
+			while child != -1:
+				if types[child] in tag_codes_basic:
+					children.append(tag_signatures.pop(child))
+				child = next_siblings[child]
+
+			entry = (self.head(tag), fold(children))
+			signature = self.signatures.get(entry)
+			if signature is None:
+				signature = self.signatures[entry] = len(self.entries)
+				self.entries.append(entry)
+			tag_signatures[tag] = signature
+
+		return tag_signatures[node]
+
+	def abbreviation(self, nodes):
+		"""
+		Returns abbreviation of sibling nodes, joined with '+'
+		@return: str
+		"""
+		types = self.store.types
+		runs = fold([self.signature(node) for node in nodes if types[node] in tag_codes_basic])
+
+		parts = []
+		stack = []
+		for index in range(len(runs) - 1, -1, -1):
+			stack.append(runs[index])
+			if index:
+				stack.append('+')
+
+		while stack:
+			item = stack.pop()
+			if not isinstance(item, tuple):
+				parts.append(item)
+				continue
+
+			signature, count = item
+			if isinstance(signature, tuple):
+				# group of sibling runs repeated count times
+				stack.append(')*' + repr(count))
+				for index in range(len(signature) - 1, -1, -1):
+					stack.append(signature[index])
+					if index:
+						stack.append('+')
+				stack.append('(')
+				continue
+
+			head, children = self.entries[signature]
+			multiplier = ''
+			if count > 1:
+				# multiplier goes before the first '>' of abbreviation
+				multiplier = '*' + repr(count)
+				index = head.find('>')
+				if index != -1:
+					head = head[:index] + multiplier + head[index:]
+					multiplier = ''
+
+			if not children:
+				parts.append(head + multiplier)
+			elif len(children) == 1:
+				stack.extend([')', children[0], '(' + head + multiplier + '>'])
+			else:
+				stack.append('))')
+				for index in range(len(children) - 1, -1, -1):
+					stack.append(children[index])
+					if index:
+						stack.append('+')
+				stack.append('(' + head + multiplier + '>(')
+
+		return ''.join(parts)
+
+def fold(signatures):
+	"""
+	Folds repeated signatures that follow each other, then repeated groups
+	of up to <code>group_limit</code> runs
+	@return: tuple of (signature, count) tuples, where signature of group is
+	tuple of its runs
+	"""
+	runs = []
+	for signature in signatures:
+		if runs and runs[-1][0] == signature:
+			runs[-1] = (signature, runs[-1][1] + 1)
+		else:
+			runs.append((signature, 1))
+
+	result = []
+	index = 0
+	while index < len(runs):
+		# group that covers most runs from index, the shortest one of equal
+		best_size, best_count = 1, 1
+		for size in range(2, min(group_limit, (len(runs) - index) // 2) + 1):
+			group = runs[index:index + size]
+			count = 1
+			while runs[index + count * size:index + (count + 1) * size] == group:
+				count += 1
+			if count > 1 and size * count > best_size * best_count:
+				best_size, best_count = size, count
+
+		if best_count > 1:
+			result.append((tuple(runs[index:index + best_size]), best_count))
+		else:
+			result.append(runs[index])
+		index += best_size * best_count
+
+	return tuple(result)
+
+
+class Node(object):
+	"""
+	Node of parsed document: a view of node kept in NodeStore
+	"""
+
+	__slots__ = ('store', 'id')
 
 	tag_types_basic = ['root', 'tag', 'empty-tag']
 	tag_types = ['tag', 'empty-tag', 'question-tag', 'exclam-tag', 'comment', 'cdata']
 	data_types = [ 'data', 'value' ]
 	other_types = [ 'root', 'attribute' ]
 
-	def __init__(self, type, name = '', start = 0, end = 0, parent = None):
-		self.type = type
-		self.name = name
-		self.start = start
-		self.end = end
-		self.parent = parent
-		self.children = []
+	def __init__(self, store, id):
+		self.store = store
+		self.id = id
+
+	def __eq__(self, other):
+		return isinstance(other, Node) and self.id == other.id and self.store is other.store
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	def __hash__(self):
+		return self.id
+
+	def _node(self, node):
+		if node == -1:
+			return None
+		return Node(self.store, node)
+
+	@property
+	def type(self):
+		return type_names[self.store.types[self.id]]
+
+	@property
+	def code(self):
+		return self.store.types[self.id]
+
+	@property
+	def name(self):
+		return self.store.name(self.id)
+
+	@property
+	def start(self):
+		return self.store.starts[self.id]
+
+	@property
+	def end(self):
+		return self.store.ends[self.id]
+
+	@property
+	def parent(self):
+		return self._node(self.store.parents[self.id])
+
+	@property
+	def children(self):
+		return [Node(self.store, child) for child in self.store.children(self.id)[0]]
 
 	def __str__(self):
 		if self.name:
@@ -71,119 +477,104 @@ class Node ():
 			return '<%s:%d:%d>' % (self.type, self.start, self.end)
 
 	def append(self, type, start = 0, end = 0, name = ''):
-		child = Node(type, name, start, end, self)
-		self.children.append(child)
-		return child
+		return Node(self.store, self.store.append(self.id, type_codes[type], start, end, name))
 
 	def first_child(self):
-		if len(self.children) > 0:
-			return self.children[0]
-		return None
+		return self._node(self.store.first_children[self.id])
 
 	def first_child_data(self):
-		if len(self.children) > 0:
-			for child in self.children:
-				if child.type == 'data':
-					return child
+		store = self.store
+		child = store.first_children[self.id]
+		while child != -1:
+			if store.types[child] == DATA:
+				return Node(store, child)
+			child = store.next_siblings[child]
 		return None
 
 	def first_child_tag(self, basic = False):
-		tag_types = Node.tag_types_basic if basic else Node.tag_types
-		if len(self.children) > 0:
-			for child in self.children:
-				if child.type in tag_types:
-					return child
+		codes = tag_codes_basic if basic else tag_codes
+		store = self.store
+		child = store.first_children[self.id]
+		while child != -1:
+			if store.types[child] in codes:
+				return Node(store, child)
+			child = store.next_siblings[child]
 		return None
 
 	def next_sibling(self):
-		if self.parent:
-			siblings = self.parent.children
-			index = siblings.index(self)
-			if index < len(siblings) - 1:
-				return siblings[index + 1]
-		return None
+		return self._node(self.store.next_siblings[self.id])
 
 	def next_sibling_tag(self, basic = False):
-		tag_types = Node.tag_types_basic if basic else Node.tag_types
-		if self.parent:
-			siblings = self.parent.children
-			index = siblings.index(self)
-			while index < len(siblings) - 1:
-				index += 1
-				if siblings[index].type in tag_types:
-					return siblings[index]
+		codes = tag_codes_basic if basic else tag_codes
+		store = self.store
+		sibling = store.next_siblings[self.id]
+		while sibling != -1:
+			if store.types[sibling] in codes:
+				return Node(store, sibling)
+			sibling = store.next_siblings[sibling]
 		return None
 
 	def last_child(self):
-		if len(self.children) > 0:
-			return self.children[-1]
-		return None
+		return self._node(self.store.last_children[self.id])
 
 	def last_child_tag(self, basic = False):
-		tag_types = Node.tag_types_basic if basic else Node.tag_types
-		index = len(self.children)
-		while index > 0:
-			index -= 1
-			if self.children[index].type in tag_types:
-				return self.children[index]
+		codes = tag_codes_basic if basic else tag_codes
+		store = self.store
+		child = store.last_children[self.id]
+		while child != -1:
+			if store.types[child] in codes:
+				return Node(store, child)
+			child = store.previous_siblings[child]
 		return None
 
 	def previous_sibling(self):
-		if self.parent:
-			siblings = self.parent.children
-			index = siblings.index(self)
-			if index > 0:
-				return siblings[index - 1]
-		return None
+		return self._node(self.store.previous_siblings[self.id])
 
 	def previous_sibling_tag(self, basic = False):
-		tag_types = Node.tag_types_basic if basic else Node.tag_types
-		if self.parent:
-			siblings = self.parent.children
-			index = siblings.index(self)
-			while index > 0:
-				index -= 1
-				if siblings[index].type in tag_types:
-					return siblings[index]
+		codes = tag_codes_basic if basic else tag_codes
+		store = self.store
+		sibling = store.previous_siblings[self.id]
+		while sibling != -1:
+			if store.types[sibling] in codes:
+				return Node(store, sibling)
+			sibling = store.previous_siblings[sibling]
 		return None
 
 	def parent_tag(self, basic = False):
 		test = self
-		tag_types = Node.tag_types_basic if basic else Node.tag_types
+		codes = tag_codes_basic if basic else tag_codes
 		while True:
 			test = test.parent
-			if test and test.type in tag_types:
+			if test and test.code in codes:
 				return test
 		return None
 
 	def is_child_of(self, node):
-		parent = self.parent
-		while parent:
-			if parent == node:
+		parents = self.store.parents
+		parent = parents[self.id]
+		while parent != -1:
+			if parent == node.id:
 				return True
-			parent = parent.parent
+			parent = parents[parent]
 		return False
 
 	def is_sibling_of(self, node):
-		if self.parent and self.parent.children:
-			children = self.parent.children
-			for child in children:
-				if child == node:
-					return True
-		return False
+		parents = self.store.parents
+		return parents[self.id] != -1 and parents[self.id] == parents[node.id]
 
 	def inner_bounds(self, offset_start, offset_end):
 
-		if self.type in ['data', 'attribute'] and self.parent:
+		code = self.code
+		if code in [DATA, ATTRIBUTE] and self.parent:
 			return self.parent.inner_bounds(offset_start, offset_end)
 
-		elif self.type == 'value' and self.parent and self.parent.parent:
+		elif code == VALUE and self.parent and self.parent.parent:
 			return self.parent.parent.inner_bounds(offset_start, offset_end)
 
-		elif self.type in ['empty-tag', 'question-tag', 'exclam-tag', 'comment', 'cdata']:
+		elif code in [EMPTY_TAG, QUESTION_TAG, EXCLAM_TAG, COMMENT, CDATA]:
 			return self.start, self.end
 
-		elif self.type in ['root', 'tag'] and self.children:
+		elif code in [ROOT, TAG] and self.first_child():
 			node_start = self.first_child_data()
 			node_end = self.last_child()
 			if node_start and node_end:
@@ -197,7 +588,8 @@ class Node ():
 
 	def outer_bounds(self, offset_start, offset_end):
 
-		if self.type in ['root', 'tag', 'empty-tag', 'question-tag', 'exclam-tag', 'comment', 'cdata']:
+		code = self.code
+		if code == ROOT or code in tag_codes:
 
 			if offset_start == self.start and offset_end == self.end and self.parent:
 				start, end = self.parent.inner_bounds(offset_start, offset_end)
@@ -209,63 +601,16 @@ class Node ():
 
 			return self.start, self.end
 
-		elif self.type in ['data', 'attribute'] and self.parent:
+		elif code in [DATA, ATTRIBUTE] and self.parent:
 			return self.parent.outer_bounds(offset_start, offset_end)
 
-		elif self.type == 'value' and self.parent and self.parent.parent:
+		elif code == VALUE and self.parent and self.parent.parent:
 			return self.parent.parent.outer_bounds(offset_start, offset_end)
 
 		return None, None
 
 	def zenify(self, content, mode):
-
-		if self.type not in Node.tag_types_basic:
-			return ''
-			
-		zen_id = ''
-		zen_class = ''
-		zen_children = []
-		zen_attributes = []
-
-		for child in self.children:
-
-			name = child.name.lower()
-
-			if mode > 0 and child.type == 'attribute' and name in ['id', 'class']:
-				for grand_child in child.children:
-					if grand_child.type == 'value' and grand_child.start < grand_child.end and not grand_child.children:
-						if name == 'id':
-							zen_id = '#' + '#'.join(filter(lambda s: s, re.split('\s+', content[grand_child.start:grand_child.end])))
-						elif name == 'class':
-							zen_class = '.' + '.'.join(filter(lambda s: s, re.split('\s+', content[grand_child.start:grand_child.end])))
-
-			elif mode > 1 and child.type == 'attribute':
-				for grand_child in child.children:
-					if grand_child.type == 'value' and grand_child.start < grand_child.end and not grand_child.children:
-						if mode == 2 or name.startswith('on'):
-							zen_attributes.append(name)
-						else:
-							zen_attributes.append(name + '="' + content[grand_child.start:grand_child.end] + '"')
-
-			elif child.type in Node.tag_types_basic:
-				zen_children.append(child.zenify(content, mode))
-
-		zen_children = factorize(zen_children)
-		if len(zen_children) == 0:
-			zen_children_string = ''
-		elif len(zen_children) == 1:
-			zen_children_string = '>' + zen_children[0]
-		else:
-			zen_children_string = '>(' + '+'.join(zen_children) + ')'
-			
-		zen_attributes_string = ''
-		if zen_attributes:
-			zen_attributes_string = '[' + ' '.join(zen_attributes) + ']'
-			
-		if zen_children_string:
-			return '(' + self.name + zen_id + zen_class + zen_attributes_string + zen_children_string + ')'
-		else:
-			return self.name + zen_id + zen_class + zen_attributes_string
+		return Zenifier(self.store, content, mode).abbreviation([self.id])
 
 	def show(self, level = 0):
 		children = ''
@@ -276,228 +621,487 @@ class Node ():
 
 class HtmlNavigation():
 
-	def __init__(self, content):
-		self.content = content
-		self.tree = self._parse(content)
+	def __init__(self, content, deferred = False):
+		"""
+		Parses content. If deferred is True, content is parsed by the next
+		calls of update() or on the first lookup
+		"""
+		self.job = self._reset(content)
+		if not deferred:
+			self.update(content)
 
 	def _parse(self, content, print_and_exit = False):
 
-		empty_tags = ['area','base','basefont','br','col','embed','frame','hr','img','input','isindex','link','meta','param']
-
-		def tokens_feed():
-			tokens_re = '(<!--|-->|<\!\[CDATA\[|\]\]>|<\?|\?>|<\!|<[A-Za-z][A-Za-z0-9\-_:\.]*|</[A-Za-z][A-Za-z0-9\-_:\.]*\s*>|/?>|["\'=]|\s+)'
-			tokens = filter(lambda s: s, re.split(tokens_re, content))
-			for token in tokens:
-				yield token
-
-		def get_next_token():
-			try:
-				return tokens.next()
-			except StopIteration:
-				return None
-
-		tokens = tokens_feed()
-		
 		if print_and_exit:
-			for token in tokens: print token, '|',
+			for kind, start, end in tokens_feed(content): print content[start:end], '|',
 			print
 			return None
 
-		root = Node('root')
-		node = root.append('data')
-		offset = 0
-		end = 0
-		token = ''
-
-		while True:
+		for step in self._reset(content): pass
+		return self.tree
 
-			previous_token = token
-			offset = end
-
-			token = get_next_token()
-			if not token: break
-			end = offset + len(token)
-
-			if token == '<!--':
-				if node.type == 'data':
-					node.end = offset
-					node = node.parent
-					node = node.append('comment', offset)
-
-			elif token == '-->':
-				if node.type == 'comment':
-					node.end = end
-					node = node.parent.append('data', end)
-
-			elif token == '<![CDATA[':
-				if node.type == 'data':
-					node.end = offset
-					node = node.parent
-					node = node.append('cdata', offset)
-
-			elif token == ']]>':
-				if node.type == 'cdata':
-					node.end = end
-					node = node.parent.append('data', end)
-
-			elif token == '<?':
-				if node.type != 'question--tag':
-					if node.type == 'data':
-						node.end = offset
-						node = node.parent
-					node = node.append('question-tag', offset)
-
-			elif token == '?>':
-				if node.type == 'question-tag':
-					node.end = end
-					previous_sibling = node.previous_sibling()
-					if previous_sibling and previous_sibling.type == 'data':
-						node = node.parent.append('data', end)
+	def _reset(self, content):
+		"""
+		Starts full parse of content
+		@return: generator of parse steps
+		"""
+		self.content = content
+		self.damage = None
+		self.store = NodeStore()
+		root = self.store.append(-1, ROOT)
+		self.tree = Node(self.store, root)
+		return self._reset_steps(content, self.store.append(root, DATA))
+
+	def _reset_steps(self, content, node):
+		for step in self._parse_from(content, node):
+			yield step
+		self.parsed_size = len(self.store)
+
+	def _parse_from(self, content, node, offset = 0, resync = None, resync_offset = 0):
+		"""
+		Parses content from offset, where parser is in node. If resync
+		function is given, it is called with every new data node that starts
+		at or after resync_offset, and parsing stops when it returns True.
+		Generator: yields after every parse_slice tokens
+		"""
+
+		store = self.store
+		append = store.append
+		types, starts, ends, parents = store.types, store.starts, store.ends, store.parents
+		name_ids, names = store.name_ids, store.names
+
+		tokens = tokens_feed(content, offset)
+		if not resync:
+			resync_offset = len(content) + 1
+		end = offset
+		previous_kind = None
+		count = parse_slice
+
+		for kind, offset, end in tokens:
+
+			count -= 1
+			if not count:
+				count = parse_slice
+				yield None
+
+			last_node = node
+
+			if kind == TOKEN_COMMENT_START:
+				if types[node] == DATA:
+					ends[node] = offset
+					node = parents[node]
+					node = append(node, COMMENT, offset)
+
+			elif kind == TOKEN_COMMENT_END:
+				if types[node] == COMMENT:
+					ends[node] = end
+					node = append(parents[node], DATA, end)
+
+			elif kind == TOKEN_CDATA_START:
+				if types[node] == DATA:
+					ends[node] = offset
+					node = parents[node]
+					node = append(node, CDATA, offset)
+
+			elif kind == TOKEN_CDATA_END:
+				if types[node] == CDATA:
+					ends[node] = end
+					node = append(parents[node], DATA, end)
+
+			elif kind == TOKEN_QUESTION_START:
+				if types[node] == DATA:
+					ends[node] = offset
+					node = parents[node]
+				node = append(node, QUESTION_TAG, offset)
+
+			elif kind == TOKEN_QUESTION_END:
+				if types[node] == QUESTION_TAG:
+					ends[node] = end
+					previous_sibling = store.previous_siblings[node]
+					if previous_sibling != -1 and types[previous_sibling] == DATA:
+						node = append(parents[node], DATA, end)
 					else:
-						node = node.parent
+						node = parents[node]
 
-			elif token == '<!':
-				if node.type == 'data':
-					node.end = offset
-					node = node.parent.append('exclam-tag', offset)
+			elif kind == TOKEN_EXCLAM_START:
+				if types[node] == DATA:
+					ends[node] = offset
+					node = append(parents[node], EXCLAM_TAG, offset)
 
-			elif token.startswith('</'):
+			elif kind == TOKEN_CLOSING_TAG:
 
-				if node.type == 'script-data':
+				if types[node] == SCRIPT_DATA:
 					
-					name = token[2:-1].rstrip().lower()
-					if name == 'script':
-						node.type = 'data'
-						node.end = offset
-						node = node.parent
-						node.end = end
-						node = node.parent.append('data', end)
+					if content[offset + 2:end - 1].rstrip().lower() == 'script':
+						types[node] = DATA
+						ends[node] = offset
+						node = parents[node]
+						ends[node] = end
+						node = append(parents[node], DATA, end)
 
-				elif node.type == 'data':
+				elif types[node] == DATA:
 
-					node.end = offset
+					ends[node] = offset
 
-					name = token[2:-1].rstrip().lower()
+					name_id = store.name_index.get(content[offset + 2:end - 1].rstrip().lower())
 					current_node = node
-					node = node.parent
+					node = parents[node]
 
 					while True:
-						if node.type == 'tag':
-							if node.name == name:
-								node.end = end
-								node = node.parent.append('data', end)
+						if types[node] == TAG:
+							if name_ids[node] == name_id:
+								ends[node] = end
+								node = append(parents[node], DATA, end)
 								break
 							else:
-								node.end = end
-								node = node.parent
-								if node.type == 'root':
+								ends[node] = end
+								node = parents[node]
+								if types[node] == ROOT:
 									node = current_node
 									break
 						else:
 							break
 
-			elif token.startswith('<'):
-				name = token[1:].rstrip().lower()
-				if node.type == 'data' and name:
-					node.end = offset
-					node = node.parent.append('start-tag', offset, 0, name)
-
-			elif token == '/>':
-				if node.type in ['start-tag', 'attribute']:
-					if node.type == 'attribute':
-						node.end = offset
-						node = node.parent
-					node.type = 'empty-tag'
-					node.end = end
-					node = node.parent.append('data', end)
-
-			elif token == '>':
-				if node.type == 'exclam-tag':
-					node.end = end
-					node = node.parent.append('data', end)
-				elif node.type in ['start-tag', 'attribute']:
-					if node.type == 'attribute':
-						node.end = offset
-						node = node.parent
-					if node.name in empty_tags:
-						node.type = 'empty-tag'
-						node.end = end
-						node = node.parent.append('data', end)
+			elif kind == TOKEN_TAG_START:
+				if types[node] == DATA:
+					name = content[offset + 1:end].lower()
+					if name:
+						ends[node] = offset
+						node = append(parents[node], START_TAG, offset, 0, name)
+
+			elif kind == TOKEN_EMPTY_TAG_END:
+				if types[node] == START_TAG or types[node] == ATTRIBUTE:
+					if types[node] == ATTRIBUTE:
+						ends[node] = offset
+						node = parents[node]
+					types[node] = EMPTY_TAG
+					ends[node] = end
+					node = append(parents[node], DATA, end)
+
+			elif kind == TOKEN_TAG_END:
+				if types[node] == EXCLAM_TAG:
+					ends[node] = end
+					node = append(parents[node], DATA, end)
+				elif types[node] == START_TAG or types[node] == ATTRIBUTE:
+					if types[node] == ATTRIBUTE:
+						ends[node] = offset
+						node = parents[node]
+					name = names[name_ids[node]]
+					if name in empty_tags:
+						types[node] = EMPTY_TAG
+						ends[node] = end
+						node = append(parents[node], DATA, end)
 					else:
-						node.type = 'tag'
-						if node.name == 'script':
-							node = node.append('script-data', end)
+						types[node] = TAG
+						if name == 'script':
+							node = append(node, SCRIPT_DATA, end)
 						else:
-							node = node.append('data', end)
-
-			elif token == '"':
-				if node.type == 'attribute' and previous_token == '=':
-					node = node.append('double-quoted-value', end)
-				elif node.type == 'double-quoted-value':
-					node.type = 'value'
-					node.end = offset
-					node = node.parent
-					node.end = end
-					node = node.parent
-
-			elif token == "'":
-				if node.type == 'attribute' and previous_token == '=':
-					node = node.append('single-quoted-value', end)
-				elif node.type == 'single-quoted-value':
-					node.type = 'value'
-					node.end = offset
-					node = node.parent
-					node.end = end
-					node = node.parent
-
-			else:
-				is_alnum = not re.sub('[A-Za-z][A-Za-z0-9\-_:\.]*', '', token)
-				if node.type == 'start-tag':
-					if is_alnum:
-						node = node.append('attribute', offset, 0, token)
-
-				elif node.type == 'attribute':
-					if previous_token == '=' and is_alnum:
-						node.append('value', offset, end)
-						node.end = end
-						node = node.parent
-					elif token != '=':
-						node.end = offset
-						node = node.parent						
-
-		while node.type != 'root':
-			node.end = end
-			node = node.parent
-		node.end = end
-
-		return root
+							node = append(node, DATA, end)
+
+			elif kind == TOKEN_DOUBLE_QUOTE:
+				if types[node] == ATTRIBUTE and previous_kind == TOKEN_EQUALS:
+					node = append(node, DOUBLE_QUOTED_VALUE, end)
+				elif types[node] == DOUBLE_QUOTED_VALUE:
+					types[node] = VALUE
+					ends[node] = offset
+					node = parents[node]
+					ends[node] = end
+					node = parents[node]
+
+			elif kind == TOKEN_SINGLE_QUOTE:
+				if types[node] == ATTRIBUTE and previous_kind == TOKEN_EQUALS:
+					node = append(node, SINGLE_QUOTED_VALUE, end)
+				elif types[node] == SINGLE_QUOTED_VALUE:
+					types[node] = VALUE
+					ends[node] = offset
+					node = parents[node]
+					ends[node] = end
+					node = parents[node]
+
+			elif types[node] == START_TAG:
+				if kind == TOKEN_TEXT and is_name(content, offset, end):
+					node = append(node, ATTRIBUTE, offset, 0, content[offset:end])
+
+			elif types[node] == ATTRIBUTE:
+				if previous_kind == TOKEN_EQUALS and kind == TOKEN_TEXT and is_name(content, offset, end):
+					append(node, VALUE, offset, end)
+					ends[node] = end
+					node = parents[node]
+				elif kind != TOKEN_EQUALS:
+					ends[node] = offset
+					node = parents[node]
+
+			if end >= resync_offset and node != last_node and starts[node] == end \
+				and (types[node] == DATA or types[node] == SCRIPT_DATA) and resync(node):
+				return
+
+			previous_kind = kind
+
+		while types[node] != ROOT:
+			ends[node] = end
+			node = parents[node]
+		ends[node] = end
 
 	def current(self, offset_start, offset_end, tree = None):
 
 		if tree is None:
 			tree = self.tree
 
-		result = tree
-		for child in tree.children:
+		return Node(self.store, self._current(offset_start, offset_end, tree.id))
+
+	def _current(self, offset_start, offset_end, node):
+
+		store = self.store
+		starts, ends = store.starts, store.ends
 
-			if child.start <= offset_start and offset_end <= child.end:
-				sibling = child.next_sibling()
+		# children that contain offsets: starts and ends of children are
+		# ordered, so they are the last ones that start before offset_start,
+		# while their ends are after offset_end
+		children, child_starts = store.children(node)
+		last = bisect_right(child_starts, offset_start)
+		first = last
+		while first > 0 and ends[children[first - 1]] >= offset_end:
+			first -= 1
 
-				if sibling and sibling.start == offset_start and sibling.end == offset_end:
+		result = node
+		for child in children[first:last]:
+
+			if starts[child] <= offset_start and offset_end <= ends[child]:
+				sibling = store.next_siblings[child]
+
+				if sibling != -1 and starts[sibling] == offset_start and ends[sibling] == offset_end:
 					return sibling
 
-				sibling = child.previous_sibling()
+				sibling = store.previous_siblings[child]
 
-				if sibling and sibling.start == offset_start and sibling.end == offset_end:
+				if sibling != -1 and starts[sibling] == offset_start and ends[sibling] == offset_end:
 					return sibling
 
-				result = self.current(offset_start, offset_end, child)
+				result = self._current(offset_start, offset_end, child)
 
 		return result
 
+	def edit(self, offset, removed, inserted):
+		"""
+		Records change of document: removed characters at offset were
+		replaced with inserted text. Changes are merged in one damaged region,
+		which is parsed again on the next navigation
+		"""
+		inserted = len(inserted)
+		if self.damage is None:
+			self.damage = (offset, offset + removed, offset + inserted)
+		else:
+			start, old_end, new_end = self.damage
+			self.damage = (min(start, offset),
+				old_end + max(0, offset + removed - new_end),
+				max(new_end, offset + removed) + inserted - removed)
+
+	def update(self, content, timeout = None):
+		"""
+		Brings tree up to date with content. If timeout is given, in seconds,
+		parsing stops when time is out and goes on with the next call, so it
+		may run in idle time slices
+		@return: True if tree is up to date
+		"""
+		if timeout is not None:
+			deadline = time.time() + timeout
+
+		while True:
+			if self.job is None:
+				self.job = self._update(content)
+				if self.job is None:
+					return True
+
+			for step in self.job:
+				if timeout is not None and time.time() >= deadline:
+					return False
+			self.job = None
+
+	def _update(self, content):
+		"""
+		Starts update of tree after change of content: damaged region is
+		parsed again, or the whole content if changes are unknown
+		@return: generator of parse steps, None if tree is up to date
+		"""
+		if self.damage:
+			start, old_end, new_end = self.damage
+			self.damage = None
+			# edits are trusted if length of content and text next to damaged
+			# region agree with them; nodes of replaced regions stay in store,
+			# so it's compacted with a full parse when it grows too much
+			if len(self.store) < 2 * self.parsed_size + 1024 \
+				and len(content) - new_end == len(self.content) - old_end \
+				and content[max(0, start - 16):start] == self.content[max(0, start - 16):start] \
+				and content[new_end:new_end + 16] == self.content[old_end:old_end + 16]:
+				return self._reparse(content, start, old_end, new_end)
+
+		if content is not self.content and content != self.content:
+			return self._reset(content)
+
+		return None
+
+	def _reparse(self, content, start, old_end, new_end):
+		"""
+		Starts parse of damaged region [start, old_end) of the tree, which is
+		[start, new_end) in new content. Parser is restarted from the last
+		data node before any token that depends on damaged region, and
+		stopped at the first data node after region where parser state is
+		the same as in old tree: the rest of old tree is moved there
+		@return: generator of parse steps
+		"""
+		store = self.store
+		delta = new_end - old_end
+		restart = self._restart_node(self.tree.id, restart_offset(content, start) - 1)
+		if restart == -1:
+			restart = store.first_children[self.tree.id]
+
+		# ancestors keep only children up to restart node; cut off children
+		# and ends are kept to move the rest of old tree back
+		cuts = {}
+		child = restart
+		while store.parents[child] != -1:
+			parent = store.parents[child]
+			cuts[parent] = (child, store.next_siblings[child], store.last_children[parent], store.ends[parent])
+			store.next_siblings[child] = -1
+			store.last_children[parent] = child
+			child = parent
+		store.child_lists.clear()
+
+		old_nodes = self._nodes_after(restart, cuts)
+		pending = [next(old_nodes, -1)]
+
+		def resync(node):
+			old_start = store.starts[node] - delta
+			candidate = pending[0]
+			while candidate != -1 and store.starts[candidate] < old_start:
+				candidate = next(old_nodes, -1)
+
+			while candidate != -1 and store.starts[candidate] == old_start:
+				if self._same_state(node, candidate):
+					self._graft(node, candidate, cuts, delta)
+					return True
+				candidate = next(old_nodes, -1)
+
+			pending[0] = candidate
+			return False
+
+		self.content = content
+		return self._parse_from(content, restart, store.starts[restart], resync, new_end)
+
+	def _restart_node(self, node, offset):
+		"""
+		Returns the last data node of node that starts at or before offset and
+		has only tags for ancestors, parser state is known there
+		"""
+		store = self.store
+		children, starts = store.children(node)
+		for index in range(bisect_right(starts, offset) - 1, -1, -1):
+			child = children[index]
+			if store.types[child] == TAG:
+				found = self._restart_node(child, offset)
+				if found != -1:
+					return found
+			elif store.types[child] == DATA and not (store.types[node] == TAG and store.name(node) == 'script'):
+				# script element has the only data child, parsed as script data
+				return child
+
+		return -1
+
+	def _nodes_after(self, node, cuts):
+		"""Yields nodes of old tree after node, in document order"""
+		store = self.store
+		while store.parents[node] != -1:
+			sibling = cuts[store.parents[node]][1]
+			while sibling != -1:
+				stack = [sibling]
+				while stack:
+					old_node = stack.pop()
+					yield old_node
+					child = store.last_children[old_node]
+					while child != -1:
+						stack.append(child)
+						child = store.previous_siblings[child]
+				sibling = store.next_siblings[sibling]
+			node = store.parents[node]
+
+	def _same_state(self, node, old_node):
+		"""
+		Tells if parser in new data node and in old data node is in the same
+		state: the rest of document is parsed the same way
+		"""
+		store = self.store
+		types, parents, name_ids = store.types, store.parents, store.name_ids
+		if types[old_node] != DATA and types[old_node] != SCRIPT_DATA:
+			return False
+
+		parent = parents[old_node]
+		old_type = types[old_node]
+		if types[parent] == TAG and store.name(parent) == 'script':
+			old_type = SCRIPT_DATA
+		if types[node] != old_type:
+			return False
+
+		node, old_node = parents[node], parents[old_node]
+		while node != -1 and old_node != -1:
+			if types[node] != types[old_node] or name_ids[node] != name_ids[old_node]:
+				return False
+			node, old_node = parents[node], parents[old_node]
+		return node == -1 and old_node == -1
+
+	def _graft(self, node, old_node, cuts, delta):
+		"""
+		Replaces new data node with old one and moves old nodes that follow
+		it to the new tree
+		"""
+		store = self.store
+		parents, next_siblings, previous_siblings = store.parents, store.next_siblings, store.previous_siblings
+
+		# new data node is the last child of its parent
+		parent = parents[node]
+		store.last_children[parent] = previous_siblings[node]
+		if previous_siblings[node] == -1:
+			store.first_children[parent] = -1
+		else:
+			next_siblings[previous_siblings[node]] = -1
+
+		first = old_node
+		while True:
+			old_parent = parents[old_node]
+			if old_parent in cuts:
+				last, old_end = cuts[old_parent][2:]
+			else:
+				last, old_end = store.last_children[old_parent], store.ends[old_parent]
+
+			if first != -1:
+				tail = store.last_children[parent]
+				if tail == -1:
+					store.first_children[parent] = first
+				else:
+					next_siblings[tail] = first
+				previous_siblings[first] = tail
+				store.last_children[parent] = last
+
+				child = first
+				while child != -1:
+					parents[child] = parent
+					if delta:
+						store.shift(child, delta)
+					child = next_siblings[child]
+
+			store.ends[parent] = old_end + delta
+			if parents[parent] == -1:
+				break
+
+			# siblings that follow old parent are moved to parent's parent
+			node, old_node = parent, old_parent
+			parent, old_parent = parents[node], parents[old_node]
+			if old_parent in cuts and cuts[old_parent][0] == old_node:
+				first = cuts[old_parent][1]
+			else:
+				first = next_siblings[old_node]
+
 	def _prepare(self, offset_start, offset_end, content):
-		if content != self.content:
-			self.__init__(content)
+		self.update(content)
 		return self.current(offset_start, offset_end)
 	
 	def previous_node(self, offset_start, offset_end, content):
@@ -651,11 +1255,7 @@ class HtmlNavigation():
 			offset_start, offset_end = self.outer_bounds(offset_start, offset_end, content)
 			nodes.append(self._prepare(offset_start, offset_end, content))
 
-		result = []
-		for node in nodes:
-			result.append(node.zenify(content, mode))
-		result = factorize(result)
-		return '+'.join(result)
+		return Zenifier(self.store, content, mode).abbreviation([node.id for node in nodes])
 
 
 if __name__ == '__main__':
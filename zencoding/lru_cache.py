@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Bounded least-recently-used cache.
+
+The cache is limited both by the number of entries and, optionally, by the
+total weight of the stored values (for example, the number of nodes in a
+parsed tree), so a few huge values can't push the memory usage up.
+Hit, miss and eviction counters are kept for diagnostics. Cache may be
+shared by threads.
+'''
+import threading
+
+class LRUCache(object):
+	"""
+	Least-recently-used cache with entry count and weight limits
+	"""
+	def __init__(self, max_size=256, max_weight=None, weigher=None):
+		"""
+		@param max_size: Maximum number of entries
+		@type max_size: int
+		@param max_weight: Maximum total weight of entries (None for unlimited)
+		@type max_weight: int
+		@param weigher: Function that returns weight of a value
+		(each value weights 1 by default)
+		@type weigher: function
+		"""
+		self.max_size = max_size
+		self.max_weight = max_weight
+		self.weigher = weigher
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._lock = threading.Lock()
+		self.clear()
+
+	def clear(self):
+		"""
+		Remove all entries. Counters are preserved, use
+		<code>reset_stats()</code> to reset them
+		"""
+		# key -> [prev, next, key, value, weight] links of circular list,
+		# self._root.next is the oldest entry, self._root.prev is the newest
+		root = []
+		root[:] = [root, root, None, None, 0]
+		self._lock.acquire()
+		try:
+			self._map = {}
+			self._root = root
+			self.weight = 0
+		finally:
+			self._lock.release()
+
+	def reset_stats(self):
+		"Reset hit, miss and eviction counters"
+		self.hits = self.misses = self.evictions = 0
+
+	def __len__(self):
+		return len(self._map)
+
+	def __contains__(self, key):
+		return key in self._map
+
+	def get(self, key, default=None):
+		"""
+		Returns cached value and marks it as recently used
+		@return: Cached value or <code>default</code> if key wasn't found
+		"""
+		self._lock.acquire()
+		try:
+			link = self._map.get(key)
+			if link is None:
+				self.misses += 1
+				return default
+
+			self.hits += 1
+
+			# move link to the end of the list
+			link_prev, link_next = link[0], link[1]
+			link_prev[1] = link_next
+			link_next[0] = link_prev
+			root = self._root
+			last = root[0]
+			last[1] = root[0] = link
+			link[0] = last
+			link[1] = root
+
+			return link[3]
+		finally:
+			self._lock.release()
+
+	def put(self, key, value):
+		"""
+		Add value to cache, evicting least recently used entries if needed
+		"""
+		weight = self.weigher(value) if self.weigher else 1
+
+		self._lock.acquire()
+		try:
+			if key in self._map:
+				self._unlink(self._map.pop(key))
+
+			if self.max_weight is not None and weight > self.max_weight:
+				# value is too big to be cached at all
+				return
+
+			root = self._root
+			last = root[0]
+			link = [last, root, key, value, weight]
+			last[1] = root[0] = link
+			self._map[key] = link
+			self.weight += weight
+
+			while len(self._map) > self.max_size or \
+					(self.max_weight is not None and self.weight > self.max_weight):
+				oldest = root[1]
+				del self._map[oldest[2]]
+				self._unlink(oldest)
+				self.evictions += 1
+		finally:
+			self._lock.release()
+
+	def stats(self):
+		"""
+		Returns cache counters
+		@return: dict
+		"""
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.evictions,
+			'size': len(self._map),
+			'weight': self.weight
+		}
+
+	def _unlink(self, link):
+		link_prev, link_next = link[0], link[1]
+		link_prev[1] = link_next
+		link_next[0] = link_prev
+		self.weight -= link[4]
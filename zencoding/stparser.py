@@ -23,6 +23,16 @@ re_tag = r'^<([\w\-]+(?:\:[\w\-]+)?)((?:\s+[\w\-]+(?:\s*=\s*(?:(?:"[^"]*")|(?:\'
 re_attrs = r'([\w\-]+)\s*=\s*([\'"])(.*?)\2'
 "Regular expression for matching XML attributes"
 
+generation = 0
+"Incremented each time settings are parsed, used to invalidate caches"
+
+class Settings(dict):
+	"""
+	Parsed settings dictionary. Holds lookup index for each syntax (see
+	<code>create_index()</code>) in <code>index</code> property
+	"""
+	index = None
+
 class Entry:
 	"""
 	Unified object for parsed data
@@ -132,11 +142,95 @@ def create_maps(obj):
 	for p, value in obj.items():
 		if p == 'element_types':
 			for k, v in value.items():
-				if isinstance(v, str):
+				if isinstance(v, basestring):
 					value[k] = [el.strip() for el in v.split(',')]
 		elif type(value) == types.DictType:
 			create_maps(value)
 
+def _get_resource_chain(settings, syntax):
+	"""
+	Returns list of resources for lookups, in order of precedence: syntax
+	itself, then syntaxes of its <code>extends</code> list, in listed order.
+	Their own <code>extends</code> aren't followed
+	@type settings: dict
+	@type syntax: str
+	@return: list
+	"""
+	result = [settings[syntax]]
+	for parent in settings[syntax].get('extends', []):
+		if type(settings.get(parent)) == types.DictType:
+			result.append(settings[parent])
+	
+	return result
+
+def _resolve_reference(abbreviations, entry):
+	"""
+	Follows chain of references until abbreviation is found
+	@type abbreviations: dict
+	@type entry: Entry
+	@return: Entry, None if chain is broken, cyclic or doesn't end with
+	abbreviation
+	"""
+	visited = {}
+	while entry and entry.type == TYPE_REFERENCE:
+		if entry.value in visited:
+			return None
+		visited[entry.value] = True
+		entry = abbreviations.get(entry.value)
+		
+	if entry and entry.type == TYPE_ABBREVIATION:
+		return entry
+	
+	return None
+
+def create_index(settings):
+	"""
+	Creates lookup index for each syntax of parsed settings. Index contains
+	flattened resources of syntax and syntaxes it extends:
+	<code>abbreviations</code> and <code>snippets</code> collections,
+	<code>tags</code> (abbreviations with resolved references),
+	<code>resources</code> (first found value of each resource),
+	<code>resource</code> (syntax settings itself) and <code>elements</code>
+	(sets of its <code>element_types</code> collections)
+	@type settings: dict
+	@return: dict
+	"""
+	index = {}
+	for syntax, resource in settings.items():
+		if type(resource) != types.DictType:
+			continue
+		
+		chain = _get_resource_chain(settings, syntax)
+		chain.reverse()
+		
+		resources = {}
+		abbreviations = {}
+		snippets = {}
+		for item in chain:
+			resources.update(item)
+			abbreviations.update(item.get('abbreviations', {}))
+			snippets.update(item.get('snippets', {}))
+			
+		tags = {}
+		for key, entry in abbreviations.items():
+			entry = _resolve_reference(abbreviations, entry)
+			if entry:
+				tags[key] = entry
+		
+		elements = {}
+		for key, names in resource.get('element_types', {}).items():
+			elements[key] = frozenset(names)
+		
+		index[syntax] = {
+			'abbreviations': abbreviations,
+			'snippets': snippets,
+			'tags': tags,
+			'resources': resources,
+			'resource': resource,
+			'elements': elements
+		}
+		
+	return index
 
 if __name__ == '__main__':
 	pass
@@ -146,7 +240,7 @@ def get_settings(user_settings=None):
 	Main function that gather all settings and returns parsed dictionary
 	@param user_settings: A dictionary of user-defined settings
 	"""
-	settings = deepcopy(_original_settings)
+	settings = Settings(deepcopy(_original_settings))
 	create_maps(settings)
 	
 	if user_settings:
@@ -156,6 +250,10 @@ def get_settings(user_settings=None):
 	
 	# now we need to parse final set of settings
 	parse(settings)
+	settings.index = create_index(settings)
+	
+	global generation
+	generation += 1
 	
 	return settings
 	
\ No newline at end of file
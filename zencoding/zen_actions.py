@@ -9,7 +9,7 @@ This layer describes all available Zen Coding actions, like
 @link http://chikuyonok.ru
 """
 from zencoding import zen_core as zen_coding
-from zencoding import html_matcher, zen_file
+from zencoding import html_matcher, zen_file, document_index
 from zen_core import char_at, ZenError
 import re
 import base64
@@ -460,7 +460,7 @@ def toggle_css_comment(editor):
 
 def search_comment(text, pos, start_token, end_token):
 	"""
-	Search for nearest comment in <code>str</code>, starting from index <code>from</code>
+	Search for comment in <code>text</code> that contains <code>pos</code>
 	@param text: Where to search
 	@type text: str
 	@param pos: Search start index
@@ -471,36 +471,7 @@ def search_comment(text, pos, start_token, end_token):
 	@type end_token: str
 	@return: None if comment wasn't found, list otherwise
 	"""
-	start_ch = start_token[0]
-	end_ch = end_token[0]
-	comment_start = -1
-	comment_end = -1
-	
-	def has_match(tx, start):
-		return text[start:start + len(tx)] == tx
-	
-		
-	# search for comment start
-	while pos:
-		pos -= 1
-		if text[pos] == start_ch and has_match(start_token, pos):
-			comment_start = pos
-			break
-	
-	if comment_start != -1:
-		# search for comment end
-		pos = comment_start
-		content_len = len(text)
-		while content_len >= pos:
-			pos += 1
-			if text[pos] == end_ch and has_match(end_token, pos):
-				comment_end = pos + len(end_token)
-				break
-	
-	if comment_start != -1 and comment_end != -1:
-		return comment_start, comment_end
-	else:
-		return None
+	return document_index.get_document(text).find_comment(pos, start_token, end_token)
 
 def generic_comment_toggle(editor, comment_start, comment_end, range_start, range_end):
 	"""
@@ -25,18 +25,57 @@ Created on Apr 17, 2009
 @author: Sergey Chikuyonok (http://chikuyonok.ru)
 '''
 from zen_settings import zen_settings
+from lru_cache import LRUCache
+import contextlib
 import re
 import stparser
-
-newline = '\n'
-"Newline symbol"
-
-caret_placeholder = '{%::zen-caret::%}'
+import threading
+import time
 
 default_tag = 'div'
 
 re_tag = re.compile(r'<\/?[\w:\-]+(?:\s+[\w\-:]+(?:\s*=\s*(?:(?:"[^"]*")|(?:\'[^\']*\')|[^>\s]+))?)*\s*(\/?)>$')
 
+re_tag_reversed = re.compile(r'>\/?\s*(?:(?:(?:(?:"[^"]*")|(?:\'[^\']*\')|[^>\s]+)\s*=\s*)?[\w\-:]+\s+)*[\w:\-]+\/?<')
+"<code>re_tag</code> for reversed text: matches tag that ends at given position"
+
+re_variable = re.compile(r'\$\{([\w\-]+)\}')
+
+re_partial_variable = re.compile(r'\$(?:\{[\w\-]*)?$')
+"Beginning of variable at the end of output chunk"
+
+_filter_pipelines = {}
+"Compiled filter chains, see <code>compile_filters()</code>"
+
+re_counter_token = re.compile(r'[\\$]')
+"Counter or escaped character"
+
+_counter_templates = {}
+"Compiled counter templates, see <code>render_counter()</code>"
+
+re_tabstop = re.compile(r'\$(\d+)|\$\{(\d+):[^\}]+\}')
+
+re_filters = re.compile(r'\|([\w\|\-]+)\Z')
+"Filters at the end of abbreviation, like <code>div|e|c</code>"
+
+# character sets used by abbreviation parser
+_lower_chars = frozenset('abcdefghijklmnopqrstuvwxyz')
+_digit_chars = frozenset('0123456789')
+_alnum_chars = _lower_chars | frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZ') | _digit_chars | frozenset('_')
+_expando_chars = _lower_chars | _digit_chars
+_name_start_chars = _alnum_chars - _digit_chars - frozenset('_') | frozenset('@!#.')
+_name_chars = _alnum_chars | frozenset(':-$')
+_attr_chars = _alnum_chars | frozenset('-$')
+_word_chars = _name_chars
+
+_defaults = None
+"Context that new contexts and default contexts of threads copy from"
+
+_local = threading.local()
+"Active expansion context and default context of each thread"
+
+_empty_index = {'abbreviations': {}, 'snippets': {}, 'tags': {}, 'resources': {}, 'resource': {}, 'elements': {}}
+
 profiles = {}
 "Available output profiles"
 
@@ -60,8 +99,17 @@ default_profile = {
 basic_filters = 'html';
 "Filters that will be applied for unknown syntax"
 
-max_tabstop = 0
-"Maximum tabstop index for current session"
+stats_enabled = False
+"Collect expansion statistics, see <code>get_stats()</code>"
+
+_stats = {}
+"Statistics for each expansion phase"
+
+_stats_lock = threading.Lock()
+"Guards updates of statistics, which are shared by all threads"
+
+tree_cache = LRUCache(max_size=512, max_weight=50000, weigher=lambda tree: tree and tree.get_size() or 1)
+"Parsed abbreviation trees, see <code>parse_into_tree()</code>"
 
 def char_at(text, pos):
 	"""
@@ -125,11 +173,12 @@ def make_map(prop):
 	@param prop: Key name in <code>zen_settings['html']</code> dictionary
 	@type prop: str
 	"""
+	settings = get_context().settings
 	obj = {}
-	for a in zen_settings['html'][prop].split(','):
+	for a in settings['html'][prop].split(','):
 		obj[a] = True
 		
-	zen_settings['html'][prop] = obj
+	settings['html'][prop] = obj
 
 def create_profile(options):
 	"""
@@ -149,7 +198,7 @@ def setup_profile(name, options = {}):
 	@param options: Profile options
 	@type options: dict
 	"""
-	profiles[name.lower()] = create_profile(options);
+	get_context().profiles[name.lower()] = create_profile(options);
 
 def get_newline():
 	"""
@@ -157,14 +206,13 @@ def get_newline():
 	redefined to return current editor's settings 
 	@return: str
 	"""
-	return newline
+	return get_context().newline
 
 def set_newline(char):
 	"""
 	Sets newline character used in Zen Coding
 	"""
-	global newline
-	newline = char
+	get_context().newline = char
 
 def string_to_hash(text):
 	"""
@@ -240,7 +288,42 @@ def replace_variables(text): # (FM) use dynamic variables
 	@param text: str
 	@return: str
 	"""
-	return re.sub(r'\$\{([\w\-]+)\}', lambda m: get_variable(m.group(1)) or m.group(0), text)
+	return re_variable.sub(lambda m: get_variable(m.group(1)) or m.group(0), text)
+
+def _replace_variables_iter(chunks):
+	"""
+	Replace variables in stream of output chunks. Variable may be split 
+	between chunks, so the incomplete one is held until the next chunk 
+	@param chunks: Iterable of strings
+	@return: generator
+	"""
+	timed = stats_enabled
+	elapsed = 0.0
+	pending = ''
+	for chunk in chunks:
+		text = pending + chunk
+		pending = ''
+		if '$' in text:
+			m = re_partial_variable.search(text)
+			if m:
+				pending = text[m.start():]
+				text = text[:m.start()]
+			
+			if timed:
+				start = time.time()
+				text = replace_variables(text)
+				elapsed += time.time() - start
+			else:
+				text = replace_variables(text)
+			
+		if text:
+			yield text
+	
+	if pending:
+		yield replace_variables(pending)
+	
+	if timed:
+		_record_stats('variables', elapsed)
 
 def get_abbreviation(res_type, abbr):
 	"""
@@ -251,7 +334,7 @@ def get_abbreviation(res_type, abbr):
 	@type abbr: str
 	@return dict, None
 	"""
-	return get_settings_resource(res_type, abbr, 'abbreviations')
+	return _get_index(res_type)['abbreviations'].get(abbr)
 
 def get_snippet(res_type, snippet_name):
 	"""
@@ -262,22 +345,20 @@ def get_snippet(res_type, snippet_name):
 	@type snippet_name: str
 	@return dict, None
 	"""
-	return get_settings_resource(res_type, snippet_name, 'snippets');
+	return _get_index(res_type)['snippets'].get(snippet_name)
 
 def get_variable(name): # (FM) variable can be missing
 	"""
 	Returns variable value
 	 @return: str
 	"""
-	if name in zen_settings['variables']:
-		return zen_settings['variables'][name]
-	return None
+	return get_context().variables.get(name)
 
 def set_variable(name, value):
 	"""
 	Set variable value
 	"""
-	zen_settings['variables'][name] = value
+	get_context().variables[name] = value
 
 def get_indentation():
 	"""
@@ -296,6 +377,7 @@ def create_resource_chain(syntax, name):
 	@return: list
 	"""
 	result = []
+	zen_settings = get_context().settings
 	
 	if syntax in zen_settings:
 		resource = zen_settings[syntax]
@@ -319,8 +401,7 @@ def get_resource(syntax, name):
 	@param name: Resource name
 	@type name: str
 	"""
-	chain = create_resource_chain(syntax, name)
-	return chain[0] if chain else None
+	return _get_index(syntax)['resources'].get(name)
 
 def get_settings_resource(syntax, abbr, name):
 	"""
@@ -333,204 +414,403 @@ def get_settings_resource(syntax, abbr, name):
 	@type name: str
 	@return dict, None
 	"""
+	if name in ('abbreviations', 'snippets'):
+		return _get_index(syntax)[name].get(abbr)
+	
 	for item in create_resource_chain(syntax, name):
 		if abbr in item:
 			return item[abbr]
 		
 	return None
 
+def _get_index(syntax):
+	"""
+	Returns lookup index of syntax (see <code>stparser.create_index()</code>)
+	@type syntax: str
+	@return: dict
+	"""
+	return get_context().index.get(syntax, _empty_index)
+
+def _scan(text, pos, end, chars):
+	"""
+	Returns index of the first character after <code>pos</code> that is not
+	in <code>chars</code> set (or <code>end</code>)
+	@type text: str
+	@type pos: int
+	@type end: int
+	@type chars: frozenset
+	@return: int
+	"""
+	while pos < end and text[pos] in chars:
+		pos += 1
+	return pos
+
 def get_word(ix, text):
 	"""
 	Get word, starting at <code>ix</code> character of <code>text</code>
 	@param ix: int
 	@param text: str
 	"""
-	m = re.match(r'^[\w\-:\$]+', text[ix:])
-	return m.group(0) if m else ''
-	
-def extract_attributes(attr_set):
+	return text[ix:_scan(text, ix, len(text), _word_chars)]
+
+def _skip_spaces(text, pos, end):
+	while pos < end and text[pos].isspace():
+		pos += 1
+	return pos
+
+def _read_attribute_set(text, start, end, result):
 	"""
-	Extract attributes and their values from attribute set 
- 	@param attr_set: str
+	Extract attributes and their values from attribute set located between
+	<code>start</code> and <code>end</code> indexes of <code>text</code>
+	(without square braces) and append them to <code>result</code> as
+	<code>[name, value]</code> lists
+	@type text: str
+	@type start: int
+	@type end: int
+	@type result: list
 	"""
-	attr_set = attr_set.strip()
+	start = _skip_spaces(text, start, end)
+	while end > start and text[end - 1].isspace():
+		end -= 1
+	
 	loop_count = 100 # endless loop protection
-	re_string = r'^(["\'])((?:(?!\1)[^\\]|\\.)*)\1'
-	result = []
-		
-	while attr_set and loop_count:
+	while start < end and loop_count:
 		loop_count -= 1
-		attr_name = get_word(0, attr_set)
-		attr = None
-		if attr_name:
-			attr = {'name': attr_name, 'value': ''}
+		name_end = _scan(text, start, end, _word_chars)
+		if name_end == start:
+			# something wrong, can't extract attribute name
+			break
+		
+		attr = [text[start:name_end], '']
+		
+		# let's see if attribute has value
+		if name_end < end and text[name_end] == '=':
+			value_start = name_end + 1
+			if value_start >= end:
+				raise InvalidAbbreviation('Attribute value expected', value_start)
 			
-			# let's see if attribute has value
-			ch = attr_set[len(attr_name)] if len(attr_set) > len(attr_name) else ''
-			if ch == '=':
-				ch2 = attr_set[len(attr_name) + 1]
-				if ch2 in '"\'':
-					# we have a quoted string
-					m = re.match(re_string, attr_set[len(attr_name) + 1:])
-					if m:
-						attr['value'] = m.group(2)
-						attr_set = attr_set[len(attr_name) + len(m.group(0)) + 1:].strip()
-					else:
-						# something wrong, break loop
-						attr_set = ''
-				else:
-					# unquoted string
-					m = re.match(r'^(.+?)(\s|$)', attr_set[len(attr_name) + 1:])
-					if m:
-						attr['value'] = m.group(1)
-						attr_set = attr_set[len(attr_name) + len(m.group(1)) + 1:].strip()
-					else:
-						# something wrong, break loop
-						attr_set = ''
+			quote = text[value_start]
+			if quote in '"\'':
+				# we have a quoted string, backslash escapes any character
+				pos = value_start + 1
+				while pos < end and text[pos] != quote:
+					if text[pos] == '\\':
+						if pos + 1 >= end or text[pos + 1] == '\n':
+							pos = end
+							break
+						pos += 1
+					pos += 1
 				
+				if pos < end:
+					attr[1] = text[value_start + 1:pos]
+					start = _skip_spaces(text, pos + 1, end)
+				else:
+					# unterminated string, break loop
+					start = end
+			elif quote != '\n':
+				# unquoted string: up to the next space
+				pos = value_start + 1
+				while pos < end and not text[pos].isspace():
+					pos += 1
+				attr[1] = text[value_start:pos]
+				start = _skip_spaces(text, pos, end)
 			else:
-				attr_set = attr_set[len(attr_name):].strip()
+				start = end
 		else:
-			# something wrong, can't extract attribute name
-			break
+			start = _skip_spaces(text, name_end, end)
 		
-		if attr: result.append(attr)
+		result.append(attr)
 		
 	return result
 
-def parse_attributes(text):
+def _read_attributes(text, start, end):
 	"""
-	Parses tag attributes extracted from abbreviation
+	Parses tag attributes (like <code>#header.some.data[attr=value]</code>)
+	located between <code>start</code> and <code>end</code> indexes of
+	<code>text</code>
+	@return: list of <code>[name, value]</code> lists
 	"""
-	
-#	Example of incoming data:
-#	#header
-#	.some.data
-#	.some.data#header
-#	[attr]
-#	#item[attr=Hello other="World"].class
-
 	result = []
-	class_name = None
-	char_map = {'#': 'id', '.': 'class'}
+	class_attr = None
 	
 	# walk char-by-char
-	i = 0
-	il = len(text)
-		
-	while i < il:
+	i = start
+	while i < end:
 		ch = text[i]
 		
 		if ch == '#': # id
-			val = get_word(i, text[1:])
-			result.append({'name': char_map[ch], 'value': val})
-			i += len(val) + 1
+			word_end = _scan(text, i + 1, end, _word_chars)
+			result.append(['id', text[i + 1:word_end]])
+			i = word_end
 			
-		elif ch == '.': #class
-			val = get_word(i, text[1:])
-			if not class_name:
+		elif ch == '.': # class
+			word_end = _scan(text, i + 1, end, _word_chars)
+			val = text[i + 1:word_end]
+			if not class_attr:
 				# remember object pointer for value modification
-				class_name = {'name': char_map[ch], 'value': ''}
-				result.append(class_name)
+				class_attr = ['class', '']
+				result.append(class_attr)
 			
-			if class_name['value']:
-				class_name['value'] += ' ' + val
+			if class_attr[1]:
+				class_attr[1] += ' ' + val
 			else:
-				class_name['value'] = val
+				class_attr[1] = val
+			
+			i = word_end
 			
-			i += len(val) + 1
-				
 		elif ch == '[': # begin attribute set
 			# search for end of set
-			end_ix = text.find(']', i)
+			end_ix = text.find(']', i, end)
 			if end_ix == -1:
 				# invalid attribute set, stop searching
-				i = len(text)
-			else:
-				result.extend(extract_attributes(text[i + 1:end_ix]))
-				i = end_ix
+				break
+			
+			_read_attribute_set(text, i + 1, end_ix, result)
+			i = end_ix + 1
 		else:
 			i += 1
-		
-		
+	
 	return result
 
-class AbbrGroup(object):
+def extract_attributes(attr_set):
 	"""
-	Abreviation's group element
+	Extract attributes and their values from attribute set 
+ 	@param attr_set: str
 	"""
-	def __init__(self, parent=None):
-		"""
-		@param parent: Parent group item element
-		@type parent: AbbrGroup
-		"""
-		self.expr = ''
-		self.parent = parent
-		self.children = []
+	return [{'name': name, 'value': value} for name, value in _read_attribute_set(attr_set, 0, len(attr_set), [])]
+
+def parse_attributes(text):
+	"""
+	Parses tag attributes extracted from abbreviation
+	"""
+	
+#	Example of incoming data:
+#	#header
+#	.some.data
+#	.some.data#header
+#	[attr]
+#	#item[attr=Hello other="World"].class
+
+	return [{'name': name, 'value': value} for name, value in _read_attributes(text, 0, len(text))]
+
+def _find_expando(text, start, end, doc_type):
+	"""
+	Search for expando (like <code>ul+</code>) at the end of group expression
+	@return: Expando start index and its value or None
+	"""
+	if end - start < 2 or text[end - 1] != '+':
+		return None
+	
+	expando_start = end - 1
+	while expando_start > start and text[expando_start - 1] in _expando_chars:
+		expando_start -= 1
 		
-	def add_child(self):
-		child = AbbrGroup(self)
-		self.children.append(child)
-		return child
+	# expando name must start with a letter
+	while expando_start < end - 1 and text[expando_start] not in _lower_chars:
+		expando_start += 1
 	
-	def clean_up(self):
-		for item in self.children:
-			expr = item.expr
-			if not expr:
-				self.children.remove(item)
+	if expando_start == end - 1:
+		return None
+		
+	a = get_abbreviation(doc_type, text[expando_start:end])
+	return a and (expando_start, a.value) or None
+
+def _parse_expression(text, start, end, parent, root, doc_type, offset=0):
+	"""
+	Parses group expression (abbreviation part without parenthesis, like
+	<code>div#header>ul.nav>li*3</code>) located between <code>start</code>
+	and <code>end</code> indexes of <code>text</code> and adds resulting
+	elements into <code>parent</code>
+	@param offset: Position of <code>text</code> inside abbreviation,
+	used for error reporting
+	@return: Last added element
+	"""
+	expando = _find_expando(text, start, end, doc_type)
+	if expando:
+		# replace expando with its value
+		expando_start, value = expando
+		text = text[start:expando_start] + value
+		offset += start
+		start, end = 0, len(text)
+	
+	last = None
+	i = start
+	
+	while i < end:
+		# operator
+		operator = text[i]
+		if operator == '+' or operator == '>':
+			i += 1
+		else:
+			operator = None
+		
+		# element name
+		if i == end or text[i] not in _name_start_chars:
+			raise InvalidAbbreviation('Element name expected', min(offset + i, offset + end - 1))
+		
+		name_start = i
+		name_end = _scan(text, i + 1, end, _name_chars)
+		
+		# attributes: #id, .class and [attr=value] sets
+		i = name_end
+		while i + 1 < end:
+			ch = text[i]
+			if (ch == '#' or ch == '.') and text[i + 1] in _attr_chars:
+				i = _scan(text, i + 2, end, _attr_chars)
+			elif ch == '[' and text[i + 1] != ']':
+				close_ix = text.find(']', i + 2, end)
+				if close_ix == -1:
+					break
+				i = close_ix + 1
+			else:
+				break
+		attrs_end = i
+		
+		# multiplier
+		count = 1
+		multiply_by_lines = False
+		if i < end and text[i] == '*':
+			digits_start = i + 1
+			i = _scan(text, digits_start, end, _digit_chars)
+			if i > digits_start:
+				count = int(text[digits_start:i]) or 1
 			else:
-				# remove operators at the and of expression
-				item.clean_up()
+				multiply_by_lines = True
+		
+		tag_name = text[name_start:name_end]
+		attrs_start = name_end
+		if tag_name[0] == '#' or tag_name[0] == '.':
+			attrs_start = name_start
+			tag_name = default_tag
+		
+		if i == end - 1 and text[i] == '+':
+			# unresolved expando
+			tag_name += '+'
+			i = end
+		
+		current = is_snippet(tag_name, doc_type) and Snippet(tag_name, count, doc_type) or Tag(tag_name, count, doc_type)
+		
+		for name, value in _read_attributes(text, attrs_start, attrs_end):
+			current.add_attribute(name, value)
+		
+		# dive into tree
+		if operator == '>' and last:
+			parent = last
+		
+		parent.add_child(current)
+		last = current
+		
+		if multiply_by_lines:
+			root.multiply_elem = current
+	
+	return last
+
+def parse_abbreviation(abbr, doc_type='html'):
+	"""
+	Parses abbreviation into a node set. Unlike <code>parse_into_tree()</code>,
+	this function doesn't use cache and raises <code>InvalidAbbreviation</code>
+	error with the position of invalid character if abbreviation can't be
+	parsed
+	@param abbr: Abbreviation to transform
+	@type abbr: str
+	@param doc_type: Document type (xsl, html), a key of dictionary where to
+	search abbreviation settings
+	@type doc_type: str
+	@return: Tag
+	"""
+	tree_root = Tag('', 1, doc_type)
+	tree_root.last = None
+	
+	# filters at the end of abbreviation
+	m = re_filters.search(abbr)
+	if m:
+		abbr_len = m.start()
+		tree_root.filters = m.group(1)
+	else:
+		abbr_len = len(abbr)
+		tree_root.filters = ''
+	
+	_parse_groups(abbr, 0, abbr_len, tree_root, tree_root, doc_type)
+	return tree_root
 
-def split_by_groups(abbr):
+def _parse_groups(abbr, start, end, group_parent, root, doc_type):
 	"""
-	Split abbreviation by groups
+	Parses part of abbreviation between <code>start</code> and
+	<code>end</code> indexes, with its nested groups, and adds resulting
+	elements into <code>group_parent</code>
 	@type abbr: str
-	@return: AbbrGroup
+	@type group_parent: Tag
+	@param root: Root of parsed tree, its <code>last</code> property is
+	set to the last parsed element
+	@type root: Tag
 	"""
-	root = AbbrGroup()
-	last_parent = root
-	cur_item = root.add_child()
+	# last element of current expression: the parent of nested groups
+	last = None
 	stack = []
-	i = 0
-	il = len(abbr)
+	i = start
 	
-	while i < il:
+	while i < end:
 		ch = abbr[i]
 		if ch == '(':
 			# found new group
-			operator = i and abbr[i - 1] or ''
-			if operator == '>':
-				stack.append(cur_item)
-				last_parent = cur_item
-			else:
-				stack.append(last_parent)
-			cur_item = None
+			if i and abbr[i - 1] == '>':
+				group_parent = last
+			
+			stack.append((group_parent, len(group_parent.children), i))
+			last = None
+			i += 1
 		elif ch == ')':
-			last_parent = stack.pop()
-			cur_item = None
-			next_char = char_at(abbr, i + 1)
-			if next_char == '+' or next_char == '>': 
-				# next char is group operator, skip it
+			if not stack:
+				raise InvalidAbbreviation('Unexpected closing parenthesis', i)
+			
+			group_parent, group_start, group_open = stack.pop()
+			group_end = i
+			last = None
+			i += 1
+			if i < end and abbr[i] == '*':
+				digits_end = _scan(abbr, i + 1, end, _digit_chars)
+				count = int(abbr[i + 1:digits_end] or 1) or 1
+				_repeat_group(abbr, group_open + 1, group_end, group_parent, group_start, count, root, doc_type)
+				i = digits_end
+			if i < end and (abbr[i] == '+' or abbr[i] == '>'):
+				# group operator, skip it
 				i += 1
 		else:
-			if ch == '+' or ch == '>':
+			# group expression runs up to the next parenthesis
+			expr_end = i
+			while expr_end < end and abbr[expr_end] != '(' and abbr[expr_end] != ')':
+				expr_end += 1
+			
+			next_ix = expr_end
+			if expr_end < end and abbr[expr_end] == '(' and abbr[expr_end - 1] in '+>':
 				# skip operator if it's followed by parenthesis
-				next_char = char_at(abbr, i + 1)
-				if next_char == '(':
-					i += 1 
-					continue
+				expr_end -= 1
 			
-			if not cur_item:
-				cur_item = last_parent.add_child()
-			cur_item.expr += ch
+			if expr_end > i:
+				if not group_parent:
+					raise InvalidAbbreviation('Group has no parent element', i)
+				last = _parse_expression(abbr, i, expr_end, group_parent, root, doc_type)
+				root.last = last
 			
-		i += 1
-	
-	root.clean_up()
-	return root
+			i = next_ix
+
+def _repeat_group(abbr, start, end, group_parent, group_start, count, root, doc_type):
+	"""
+	Adds <code>count - 1</code> more copies of multiplied group, whose first
+	copy is <code>group_parent</code> children from <code>group_start</code>.
+	Every copy is parsed again, so it has its own elements, and copy's
+	counters continue after the highest counter of the first copy: 
+	<code>(li.a$+li.b$*2)*2</code> is li.a1, li.b1, li.b2, li.a3, li.b3, li.b4
+	"""
+	group = group_parent.children[group_start:]
+	step = max([tag.counter + tag.count - 1 for tag in group] or [1])
+	for copy in range(1, count):
+		copy_start = len(group_parent.children)
+		_parse_groups(abbr, start, end, group_parent, root, doc_type)
+		for tag in group_parent.children[copy_start:]:
+			tag.counter += copy * step
 
-def rollout_tree(tree, parent=None):
+def rollout_tree(tree, parent=None, wrapped=None, virtual=False):
 	"""
 	Roll outs basic Zen Coding tree into simplified, DOM-like tree.
 	The simplified tree, for example, represents each multiplied element 
@@ -544,9 +824,25 @@ def rollout_tree(tree, parent=None):
 	 
 	@type tree: Tag
 	@param parent: ZenNode
+	@param wrapped: Content to place inside one of the tree elements instead 
+	of its own content, as <code>(tag, content, repeat_by_lines)</code> tuple.
+	Parsed trees are cached and shared, so they must not be modified
+	@type wrapped: tuple
+	@param virtual: Represent multiplied elements as repeat nodes (see
+	<code>ZenNode.repeat</code>) instead of separate copies. Only filters that
+	support repeat nodes can be applied to such tree
+	@type virtual: bool
 	"""
 	if not parent:
 		parent = ZenNode(tree)
+		if virtual:
+			parent.deferred = []
+		
+		if stats_enabled:
+			start = time.time()
+			rollout_tree(tree, parent, wrapped, virtual)
+			_record_stats('rollout', time.time() - start, _count_nodes(parent))
+			return parent
 		
 	how_many = 1
 	tag_content = ''
@@ -554,20 +850,29 @@ def rollout_tree(tree, parent=None):
 	for child in tree.children:
 		how_many = child.count
 		
-		if child.repeat_by_lines:
+		if wrapped and child is wrapped[0]:
+			content, repeat_by_lines = wrapped[1], wrapped[2]
+		else:
+			content, repeat_by_lines = child.get_content(), child.repeat_by_lines
+		
+		if repeat_by_lines:
 			# it's a repeating element
-			tag_content = split_by_lines(child.get_content(), True)
+			tag_content = split_by_lines(content, True)
 			how_many = max(len(tag_content), 1)
 		else:
-			tag_content = child.get_content()
+			tag_content = content
+			
+		if virtual and _can_repeat(tag_content):
+			_rollout_repeat(child, parent, how_many, tag_content, wrapped)
+			continue
 		
 		for j in range(how_many):
 			tag = ZenNode(child)
 			parent.add_child(tag)
-			tag.counter = j + 1
+			tag.counter = child.counter + j
 			
 			if child.children:
-				rollout_tree(child, tag)
+				rollout_tree(child, tag, wrapped, virtual and not (wrapped and child is wrapped[0]))
 				
 			add_point = tag.find_deepest_child() or tag
 			
@@ -579,135 +884,295 @@ def rollout_tree(tree, parent=None):
 					
 	return parent
 
-def run_filters(tree, profile, filter_list):
+def _can_repeat(tag_content):
 	"""
-	Runs filters on tree
+	Test if element with per-copy content lines can be represented as 
+	repeat node: lines must not affect output formatting
+	@type tag_content: str, list
+	@return: bool
+	"""
+	if isinstance(tag_content, list):
+		for line in tag_content:
+			if line and re_tag.search(line):
+				return False
+			
+	return True
+
+def _rollout_repeat(tree, parent, how_many, tag_content, wrapped):
+	"""
+	Roll outs multiplied element as repeat node, storing its subtree only 
+	once. The very first copy of top-level element is formatted differently, 
+	so it's rolled out as separate node
+	@type tree: Tag
+	@type parent: ZenNode
+	@type how_many: int
+	@param tag_content: Content of each copy, or list of contents
+	@type tag_content: str, list
+	@type wrapped: tuple
+	"""
+	ranges = [(0, how_many)]
+	if how_many > 1 and not parent.parent:
+		ranges = [(0, 1), (1, how_many)]
+	
+	# content goes to the deepest child of the wrapped element's copies,
+	# so its subtree must be rolled out completely
+	is_wrapped = wrapped and tree is wrapped[0]
+		
+	for first, last in ranges:
+		tag = ZenNode(tree)
+		parent.add_child(tag)
+		tag.counter = tree.counter + first
+		tag.repeat = last - first
+		
+		if tree.children:
+			rollout_tree(tree, tag, wrapped, not is_wrapped)
+			
+		add_point = tag.find_deepest_child() or tag
+		
+		if tag_content:
+			if isinstance(tag_content, basestring):
+				add_point.content = tag_content
+			elif tag.repeat == 1:
+				add_point.content = tag_content[first] or ''
+			else:
+				add_point.lines = [line or '' for line in tag_content[first:last]]
+
+def materialize_tree(tree):
+	"""
+	Replaces repeat nodes of tree, rolled out with <code>virtual</code> 
+	option, with separate copies and performs operations deferred by filters. 
+	The result is the same as if tree was rolled out without repeat nodes 
+	and processed by the same filters 
 	@type tree: ZenNode
-	@param profile: str, object
-	@param filter_list: str, list
 	@return: ZenNode
 	"""
-	import filters
+	ops = tree.deferred or ()
+	children = tree.children
+	tree.children = []
+	_materialize_children(children, tree, 0, ops, [0] * len(ops))
+	tree.deferred = None
+	return tree
+
+def _materialize_children(children, parent, line, ops, offsets):
+	"""
+	Adds copies of each child to <code>parent</code>
+	@type children: list
+	@type parent: ZenNode
+	@param line: Index of content line of current copy
+	@type line: int
+	"""
+	for child in children:
+		for copy in range(child.repeat):
+			copy_line = copy if child.repeat > 1 else line
+				
+			tag = ZenNode(child.source)
+			parent.add_child(tag)
+			tag.counter = child.counter + copy
+			tag.padding = child.padding
+			
+			start, end = child.start, child.end
+			content = child.lines[copy_line] if child.lines else child.content
+			if ops:
+				start, end, content = _finalize_output(ops, offsets, start, end, content, tag.counter)
+			
+			tag.start, tag.end, tag.content = start, end, content
+			_materialize_children(child.children, tag, copy_line, ops, offsets)
+
+def _supports_repeat(filter_list):
+	"""
+	Test if all filters from list can process repeat nodes
+	@param filter_list: str, list
+	@return: bool
+	"""
+	if callable(get_context().caret_placeholder):
+		# each element copy may get its own placeholder
+		return False
 	
-	if isinstance(profile, basestring) and profile in profiles:
-		profile = profiles[profile];
+	return compile_filters(filter_list)['supports_repeat']
+
+def compile_filters(filter_list, virtual=False):
+	"""
+	Compiles filter chain into list of stages. Filters that declare per-node 
+	<code>enter</code> and <code>leave</code> hooks are fused, so each stage 
+	traverses tree only once. New stage is started when filter is already 
+	used in current stage, when filter has <code>process</code> function 
+	only, or when filter can't process repeat nodes of virtual tree. 
+	Compiled chains are cached
+	@param filter_list: str, list
+	@param virtual: Tree is rolled out with repeat nodes
+	@type virtual: bool
+	@return: dict with <code>stages</code> list and <code>supports_repeat</code> 
+	flag (all filters can process repeat nodes)
+	"""
+	import filters
 	
-	if not profile:
-		profile = profiles['plain']
-		
+	key = None
 	if isinstance(filter_list, basestring):
-		filter_list = re.split(r'[\|,]', filter_list)
+		key = (filter_list, virtual)
+		if key in _filter_pipelines:
+			return _filter_pipelines[key]
 		
+		filter_list = re.split(r'[\|,]', filter_list)
+	
+	# add filters that others depend on, like '_format' for 'html'
+	modules = []
 	for name in filter_list:
 		name = name.strip()
-		if name and name in filters.filter_map:
-			tree = filters.filter_map[name](tree, profile)
+		module = name and filters.get_filter(name)
+		if module:
+			for dep in getattr(module, 'depends', ()):
+				modules.append((dep, filters.get_filter(dep)))
+			modules.append((name, module))
+	
+	stages = []
+	stage = None
+	supports_repeat = True
+	
+	for name, module in modules:
+		enter = getattr(module, 'enter', None)
+		leave = getattr(module, 'leave', None)
+		aware = getattr(module, 'supports_repeat', False)
+		supports_repeat = supports_repeat and aware
+		
+		if not enter and not leave:
+			stages.append({'process': module.process, 'name': name, 'hooks': None, 'materialize': virtual and not aware})
+			stage = None
+		else:
+			if stage is None or name in stage['names'] or (virtual and not aware):
+				stage = {'process': None, 'hooks': [], 'names': {}, 'materialize': virtual and not aware}
+				stages.append(stage)
 			
-	return tree
+			stage['names'][name] = True
+			stage['hooks'].append((name, getattr(module, 'begin', None), enter, leave))
+			
+		if virtual and not aware:
+			# tree is materialized at this point
+			virtual = False
+	
+	result = {'stages': stages, 'supports_repeat': supports_repeat}
+	
+	if key:
+		if len(_filter_pipelines) >= 256:
+			_filter_pipelines.clear()
+		_filter_pipelines[key] = result
+		
+	return result
 
-def abbr_to_primary_tree(abbr, doc_type='html'):
+def register_filter(name, module):
 	"""
-	Transforms abbreviation into a primary internal tree. This tree should'n 
-	be used ouside of this scope
-	@param abbr: Abbreviation to transform
-	@type abbr: str
-	@param doc_type: Document type (xsl, html), a key of dictionary where to
-	search abbreviation settings
-	@type doc_type: str
-	@return: Tag
+	Registers output filter, which can be used in filter chains afterwards
+	@param name: Filter name, like 'html' or 'c'
+	@type name: str
+	@param module: Filter module (or any object with filter functions) or
+	its import name, which will be imported on first use
+	@type module: module, str
 	"""
-	root = Tag('', 1, doc_type)
-	token = re.compile(r'([\+>])?([a-z@\!\#\.][\w:\-\$]*)((?:(?:[#\.][\w\-\$]+)|(?:\[[^\]]+\]))+)?(\*(\d*))?(\+$)?', re.IGNORECASE)
+	import filters
 	
-	if not abbr:
-		return None
+	filters.register_filter(name, module)
+	_filter_pipelines.clear()
+
+def run_filters(tree, profile, filter_list):
+	"""
+	Runs filters on tree
+	@type tree: ZenNode
+	@param profile: str, object
+	@param filter_list: str, list
+	@return: ZenNode
+	"""
+	profiles = get_context().profiles
+	if isinstance(profile, basestring) and profile in profiles:
+		profile = profiles[profile];
 	
-	def expando_replace(m):
-		ex = m.group(0)
-		a = get_abbreviation(doc_type, ex)
-		return a and a.value or ex
-		
-	def token_expander(operator, tag_name, attrs, has_multiplier, multiplier, has_expando):
-		multiply_by_lines = (has_multiplier and not multiplier)
-		multiplier = multiplier and int(multiplier) or 1
-		
-		tag_ch = tag_name[0]
-		if tag_ch == '#' or tag_ch == '.':
-			if attrs: attrs = tag_name + attrs
-			else: attrs = tag_name
-			tag_name = default_tag
-		
-		if has_expando:
-			tag_name += '+'
-		
-		current = is_snippet(tag_name, doc_type) and Snippet(tag_name, multiplier, doc_type) or Tag(tag_name, multiplier, doc_type)
-		
-		if attrs:
-			attrs = parse_attributes(attrs)
-			for attr in attrs:
-				current.add_attribute(attr['name'], attr['value'])
+	if not profile:
+		profile = profiles['plain']
+	
+	virtual = tree is not None and tree.deferred is not None
+	timed = stats_enabled
+	if timed:
+		total = time.time()
+	
+	for stage in compile_filters(filter_list, virtual)['stages']:
+		if stage['materialize'] and tree.deferred is not None:
+			materialize_tree(tree)
+		
+		if stage['process']:
+			if timed:
+				start = time.time()
+			tree = stage['process'](tree, profile)
+			if timed:
+				_record_stats('filter:' + stage['name'], time.time() - start)
+			continue
 			
-		# dive into tree
-		if operator == '>' and token_expander.last:
-			token_expander.parent = token_expander.last;
+		enters = []
+		leaves = []
+		timers = []
+		for name, begin, enter, leave in stage['hooks']:
+			if timed:
+				# time spent in filter's hooks is summed in timer
+				timer = [0.0]
+				timers.append((name, timer))
+				begin = begin and _timed_hook(begin, timer)
+				enter = enter and _timed_hook(enter, timer)
+				leave = leave and _timed_hook(leave, timer)
 			
-		token_expander.parent.add_child(current)
-		token_expander.last = current
-		
-		if multiply_by_lines:
-			root.multiply_elem = current
+			state = begin and begin(tree, profile)
+			if enter:
+				enters.append((enter, state))
+			if leave:
+				leaves.append((leave, state))
 		
-		return ''
+		_walk_tree(tree, profile, 0, enters, leaves)
 		
-	# replace expandos
-	abbr = re.sub(r'([a-z][a-z0-9]*)\+$', expando_replace, abbr)
-	
-	token_expander.parent = root
-	token_expander.last = None
-	
+		if timers:
+			nodes = _count_nodes(tree) - 1
+			for name, timer in timers:
+				_record_stats('filter:' + name, timer[0], nodes)
 	
-#	abbr = re.sub(token, lambda m: token_expander(m.group(1), m.group(2), m.group(3), m.group(4), m.group(5), m.group(6), m.group(7)), abbr)
-	# Issue from Einar Egilsson
-	abbr = token.sub(lambda m: token_expander(m.group(1), m.group(2), m.group(3), m.group(4), m.group(5), m.group(6)), abbr)
-	
-	root.last = token_expander.last
-	
-	# empty 'abbr' variable means that abbreviation was expanded successfully, 
-	# non-empty variable means there was a syntax error
-	return not abbr and root or None;
+	if timed:
+		_record_stats('filters', time.time() - total)
+			
+	return tree
 
-def expand_group(group, doc_type, parent):
-	"""
-	Expand single group item 
-	@param group: AbbrGroup
-	@param doc_type: str
-	@param parent: Tag
+def _timed_hook(hook, timer):
+	"""
+	Wraps filter hook so time spent in it is added to timer
+	@type hook: function
+	@param timer: One-item list with time in seconds
+	@type timer: list
+	@return: function
+	"""
+	def timed_hook(*args):
+		start = time.time()
+		try:
+			return hook(*args)
+		finally:
+			timer[0] += time.time() - start
+	
+	return timed_hook
+
+def _walk_tree(node, profile, level, enters, leaves):
 	"""
-	tree = abbr_to_primary_tree(group.expr, doc_type)
-	last_item = None
-		
-	if tree:
-		for item in tree.children:
-			last_item = item
-			parent.add_child(last_item)
-	else:
-		raise Exception('InvalidGroup')
-	
-	
-	# set repeating element to the topmost node
-	root = parent
-	while root.parent:
-		root = root.parent
-	
-	root.last = tree.last
-	if tree.multiply_elem:
-		root.multiply_elem = tree.multiply_elem
-		
-	# process child groups
-	if group.children:
-		add_point = last_item.find_deepest_child() or last_item
-		for child in group.children:
-			expand_group(child, doc_type, add_point)
+	Calls filter hooks for each descendant of node: <code>enter</code> hooks 
+	before and <code>leave</code> hooks after its children are processed
+	@type node: ZenNode
+	@type profile: dict
+	@param level: Depth level
+	@type level: int
+	@param enters: List of (hook, state) tuples
+	@type enters: list
+	@param leaves: List of (hook, state) tuples
+	@type leaves: list
+	"""
+	for index, item in enumerate(node.children):
+		for hook, state in enters:
+			hook(item, profile, level, index, state)
+		
+		if item.children:
+			_walk_tree(item, profile, level + 1, enters, leaves)
+		
+		for hook, state in leaves:
+			hook(item, profile, level, index, state)
 
 def replace_unescaped_symbol(text, symbol, replace):
 	"""
@@ -717,44 +1182,58 @@ def replace_unescaped_symbol(text, symbol, replace):
 	@type text: str
 	@param symbol: Symbol to replace
 	@type symbol: st
-	@param replace: Symbol replacement
+	@param replace: Symbol replacement. Function receives original text,
+	symbol, symbol position and match number and returns tuple of matched
+	string and its replacement, or None to leave symbol as is
 	@type replace: str, function 
 	@return: str
 	"""
-	i = 0
-	il = len(text)
 	sl = len(symbol)
 	match_count = 0
+	result = []
+	last = 0
+	i = 0
+	
+	while True:
+		# jump to the next escape or symbol
+		escape_pos = text.find('\\', i)
+		i = text.find(symbol, i)
+		if i == -1 or (escape_pos != -1 and escape_pos < i):
+			i = escape_pos
+		if i == -1:
+			break
 		
-	while i < il:
 		if text[i] == '\\':
 			# escaped symbol, skip next character
 			i += sl + 1
-		elif text[i:i + sl] == symbol:
-			# have match
-			cur_sl = sl
-			match_count += 1
-			new_value = replace
-			if callable(new_value):
-				replace_data = replace(text, symbol, i, match_count)
-				if replace_data:
-					cur_sl = len(replace_data[0])
-					new_value = replace_data[1]
-				else:
-					new_value = False
-			
-			if new_value is False: # skip replacement
-				i += 1
-				continue
-			
-			text = text[0:i] + new_value + text[i + cur_sl:]
-			# adjust indexes
-			il = len(text)
-			i += len(new_value)
-		else:
+			continue
+		
+		# have match
+		cur_sl = sl
+		match_count += 1
+		new_value = replace
+		if callable(new_value):
+			replace_data = replace(text, symbol, i, match_count)
+			if replace_data:
+				cur_sl = len(replace_data[0])
+				new_value = replace_data[1]
+			else:
+				new_value = False
+		
+		if new_value is False: # skip replacement
 			i += 1
+			continue
+		
+		result.append(text[last:i])
+		result.append(new_value)
+		i += cur_sl
+		last = i
+	
+	if not result:
+		return text
 	
-	return text
+	result.append(text[last:])
+	return ''.join(result)
 	
 def run_action(name, *args, **kwargs):
 	"""
@@ -780,23 +1259,158 @@ def expand_abbreviation(abbr, syntax='html', profile_name='plain'):
 	@type abbr: str
 	@return: str
 	"""
-	tree_root = parse_into_tree(abbr, syntax);
+	return ''.join(expand_abbreviation_iter(abbr, syntax, profile_name))
+
+def expand_abbreviation_iter(abbr, syntax='html', profile_name='plain'):
+	"""
+	Expands abbreviation and yields output in chunks, so large expansions 
+	may be written somewhere without building the whole string. Yields 
+	nothing if abbreviation is invalid
+	@type abbr: str
+	@return: generator
+	"""
+	tree_root = parse_into_tree(abbr, syntax)
 	if tree_root:
-		tree = rollout_tree(tree_root)
-		apply_filters(tree, syntax, profile_name, tree_root.filters)
-		return replace_variables(tree.to_string())
+		filter_list = get_filter_list(syntax, tree_root.filters)
+		tree = rollout_tree(tree_root, virtual=_supports_repeat(filter_list))
+		run_filters(tree, profile_name, filter_list)
+		for chunk in _output_iter(tree):
+			yield chunk
+
+def _output_iter(tree):
+	"""
+	Returns output chunks of rolled out and filtered tree, with variables
+	replaced
+	@type tree: ZenNode
+	@return: iterator
+	"""
+	if not stats_enabled:
+		return _replace_variables_iter(tree.iter_output())
+	
+	return _replace_variables_iter(_timed_iter('output', tree.iter_output(), _count_nodes(tree)))
+
+def _timed_iter(phase, iterable, nodes=0):
+	"""
+	Yields items of iterable and records time spent to produce them as 
+	<code>phase</code> statistics
+	@type phase: str
+	@return: generator
+	"""
+	elapsed = 0.0
+	iterator = iter(iterable)
+	while True:
+		start = time.time()
+		try:
+			item = iterator.next()
+		except StopIteration:
+			break
+		finally:
+			elapsed += time.time() - start
+		
+		yield item
 	
-	return ''
+	_record_stats(phase, elapsed, nodes)
+
+def expand_abbreviation_to(sink, abbr, syntax='html', profile_name='plain'):
+	"""
+	Expands abbreviation and writes result into file-like object
+	@param sink: Object with <code>write()</code> method
+	@type abbr: str
+	@return: bool, False if abbreviation is invalid
+	"""
+	written = False
+	for chunk in expand_abbreviation_iter(abbr, syntax, profile_name):
+		sink.write(chunk)
+		written = True
+	
+	return written
+
+def expand_many(abbreviations, syntax='html', profile_name='plain', processes=None, chunk_size=1000):
+	"""
+	Expands list of abbreviations, like a static site build does. Each
+	distinct abbreviation is parsed and rendered once per batch. Large
+	batches may be expanded by a <code>multiprocessing</code> pool, in
+	chunks of distinct abbreviations. An error in one abbreviation doesn't
+	abort the batch, it's reported in the abbreviation's result
+	@param abbreviations: Abbreviations to expand
+	@type abbreviations: list
+	@param processes: Number of worker processes, None or 1 to expand in
+	current process. Pool is used only if batch has more than
+	<code>chunk_size</code> distinct abbreviations
+	@type processes: int
+	@param chunk_size: Number of distinct abbreviations sent to worker at once
+	@type chunk_size: int
+	@return: list of (output, error) tuples in the same order as
+	<code>abbreviations</code>. <code>error</code> is None on success,
+	otherwise it's an exception (<code>InvalidAbbreviation</code> for
+	syntax errors) and <code>output</code> is empty string
+	"""
+	unique = []
+	positions = {}
+	for abbr in abbreviations:
+		if abbr not in positions:
+			positions[abbr] = len(unique)
+			unique.append(abbr)
+
+	if processes and processes > 1 and len(unique) > chunk_size:
+		import multiprocessing
+
+		chunks = [(unique[i:i + chunk_size], syntax, profile_name)
+				for i in range(0, len(unique), chunk_size)]
+		pool = multiprocessing.Pool(processes)
+		try:
+			results = []
+			for chunk_results in pool.map(_expand_chunk, chunks):
+				results.extend(chunk_results)
+		finally:
+			pool.terminate()
+	else:
+		results = _expand_chunk((unique, syntax, profile_name))
+
+	return [results[positions[abbr]] for abbr in abbreviations]
+
+def _expand_chunk(args):
+	"""
+	Expands distinct abbreviations for <code>expand_many()</code>. It's a
+	module-level function so it may be sent to worker process
+	@param args: Tuple of abbreviations list, syntax and profile name
+	@type args: tuple
+	@return: list of (output, error) tuples
+	"""
+	abbreviations, syntax, profile_name = args
+	profile = get_profile(profile_name)
+	results = []
+
+	for abbr in abbreviations:
+		try:
+			tree_root = parse_into_tree(abbr, syntax)
+			if not tree_root:
+				# cached trees don't keep errors, parse again to get one
+				parse_abbreviation(abbr, syntax)
+				raise InvalidAbbreviation('Invalid abbreviation', 0)
+
+			filter_list = get_filter_list(syntax, tree_root.filters)
+			tree = rollout_tree(tree_root, virtual=_supports_repeat(filter_list))
+			run_filters(tree, profile, filter_list)
+			results.append((''.join(_output_iter(tree)), None))
+		except Exception as error:
+			results.append(('', error))
+
+	return results
 
 def extract_abbreviation(text):
 	"""
-	Extracts abbreviations from text stream, starting from the end
+	Extracts abbreviations from text stream, starting from the end. Text is
+	scanned backwards in a single pass: tag endings are matched against
+	reversed text right at the '>' character, so text before it isn't 
+	copied or rescanned
 	@type text: str
 	@return: Abbreviation or empty string
 	"""
 	cur_offset = len(text)
 	start_index = -1
 	brace_count = 0
+	reversed_text = None
 	
 	while True:
 		cur_offset -= 1
@@ -813,9 +1427,19 @@ def extract_abbreviation(text):
 			brace_count -= 1
 		else:
 			if brace_count: 
-				# respect all characters inside attribute sets
+				# respect all characters inside attribute sets, jump to the 
+				# nearest bracket
+				cur_offset = max(text.rfind('[', 0, cur_offset), text.rfind(']', 0, cur_offset)) + 1
 				continue
-			if not is_allowed_char(ch) or (ch == '>' and is_ends_with_tag(text[0:cur_offset + 1])):
+			
+			if ch == '>':
+				if reversed_text is None:
+					reversed_text = text[::-1]
+				if re_tag_reversed.match(reversed_text, len(text) - cur_offset - 1):
+					# '>' ends a tag
+					start_index = cur_offset + 1
+					break
+			elif not is_allowed_char(ch):
 				# found stop symbol
 				start_index = cur_offset + 1
 				break
@@ -824,7 +1448,9 @@ def extract_abbreviation(text):
 
 def parse_into_tree(abbr, doc_type='html'):
 	"""
-	Parses abbreviation into a node set
+	Parses abbreviation into a node set. Parsed trees are cached in
+	<code>tree_cache</code>, so the same tree may be returned for subsequent
+	calls: it must not be modified
 	@param abbr: Abbreviation to transform
 	@type abbr: str
 	@param doc_type: Document type (xsl, html), a key of dictionary where to
@@ -832,30 +1458,40 @@ def parse_into_tree(abbr, doc_type='html'):
 	@type doc_type: str
 	@return: Tag
 	"""
-	# remove filters from abbreviation
-	filter_list = []
+	if stats_enabled:
+		start = time.time()
+		tree_root = _get_tree(abbr, doc_type)
+		_record_stats('parse', time.time() - start, tree_root and tree_root.get_size() or 0)
+		return tree_root
 	
-	def filter_replace(m):
-		filter_list.append(m.group(1))
-		return ''
-	
-	re_filter = re.compile(r'\|([\w\|\-]+)$')
-	abbr = re_filter.sub(filter_replace, abbr)
+	return _get_tree(abbr, doc_type)
+
+def _get_tree(abbr, doc_type):
+	"""
+	Returns cached or parsed abbreviation tree, see <code>parse_into_tree()</code>
+	@return: Tag
+	"""
+	context = get_context()
+	if callable(context.caret_placeholder):
+		# generated placeholders may differ on each call, don't cache
+		return _parse_into_tree(abbr, doc_type)
 	
-	# split abbreviation by groups
-	group_root = split_by_groups(abbr)
-	tree_root = Tag('', 1, doc_type)
+	# attributes and snippets hold caret placeholder, so it's a part of the
+	# key, as well as settings of context
+	key = (abbr, doc_type, context.caret_placeholder, context.version, stparser.generation)
+	tree_root = tree_cache.get(key, tree_cache)
+	if tree_root is tree_cache:
+		tree_root = _parse_into_tree(abbr, doc_type)
+		tree_cache.put(key, tree_root)
 	
-	# then recursively expand each group item
+	return tree_root
+
+def _parse_into_tree(abbr, doc_type):
 	try:
-		for item in group_root.children:
-			expand_group(item, doc_type, tree_root)
+		return parse_abbreviation(abbr, doc_type)
 	except:
 		# there's invalid group, stop parsing
 		return None
-	
-	tree_root.filters = ''.join(filter_list)
-	return tree_root
 
 def is_inside_tag(html, cursor_pos):
 	re_tag = re.compile(r'^<\/?\w[\w\:\-]*.*?>')
@@ -894,12 +1530,11 @@ def wrap_with_abbreviation(abbr, text, doc_type='html', profile='plain'):
 	tree_root = parse_into_tree(abbr, doc_type)
 	if tree_root:
 		repeat_elem = tree_root.multiply_elem or tree_root.last
-		repeat_elem.set_content(text)
-		repeat_elem.repeat_by_lines = bool(tree_root.multiply_elem)
-		
-		tree = rollout_tree(tree_root)
-		apply_filters(tree, doc_type, profile, tree_root.filters);
-		return replace_variables(tree.to_string())
+		filter_list = get_filter_list(doc_type, tree_root.filters)
+		tree = rollout_tree(tree_root, wrapped=(repeat_elem, text, bool(tree_root.multiply_elem)),
+			virtual=_supports_repeat(filter_list))
+		run_filters(tree, profile, filter_list)
+		return ''.join(_output_iter(tree))
 	
 	return None
 
@@ -908,6 +1543,7 @@ def get_caret_placeholder():
 	Returns caret placeholder
 	@return: str
 	"""
+	caret_placeholder = get_context().caret_placeholder
 	if callable(caret_placeholder):
 		return caret_placeholder()
 	else:
@@ -921,8 +1557,7 @@ def set_caret_placeholder(value):
 	between them.
 	@param {String|Function}
 	"""
-	global caret_placeholder
-	caret_placeholder = value
+	get_context().caret_placeholder = value
 
 def apply_filters(tree, syntax, profile, additional_filters=None):
 	"""
@@ -938,6 +1573,17 @@ def apply_filters(tree, syntax, profile, additional_filters=None):
 	 
 	@return: ZenNode
 	"""
+	return run_filters(tree, profile, get_filter_list(syntax, additional_filters))
+
+def get_filter_list(syntax, additional_filters=None):
+	"""
+	Returns pipe-separated list of filters for syntax
+	@param syntax: Syntax name ('html', 'css', etc.)
+	@type syntax: str
+	@param additional_filters: List or pipe-separated string of additional filters to apply
+	@type additional_filters: str, list 
+	@return: str
+	"""
 	_filters = get_resource(syntax, 'filters') or basic_filters
 		
 	if additional_filters:
@@ -951,7 +1597,7 @@ def apply_filters(tree, syntax, profile, additional_filters=None):
 		# looks like unknown syntax, apply basic filters
 		_filters = basic_filters
 		
-	return run_filters(tree, profile, _filters)
+	return _filters
 
 def replace_counter(text, value):
 	"""
@@ -970,13 +1616,75 @@ def replace_counter(text, value):
 		
 		# replace sequense of $ symbols with padded number  
 		j = pos + 1
-		if j < len(text):
-			while tx[j] == '$' and char_at(tx, j + 1) != '{': j += 1
+		while j < len(tx) and tx[j] == '$' and char_at(tx, j + 1) != '{': j += 1
 		
 		return (tx[pos:j], value.zfill(j - pos))
 	
 	return replace_unescaped_symbol(text, symbol, replace_func)
 
+def compile_counter_template(text):
+	"""
+	Compiles text into list of segments: unescaped literal strings and 
+	counter slots (padding width of counter, int). Rendering of compiled 
+	template gives the same result as 
+	<code>unescape_text(replace_counter(text, value))</code>
+	@type text: str
+	@return: list
+	"""
+	segments = []
+	il = len(text)
+	last = 0
+	i = 0
+	
+	while True:
+		m = re_counter_token.search(text, i)
+		if not m:
+			break
+		
+		i = m.start()
+		if text[i] == '\\':
+			# escaped character
+			i += 2
+			continue
+		
+		next_char = char_at(text, i + 1)
+		if next_char == '{' or next_char.isdigit():
+			# it's a variable, skip it
+			i += 1
+			continue
+		
+		# sequence of $ symbols is replaced with padded number
+		j = i + 1
+		while j < il and text[j] == '$' and char_at(text, j + 1) != '{': j += 1
+		
+		segments.append(unescape_text(text[last:i]))
+		segments.append(j - i)
+		i = last = j
+	
+	segments.append(unescape_text(text[last:]))
+	return segments
+
+def render_counter(text, value):
+	"""
+	Replaces counters in text and unescapes it, same as
+	<code>unescape_text(replace_counter(text, value))</code>. Text is
+	compiled once, so rendering many copies of the same text is cheap
+	@type text: str
+	@type value: str, int
+	@return: str
+	"""
+	template = _counter_templates.get(text)
+	if template is None:
+		if len(_counter_templates) >= 2048:
+			_counter_templates.clear()
+		template = _counter_templates[text] = compile_counter_template(text)
+		
+	if len(template) == 1:
+		return template[0]
+	
+	value = str(value)
+	return ''.join([type(s) is int and value.zfill(s) or s for s in template])
+
 def upgrade_tabstops(node):
 	"""
 	Upgrades tabstops in zen node in order to prevent naming conflicts
@@ -985,20 +1693,57 @@ def upgrade_tabstops(node):
 	@type offset: int
 	@returns Maximum tabstop index in element
 	"""
+	context = get_context()
+	texts, max_num = _upgrade_tabstops((node.start, node.end, node.content), context.max_tabstop)
+	node.start, node.end, node.content = texts
+		
+	context.max_tabstop += max_num + 1
+		
+	return max_num
+
+def _upgrade_tabstops(texts, offset):
+	"""
+	Adds offset to tabstop indexes in strings
+	@type texts: tuple
+	@type offset: int
+	@return: Tuple of upgraded strings and maximum tabstop index found
+	"""
 	max_num = [0]
-	props = ('start', 'end', 'content')
 	
 	def _replace(m):
 		num = int(m.group(1) or m.group(2))
 		if num > max_num[0]: max_num[0] = num
-		return re.sub(r'\d+', str(num + max_tabstop), m.group(0), 1)
+		return re.sub(r'\d+', str(num + offset), m.group(0), 1)
 	
-	for prop in props:
-		node.__setattr__(prop, re.sub(r'\$(\d+)|\$\{(\d+):[^\}]+\}', _replace, node.__getattribute__(prop)))
-		
-	globals()['max_tabstop'] += max_num[0] + 1
+	result = []
+	for text in texts:
+		if '$' in text:
+			text = re_tabstop.sub(_replace, text)
+		result.append(text)
 		
-	return max_num[0]
+	return tuple(result), max_num[0]
+
+def _finalize_output(ops, offsets, start, end, content, counter):
+	"""
+	Performs output operations deferred by filters for a copy of repeated 
+	element (see <code>ZenNode.deferred</code>)
+	@param ops: List of operations: 'counters' or 'tabstops'
+	@type ops: list
+	@param offsets: Tabstop offset for each 'tabstops' operation, updated
+	@type offsets: list
+	@param counter: Element copy counter
+	@type counter: int
+	@return: Tuple of output strings
+	"""
+	for i, op in enumerate(ops):
+		if op == 'counters':
+			start = render_counter(start, counter)
+			end = render_counter(end, counter)
+		elif op == 'tabstops':
+			(start, end, content), max_num = _upgrade_tabstops((start, end, content), offsets[i])
+			offsets[i] += max_num + 1
+			
+	return start, end, content
 
 def unescape_text(text):
 	"""
@@ -1013,6 +1758,7 @@ def get_profile(name):
 	"""
 	Get profile by it's name. If profile wasn't found, returns 'plain' profile
 	"""
+	profiles = get_context().profiles
 	return profiles[name] if name in profiles else profiles['plain']
 
 def get_image_size(stream): # (FM) less code when called
@@ -1064,9 +1810,134 @@ def get_image_size(stream): # (FM) less code when called
 		return None
 
 def update_settings(settings):
-	globals()['zen_settings'] = settings
+	"""
+	Set new Zen Coding settings (usually, the result of 
+	<code>stparser.get_settings()</code>) of active expansion context and drop
+	parsed abbreviations cache
+	@type settings: dict
+	"""
+	global zen_settings
+	context = get_context()
+	context.update_settings(settings)
+	if context is _defaults or context is getattr(_local, 'default', None):
+		# settings of module-level functions, threads that start later
+		# use them too
+		zen_settings = settings
+		_defaults.copy_settings(context)
+	
+	tree_cache.clear()
+
+def get_context():
+	"""
+	Returns expansion context which is active in current thread, or default
+	context of the thread, which is used by module-level functions. Default
+	context of thread is made on first use
+	@return: ExpansionContext
+	"""
+	context = getattr(_local, 'context', None)
+	if context is None:
+		context = getattr(_local, 'default', None)
+		if context is None:
+			context = _local.default = ExpansionContext()
+	
+	return context
+
+def get_tree_cache_stats():
+	"""
+	Returns parsed abbreviations cache counters: hits, misses, evictions,
+	size and weight
+	@return: dict
+	"""
+	return tree_cache.stats()
+
+def enable_stats(enabled=True):
+	"""
+	Turns expansion statistics collecting on or off. Statistics are 
+	collected for all threads
+	@type enabled: bool
+	"""
+	global stats_enabled
+	stats_enabled = enabled
+
+@contextlib.contextmanager
+def collect_stats():
+	"""
+	Context manager that collects expansion statistics inside 
+	<code>with</code> block:
+	
+	with zen_coding.collect_stats():
+		zen_coding.expand_abbreviation('ul>li*5', 'html', 'xhtml')
+	print zen_coding.get_stats()
+	"""
+	enabled = stats_enabled
+	enable_stats(True)
+	try:
+		yield
+	finally:
+		enable_stats(enabled)
+
+def get_stats():
+	"""
+	Returns expansion statistics collected since last <code>reset_stats()</code>
+	call. Each expansion phase ('parse', 'rollout', 'filters', 'output',
+	'variables') and each filter ('filter:html', 'filter:c', ...) has
+	a dict with wall time in seconds, number of calls and number of nodes 
+	processed
+	@return: dict
+	"""
+	result = {}
+	with _stats_lock:
+		for phase, item in _stats.items():
+			result[phase] = dict(item)
+	
+	return result
+
+def reset_stats():
+	"""
+	Clears collected expansion statistics
+	"""
+	with _stats_lock:
+		_stats.clear()
+
+def _record_stats(phase, elapsed, nodes=0):
+	"""
+	Adds phase call to statistics
+	@type phase: str
+	@param elapsed: Time spent, in seconds
+	@type elapsed: float
+	@param nodes: Number of processed nodes
+	@type nodes: int
+	"""
+	with _stats_lock:
+		item = _stats.get(phase)
+		if item is None:
+			item = _stats[phase] = {'time': 0.0, 'calls': 0, 'nodes': 0}
+		
+		item['time'] += elapsed
+		item['calls'] += 1
+		item['nodes'] += nodes
+
+def _count_nodes(tree):
+	"""
+	Returns number of nodes in rolled out tree, including its root. Repeat
+	node is counted once
+	@type tree: ZenNode
+	@return: int
+	"""
+	count = 0
+	stack = [tree]
+	while stack:
+		node = stack.pop()
+		count += 1
+		stack.extend(node.children)
+	
+	return count
 	
 class Tag(object):
+	__slots__ = ('name', 'count', 'children', 'attributes', 'multiply_elem',
+		'__attr_hash', '_abbr', '__content', 'repeat_by_lines', '_res', '_elements',
+		'parent', 'filters', 'last', 'counter')
+	
 	def __init__(self, name, count=1, doc_type='html'):
 		"""
 		@param name: Tag name
@@ -1078,13 +1949,14 @@ class Tag(object):
 		"""
 		name = name.lower()
 		
-		abbr = get_abbreviation(doc_type, name)
-		
-		if abbr and abbr.type == stparser.TYPE_REFERENCE:
-			abbr = get_abbreviation(doc_type, abbr.value)
+		index = _get_index(doc_type)
+		abbr = index['tags'].get(name)
 		
 		self.name = abbr and abbr.value['name'] or name.replace('+', '')
 		self.count = count
+		# counter of the first copy, copies of multiplied groups start after
+		# counters of the previous copy
+		self.counter = 1
 		self.children = []
 		self.attributes = []
 		self.multiply_elem = None
@@ -1092,7 +1964,8 @@ class Tag(object):
 		self._abbr = abbr
 		self.__content = ''
 		self.repeat_by_lines = False
-		self._res = zen_settings.has_key(doc_type) and zen_settings[doc_type] or {}
+		self._res = index['resource']
+		self._elements = index['elements']
 		self.parent = None
 		
 		# add default attributes
@@ -1174,12 +2047,25 @@ class Tag(object):
 		
 		return deepest_child
 	
+	def get_size(self):
+		"""
+		Returns number of elements in tree, including current one
+		@return: int
+		"""
+		size = 1
+		for child in self.children:
+			size += child.get_size()
+		
+		return size
+	
 class Snippet(Tag):
+	__slots__ = ('value',)
+	
 	def __init__(self, name, count=1, doc_type='html'):
 		super(Snippet, self).__init__(name, count, doc_type)
 		self.value = replace_unescaped_symbol(get_snippet(doc_type, name), '|', get_caret_placeholder())
 		self.attributes = {'id': get_caret_placeholder(), 'class': get_caret_placeholder()}
-		self._res = zen_settings[doc_type]		
+		self._res = _get_index(doc_type)['resource']
 	
 	def is_block(self):
 		return True
@@ -1188,6 +2074,10 @@ class ZenNode(object):
 	"""
 	Creates simplified tag from Zen Coding tag
 	"""
+	__slots__ = ('type', 'name', 'attributes', 'children', 'counter', 'source',
+		'parent', 'next_sibling', 'previous_sibling',
+		'start', 'end', 'content', 'padding', 'repeat', 'lines', 'deferred')
+	
 	def __init__(self, tag):
 		"""
 		@type tag: Tag
@@ -1211,6 +2101,22 @@ class ZenNode(object):
 		self.end = ''
 		self.content = ''
 		self.padding = ''
+		
+		self.repeat = 1
+		"""
+		How many copies of element (with its children) are outputted. Copies
+		differ only in counter (starting with <code>counter</code>) and
+		content lines
+		"""
+		
+		self.lines = None
+		"Content of each copy of the nearest repeated element"
+		
+		self.deferred = None
+		"""
+		Operations that filters left for output stage, like counter
+		replacement. Used in the root of tree with repeat nodes only
+		"""
 
 	def add_child(self, tag):
 		"""
@@ -1246,14 +2152,14 @@ class ZenNode(object):
 		if self.type == 'snippet':
 			return False
 			
-		return (self.source._abbr and self.source._abbr.value['is_empty']) or (self.name in get_elements_collection(self.source._res, 'empty'))
+		return (self.source._abbr and self.source._abbr.value['is_empty']) or (self.name in self.source._elements.get('empty', ()))
 	
 	def is_inline(self):
 		"""
 		Test if current tag is inline-level (like <strong>, <img>)
 		@return: bool
 		"""
-		return self.name in get_elements_collection(self.source._res, 'inline_level')
+		return self.name in self.source._elements.get('inline_level', ())
 	
 	def is_block(self):
 		"""
@@ -1307,10 +2213,56 @@ class ZenNode(object):
 		
 		return deepest_child
 	
+	def iter_output(self):
+		"""
+		Walks the tree once and yields output strings of current element and
+		its descendants in document order. Repeat nodes are outputted once
+		for each copy
+		@return: generator
+		"""
+		ops = self.deferred
+		offsets = ops and [0] * len(ops)
+		
+		# stack items are closing strings and (node, copy, line) tuples
+		stack = [(self, 0, 0)]
+		while stack:
+			item = stack.pop()
+			if not isinstance(item, tuple):
+				if item:
+					yield item
+				continue
+			
+			node, copy, line = item
+			if node.repeat > 1:
+				if copy + 1 < node.repeat:
+					stack.append((node, copy + 1, line))
+				line = copy
+				
+			start, end = node.start, node.end
+			content = node.lines[line] if node.lines else node.content
+			if ops and node is not self:
+				start, end, content = _finalize_output(ops, offsets, start, end, content, node.counter + copy)
+			
+			if start:
+				yield start
+			if content:
+				yield content
+			
+			stack.append(end)
+			for child in reversed(node.children):
+				stack.append((child, 0, line))
+	
+	def write(self, sink):
+		"""
+		Writes output of current element into file-like object
+		@param sink: Object with <code>write()</code> method
+		"""
+		for chunk in self.iter_output():
+			sink.write(chunk)
+	
 	def to_string(self):
 		"@return {String}"
-		content = ''.join([item.to_string() for item in self.children])
-		return self.start + self.content + content + self.end
+		return ''.join(self.iter_output())
 		
 class ZenError(Exception):
 	"""
@@ -1318,17 +2270,129 @@ class ZenError(Exception):
 	@since: 0.65
 	"""
 	def __init__(self, value):
+		Exception.__init__(self, value)
 		self.value = value
 	def __str__(self):
 		return repr(self.value)
+
+class InvalidAbbreviation(ZenError):
+	"""
+	Abbreviation syntax error
+	"""
+	def __init__(self, value, pos):
+		"""
+		@param value: Error message
+		@type value: str
+		@param pos: Index of invalid character in abbreviation
+		@type pos: int
+		"""
+		ZenError.__init__(self, value)
+		# all arguments are kept, so error may be pickled and sent back from
+		# worker process of expand_many()
+		self.args = (value, pos)
+		self.pos = pos
+	def __str__(self):
+		return '%s at character %d' % (self.value, self.pos)
+		
+class ExpansionContext(object):
+	"""
+	Expansion state: settings, output profiles, variables, newline, caret
+	placeholder and tabstop counter. Module-level functions use context 
+	which is active in current thread (see <code>get_context()</code>), so 
+	threads that expand abbreviations with their own contexts don't affect
+	each other. Context is activated by <code>with</code> statement:
+	
+	context = ExpansionContext(caret_placeholder='|')
+	with context:
+		zen_coding.expand_abbreviation('ul>li*3', 'html', 'xhtml')
+	
+	Context shouldn't be active in several threads at once
+	"""
+	_versions = [0]
+	
+	def __init__(self, settings=None, profiles=None, newline=None, caret_placeholder=None):
+		"""
+		Parameters that aren't passed are copied from default context
+		@param settings: Zen Coding settings (see <code>stparser.get_settings()</code>)
+		@type settings: dict
+		@param profiles: Output profiles, by name
+		@type profiles: dict
+		@type newline: str
+		@param caret_placeholder: Placeholder string or generator function
+		@type caret_placeholder: str, function
+		"""
+		base = _defaults
+		if settings is None:
+			self.copy_settings(base)
+		else:
+			self.update_settings(settings)
 		
-# create default profiles
-setup_profile('xhtml');
-setup_profile('html', {'self_closing_tag': False});
-setup_profile('xml', {'self_closing_tag': True, 'tag_nl': True});
-setup_profile('plain', {'tag_nl': False, 'indent': False, 'place_cursor': False});
+		self.profiles = profiles if profiles is not None else dict(base.profiles)
+		self.newline = newline if newline is not None else base.newline
+		self.caret_placeholder = caret_placeholder if caret_placeholder is not None else base.caret_placeholder
+		self.max_tabstop = 0
+		
+	def update_settings(self, settings):
+		"""
+		Sets new settings of context
+		@type settings: dict
+		"""
+		index = getattr(settings, 'index', None)
+		if index is None:
+			index = stparser.create_index(settings)
+		
+		self._versions[0] += 1
+		self.settings = settings
+		self.index = index
+		self.version = self._versions[0]
+		self.variables = dict(settings.get('variables', {}))
+	
+	def copy_settings(self, context):
+		"""
+		Sets settings of another context, with copy of its variables
+		@type context: ExpansionContext
+		"""
+		self.settings = context.settings
+		self.index = context.index
+		self.version = context.version
+		self.variables = dict(context.variables)
+		
+	def __enter__(self):
+		stack = _local.__dict__.setdefault('stack', [])
+		stack.append(getattr(_local, 'context', None))
+		_local.context = self
+		return self
+	
+	def __exit__(self, *args):
+		_local.context = _local.stack.pop()
+		
+	def expand_abbreviation(self, abbr, syntax='html', profile_name='plain'):
+		"""
+		Expands abbreviation in this context
+		@type abbr: str
+		@return: str
+		"""
+		with self:
+			return expand_abbreviation(abbr, syntax, profile_name)
+		
+	def wrap_with_abbreviation(self, abbr, text, doc_type='html', profile='plain'):
+		"""
+		Wraps text with abbreviation in this context
+		@return: str
+		"""
+		with self:
+			return wrap_with_abbreviation(abbr, text, doc_type, profile)
+
+_defaults = ExpansionContext({'variables': {}}, profiles, '\n', '{%::zen-caret::%}')
 
-# This method call explicity loads default settings from zen_settings.py on start up
-# Comment this line if you want to load data from other resources (like editor's 
-# native snippet) 
-update_settings(stparser.get_settings())
+with _defaults:
+	# create default profiles
+	setup_profile('xhtml');
+	setup_profile('html', {'self_closing_tag': False});
+	setup_profile('xml', {'self_closing_tag': True, 'tag_nl': True});
+	setup_profile('plain', {'tag_nl': False, 'indent': False, 'place_cursor': False});
+	
+	# This method call explicity loads default settings from zen_settings.py on start up
+	# Comment this line if you want to load data from other resources (like editor's 
+	# native snippet) 
+	update_settings(stparser.get_settings())
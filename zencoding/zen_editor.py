@@ -15,13 +15,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
-import sys, os, re, locale
+import sys, os, re, locale, bisect
+import gobject
 
-import zen_core, zen_actions, zen_file, html_matcher
+import zen_core, zen_actions, zen_file, html_matcher, document_index
 from image_size import update_image_size
 
 import zen_dialog
-from html_navigation import HtmlNavigation
 from lorem_ipsum import lorem_ipsum
 
 try:
@@ -47,6 +47,149 @@ class ZenSnippet():
 		return self.properties[prop]
 
 
+re_line_break = re.compile(u'\r\n|[\n\r\u2029]')
+
+parse_delay = 500
+"Time without changes of buffer before it's parsed in background, in milliseconds"
+
+parse_time_slice = 0.02
+"Time of background parse in each idle call, in seconds"
+
+markup_languages = ('HTML', 'XML', 'XSLT', 'PHP')
+"Languages of buffers parsed in background, others are parsed on first navigation"
+
+class BufferSnapshot():
+	"""
+	Text of GtkTextBuffer, copied from the buffer once and reused until the
+	buffer changes. Changes are counted from buffer's insert-text and
+	delete-range signals, and passed to navigation tree of the buffer, so it
+	parses again only changed part of text. Indexes of the text are shared
+	with actions through document_index. Navigation tree of active markup
+	buffer is parsed in background, in idle time slices. Until the text is
+	copied again, lines and ranges are read from the buffer
+	"""
+
+	def __init__(self, buffer):
+		self.buffer = buffer
+		self.version = 0
+		self.parse_source = None
+		self.clear()
+		self.handlers = [
+			buffer.connect('insert-text', self.on_insert_text),
+			buffer.connect('delete-range', self.on_delete_range)
+		]
+
+	def on_insert_text(self, buffer, location, text, length):
+		self.version += 1
+		if self.navigation:
+			self.navigation.edit(location.get_offset(), 0, text.decode('UTF-8'))
+			self.schedule_parse()
+
+	def on_delete_range(self, buffer, start, end):
+		self.version += 1
+		if self.navigation:
+			offset_start, offset_end = sorted([start.get_offset(), end.get_offset()])
+			self.navigation.edit(offset_start, offset_end - offset_start, u'')
+			self.schedule_parse()
+
+	def schedule_parse(self):
+		"""
+		Parses text in background when buffer isn't changed for a while, so
+		navigation waits only for the part of parse that isn't done yet
+		"""
+		self.cancel_parse()
+		self.parse_source = gobject.timeout_add(parse_delay, self.on_parse_timeout)
+
+	def cancel_parse(self):
+		if self.parse_source is not None:
+			gobject.source_remove(self.parse_source)
+			self.parse_source = None
+
+	def on_parse_timeout(self):
+		self.parse_source = gobject.idle_add(self.on_parse_idle, priority = gobject.PRIORITY_LOW)
+		return False
+
+	def on_parse_idle(self):
+		navigation = self.get_navigation()
+		if navigation.update(self.document.content, parse_time_slice):
+			self.parse_source = None
+			return False
+		return True
+
+	def clear(self):
+		"""Drops copied text and navigation tree, they will be made again on next access"""
+		self.cancel_parse()
+		self.content = None
+		self.content_version = None
+		self.line_starts = None
+		self.navigation = None
+		self.document = None
+
+	def close(self):
+		"""Drops copied text and stops following changes of the buffer"""
+		self.clear()
+		for handler in self.handlers:
+			self.buffer.disconnect(handler)
+		self.handlers = []
+
+	def is_current(self):
+		"""Tells if copied text is the current text of the buffer"""
+		return self.content_version == self.version
+
+	def get_content(self):
+		if self.content_version != self.version:
+			self.content = self.buffer.get_text(self.buffer.get_start_iter(), self.buffer.get_end_iter()).decode('UTF-8')
+			self.content_version = self.version
+			self.line_starts = None
+		return self.content
+
+	def get_range(self, offset_start, offset_end):
+		if self.is_current():
+			return self.content[offset_start:offset_end]
+
+		iter_start = self.buffer.get_iter_at_offset(offset_start)
+		iter_end = self.buffer.get_iter_at_offset(offset_end)
+		return self.buffer.get_text(iter_start, iter_end).decode('UTF-8')
+
+	def get_document(self):
+		"""Returns index of current text, made current for actions"""
+		content = self.get_content()
+		if self.document is None or self.document.content is not content:
+			self.document = document_index.DocumentIndex(content, self.navigation)
+		document_index.set_document(self.document)
+		return self.document
+
+	def get_navigation(self):
+		self.navigation = self.get_document().get_navigation()
+		return self.navigation
+
+	def get_line_range(self, offset):
+		"""
+		Returns start and end offsets of line that contains offset, without
+		line break
+		"""
+		if not self.is_current():
+			# line is found in the buffer, copying the whole text for it is slower
+			iter_start = self.buffer.get_iter_at_offset(offset)
+			iter_start.set_line_offset(0)
+			iter_end = iter_start.copy()
+
+			if iter_end.forward_visible_line():
+				iter_end.backward_char()
+			else:
+				iter_end = self.buffer.get_end_iter()
+
+			return iter_start.get_offset(), iter_end.get_offset()
+
+		content = self.content
+		if self.line_starts is None:
+			self.line_starts = [0] + [m.end() for m in re_line_break.finditer(content)]
+
+		line = bisect.bisect_right(self.line_starts, offset) - 1
+		if line + 1 < len(self.line_starts):
+			return self.line_starts[line], self.line_starts[line + 1] - 1
+		return self.line_starts[line], len(content)
+
 placeholder_count = 0
 
 def placeholder_feed(m):
@@ -82,6 +225,30 @@ class ZenEditor():
 		self.html_navigation = None
 		self.snippet_document = {}
 
+		self.snapshot = None
+		self.snapshots = {}
+		self.window_handlers = [window.connect('tab-removed', self.on_tab_removed)]
+
+	def close(self):
+		"""Stops background parses and following changes of buffers and window"""
+		for handler in self.window_handlers:
+			self.window.disconnect(handler)
+		self.window_handlers = []
+		for snapshot in self.snapshots.values():
+			snapshot.close()
+		self.snapshots = {}
+		self.snapshot = None
+		document_index.clear()
+
+	def on_tab_removed(self, window, tab):
+		"""Forgets snapshot and snippets of closed document"""
+		snapshot = self.snapshots.pop(tab.get_document(), None)
+		if snapshot:
+			snapshot.close()
+			if snapshot is self.snapshot:
+				self.snapshot = None
+		self.snippet_document.pop(tab.get_view(), None)
+
 	# --- Original interface ---------------------------------------------------
 
 	def set_context(self, view):
@@ -103,6 +270,18 @@ class ZenEditor():
 		self.view = view
 		if self.view:
 			self.buffer = self.view.get_buffer()
+
+			if not (self.buffer in self.snapshots):
+				self.snapshots[self.buffer] = BufferSnapshot(self.buffer)
+			if self.snapshot and self.snapshot is not self.snapshots[self.buffer]:
+				# don't keep text of inactive documents
+				self.snapshot.clear()
+			if self.snapshot is not self.snapshots[self.buffer]:
+				self.snapshot = self.snapshots[self.buffer]
+				lang = self.document and self.document.get_language()
+				if lang and lang.get_name() in markup_languages:
+					self.snapshot.schedule_parse()
+
 			if self.view.get_insert_spaces_instead_of_tabs():
 				zen_core.set_variable('indentation', " " * self.view.get_tab_width())
 			else:
@@ -138,18 +317,7 @@ class ZenEditor():
 			self.buffer.select_range(iter_start, iter_end)
 
 	def get_current_line_range(self):
-
-		iter_start = self.get_insert_iter()
-		iter_start.set_line_offset(0)
-		iter_end = iter_start.copy()
-
-		if iter_end.forward_visible_line():
-			iter_end.backward_char()
-
-		else:
-			iter_end = self.buffer.get_end_iter()
-
-		return iter_start.get_offset(), iter_end.get_offset()
+		return self.snapshot.get_line_range(self.get_insert_offset())
 
 	def get_caret_pos(self):
 		return self.get_insert_offset()
@@ -160,9 +328,7 @@ class ZenEditor():
 	def get_current_line(self):
 
 		offset_start, offset_end = self.get_current_line_range()
-		iter_start = self.buffer.get_iter_at_offset(offset_start)
-		iter_end = self.buffer.get_iter_at_offset(offset_end)
-		return self.buffer.get_text(iter_start, iter_end).decode('UTF-8')
+		return self.get_range(offset_start, offset_end)
 
 	def replace_content(self, value, offset_start=None, offset_end=None):
 
@@ -189,9 +355,10 @@ class ZenEditor():
 		self.insertion_end = self.get_insert_offset()
 
 	def get_content(self):
-		iter_start = self.buffer.get_iter_at_offset(0)
-		iter_end = self.get_end_iter()
-		return self.buffer.get_text(iter_start, iter_end).decode('UTF-8')
+		return self.snapshot.get_document().content
+
+	def get_range(self, offset_start, offset_end):
+		return self.snapshot.get_range(offset_start, offset_end)
 
 	def get_syntax(self):
 		lang = self.window.get_active_document().get_language()
@@ -212,9 +379,7 @@ class ZenEditor():
 
 	def get_selection(self):
 		offset_start, offset_end = self.get_selection_range()
-		iter_start = self.buffer.get_iter_at_offset(offset_start)
-		iter_end = self.buffer.get_iter_at_offset(offset_end)
-		return self.buffer.get_text(iter_start, iter_end).decode('UTF-8')
+		return self.get_range(offset_start, offset_end)
 
 	def get_file_path(self):
 		return re.sub('^file://', '', self.document.get_uri())
@@ -267,8 +432,7 @@ class ZenEditor():
 	def prepare_nav(self):
 		offset_start, offset_end = self.get_selection_range()
 		content = self.get_content()
-		if not self.html_navigation:
-			self.html_navigation = HtmlNavigation(content)
+		self.html_navigation = self.snapshot.get_navigation()
 		return offset_start, offset_end, content
 
 	#--- Snippet hook ----------------------------------------------------------
@@ -511,10 +675,7 @@ class ZenEditor():
 
 			if node:
 
-				iter_start = self.buffer.get_iter_at_offset(node.start)
-				iter_end = self.buffer.get_iter_at_offset(node.end)
-
-				found = self.buffer.get_text(iter_start, iter_end).decode('UTF-8')
+				found = self.get_range(node.start, node.end)
 				if not with_spaces and found.isspace() and found.find('\n') != -1:
 					offset_start = node.start
 					offset_end = node.end